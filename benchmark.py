@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy as np
+import pygame
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = []
+STARTUP_BUDGET = 1.0  # seconds from the start of the process to the first frame
+
+
+def benchmark(name, number, repeat=5):
+    """Registers a benchmark. The decorated function prepares everything and returns a function to be timed."""
+    def register(setup):
+        BENCHMARKS.append((name, setup, number, repeat))
+        return setup
+    return register
+
+
+def init():
+    """Initializes pygame with a dummy window, which is needed to load images."""
+    pygame.init()
+    pygame.display.set_mode((800, 600))
+    np.random.seed(0)
+
+
+def regular_polygon(vertices, center=(400, 300), radius=250):
+    """
+
+    :return: vertices of a regular polygon.
+    """
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    return np.stack((center[0] + radius * np.cos(angles), center[1] + radius * np.sin(angles)), axis=1).astype(int)
+
+
+@benchmark("ball_update", number=20000)
+def ball_update():
+    import objects
+    ball = objects.Ball(pygame.sprite.Group(), 10, (400, 300))
+    ball.vel = np.array([3.0, 4.0])
+    return lambda: ball.update(0.05, 0.0, 0.6)
+
+
+def obstacle_collide(vertices):
+    def setup():
+        import objects
+        group = pygame.sprite.Group()
+        obstacle = objects.Obstacle(group, (800, 600), regular_polygon(vertices))
+        ball = objects.Ball(group, 10, (400, 300))
+        ball.vel = np.array([3.0, 4.0])
+        ball.prev_pos = ball.pos - ball.vel * 0.6
+        return lambda: obstacle.collide(ball)
+    return setup
+
+
+for _vertices in (3, 8, 32, 128):
+    benchmark(f"obstacle_collide[{_vertices}]", number=max(20000 // _vertices, 100))(obstacle_collide(_vertices))
+
+
+def make_chaos_study(balls, processes=1):
+    """
+
+    :param processes: number of processes that move balls, they are moved in this process if it is 1.
+    :return: chaos study of level 2 with balls that have just been hit.
+    """
+    import game
+    chaos = game.ChaosStudy(2)
+    chaos.processes = processes
+    chaos.parallel_from = 0
+    variables = [20, np.pi / 360, balls]
+    click = pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=(250, 300), button=1)
+    chaos.update([click], 0.6, variables)
+    chaos.cue.direction = np.array([0.6, 0.8])
+    chaos.update([click], 0.6, variables)
+    return chaos, variables
+
+
+def chaos_steps(balls, workers=False):
+    """
+    :param workers: if True, balls are moved in worker processes, at least two of them even on a single core, where
+        only the overhead of workers is seen.
+    """
+    def setup():
+        import parallel
+        chaos, variables = make_chaos_study(balls, max(parallel.default_processes(), 2) if workers else 1)
+        return lambda: chaos.update([], 0.6, variables)
+    return setup
+
+
+def chaos_draw(balls):
+    def setup():
+        chaos, variables = make_chaos_study(balls)
+        return chaos.draw_on_field
+    return setup
+
+
+def chaos_density(balls):
+    def setup():
+        chaos, variables = make_chaos_study(balls)
+        chaos.density_on = True
+
+        def run():
+            chaos.update([], 0.6, variables)
+            chaos.draw_on_field()
+        return run
+    return setup
+
+
+for _balls in (10, 100, 10000):
+    benchmark(f"chaos_step[{_balls}]", number=max(2000 // _balls, 1), repeat=3)(chaos_steps(_balls))
+    benchmark(f"chaos_draw[{_balls}]", number=max(2000 // _balls, 5), repeat=3)(chaos_draw(_balls))
+benchmark("chaos_density[10000]", number=5, repeat=3)(chaos_density(10000))
+for _balls in (1000, 100000):
+    benchmark(f"chaos_step[{_balls}]", number=max(2000 // _balls, 1), repeat=3)(chaos_steps(_balls))
+# ChaosStudy.parallel_from is where these become faster than chaos_step
+for _balls in (1000, 10000, 100000):
+    benchmark(f"chaos_step_parallel[{_balls}]", number=max(2000 // _balls, 1), repeat=3)(chaos_steps(_balls, True))
+
+
+@benchmark("field_map_sample[10000]", number=200)
+def field_map_sample():
+    import physics
+    field_map = physics.FieldMap((100, 100), 50, np.random.rand(8, 13))
+    pos = np.random.rand(10000, 2) * [800, 600]
+    return lambda: field_map.sample_many(pos)
+
+
+@benchmark("game_draw_on_field", number=200)
+def game_draw_on_field():
+    import game
+    level = game.Game(2)
+    level.cue.update((500, 300))
+    return level.draw_on_field
+
+
+@benchmark("cue_update", number=500)
+def cue_update():
+    import objects
+    cue = objects.Cue(pygame.sprite.Group(), np.array([400.0, 300.0]), max_vel=15)
+    positions = [(400 + 100 * np.cos(a), 300 + 100 * np.sin(a)) for a in np.linspace(0, 2 * np.pi, 64)]
+    state = {"i": 0}
+
+    def run():
+        state["i"] = (state["i"] + 1) % len(positions)
+        cue.update(positions[state["i"]])
+    return run
+
+
+@benchmark("read_map", number=2000)
+def read_map():
+    import data
+    return lambda: data.read_map(5)
+
+
+STARTUP_SCRIPT = """
+import os, time
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+start = time.perf_counter()
+import pygame
+import main
+pygame.init()
+screen = pygame.display.set_mode(main.WINDOW_SIZE)
+imported = time.perf_counter()
+manager = main.Manager()
+made = time.perf_counter()
+manager.process(screen)
+pygame.display.update()
+print(imported - start, made - imported, time.perf_counter() - start)
+"""
+
+
+def copy_tree(levels):
+    """Copies the game to a temporary folder and makes the given number of levels there."""
+    path = tempfile.mkdtemp(prefix="magnetic-pool-")
+    for name in os.listdir(ROOT):
+        source = os.path.join(ROOT, name)
+        if name.endswith(".py"):
+            shutil.copy(source, path)
+        elif name in ("images", "info", "themes", "levels"):
+            shutil.copytree(source, os.path.join(path, name))
+    shipped = sorted(name for name in os.listdir(os.path.join(path, "levels")) if name.startswith("level_"))
+    with open(os.path.join(path, "levels", "high_scores.txt"), "w", encoding="utf8") as f:
+        f.write("\n".join(f"{i + 1} 0" for i in range(levels)))
+    for i in range(len(shipped), levels):
+        shutil.copy(os.path.join(path, "levels", shipped[i % len(shipped)]),
+                    os.path.join(path, "levels", f"level_{i + 1}.txt"))
+    return path
+
+
+def startup(levels, repeat=3):
+    """Measures import time, Manager.__init__ time and time to the first frame in fresh processes. The first run
+    makes pictures of the levels, so it is not counted."""
+    path = copy_tree(levels)
+    try:
+        runs = []
+        for _ in range(repeat + 1):
+            output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=path, check=True,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+            runs.append([float(value) for value in output.stdout.split()[-3:]])
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    runs = np.array(runs[1:])
+    return {f"startup_import[{levels}]": summary(runs[:, 0]),
+            f"manager_init[{levels}]": summary(runs[:, 1]),
+            f"first_frame[{levels}]": summary(runs[:, 2])}
+
+
+def summary(times):
+    """
+
+    :return: dictionary with statistics of times of one operation in seconds.
+    """
+    times = np.asarray(times)
+    return {"min": float(times.min()), "median": float(np.median(times)), "mean": float(times.mean()),
+            "runs": len(times)}
+
+
+def run(name_filter=None):
+    """Runs all benchmarks whose names contain the filter. They are run in a copy of the game, because creating
+    levels saves their pictures.
+
+    :return: dictionary with results.
+    """
+    path = copy_tree(5)
+    os.chdir(path)
+    sys.path.insert(0, path)
+    init()
+    results = {}
+    for name, setup, number, repeat in BENCHMARKS:
+        if name_filter and name_filter not in name:
+            continue
+        function = setup()
+        function()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                function()
+            times.append((time.perf_counter() - start) / number)
+        results[name] = summary(times)
+        print(f"{name:<28} {results[name]['median'] * 1e6:12.1f} us", file=sys.stderr)
+    for levels in (5, 10, 20):
+        if name_filter and name_filter not in "startup_import manager_init first_frame":
+            continue
+        for name, result in startup(levels).items():
+            results[name] = result
+            print(f"{name:<28} {result['median'] * 1e6:12.1f} us", file=sys.stderr)
+    os.chdir(ROOT)
+    shutil.rmtree(path, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints ratios of medians to the baseline.
+
+    :return: list of names of benchmarks that became slower than the threshold allows.
+    """
+    slower = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        mark = ""
+        if ratio > 1 + threshold:
+            slower.append(name)
+            mark = "  SLOWER"
+        elif ratio < 1 - threshold:
+            mark = "  faster"
+        print(f"{name:<28} {ratio:6.2f}x{mark}", file=sys.stderr)
+    return slower
+
+
+def main():
+    """Runs benchmarks, saves results and compares them with the baseline."""
+    parser = argparse.ArgumentParser(description="Benchmarks of physics, rendering and startup. The exit code is 1 "
+                                                 "if time to the first frame is over the budget or, with --compare, "
+                                                 "if some benchmark became slower than the baseline by more than "
+                                                 "the threshold.")
+    parser.add_argument("--filter", help="run only benchmarks whose names contain this string")
+    parser.add_argument("--output", help="file to save results to")
+    parser.add_argument("--compare", help="file with baseline results")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative slowdown")
+    parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET,
+                        help="maximum time to the first frame in seconds")
+    args = parser.parse_args()
+    output = args.output and os.path.abspath(args.output)
+    baseline_path = args.compare and os.path.abspath(args.compare)
+
+    results = run(args.filter)
+    report = {"python": platform.python_version(), "pygame": pygame.version.ver, "numpy": np.__version__,
+              "machine": platform.machine(), "results": results}
+    if output:
+        with open(output, "w", encoding="utf8") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    failed = False
+    for name, result in results.items():
+        if name.startswith("first_frame") and result["median"] > args.startup_budget:
+            print(f"{name} is {result['median']:.2f} s, over the budget of {args.startup_budget:.2f} s",
+                  file=sys.stderr)
+            failed = True
+    if baseline_path:
+        with open(baseline_path, encoding="utf8") as f:
+            baseline = json.load(f)["results"]
+        slower = compare(results, baseline, args.threshold)
+        if slower:
+            print("slower than baseline: " + ", ".join(slower), file=sys.stderr)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import numpy as np
+
+BALL = -1  # obstacle number of collisions of two balls, vertex is then the number of the other ball
+
+# one collision: time step, number of the ball, number of the obstacle in the list of obstacles (0 is the edge of the
+# table) or BALL, number of the vertex as in physics.collide, point of contact, velocity before and after it
+EVENT = np.dtype([("tick", "<i8"), ("ball", "<i4"), ("obstacle", "<i4"), ("vertex", "<i4"), ("point", "<f8", (2,)),
+                  ("vel_in", "<f8", (2,)), ("vel_out", "<f8", (2,))])
+
+
+class CollisionBus:
+    """Collects collisions of a time step into a structured array of EVENT records and passes them to subscribers,
+    such as scoring and the Poincare section, at the end of the step.
+
+    The array is allocated once and grows by doubling if a step has more collisions, so steps without collisions
+    don't allocate anything.
+
+    Attributes:
+        buffer: structured array of EVENT records, first count of which are collisions of the current step.
+        count: number of collisions in the current step.
+        subscribers: functions that are called with the array of collisions of each step that has them. The array is
+            a view of the buffer, so it has to be copied to be kept.
+    """
+    def __init__(self, capacity=256):
+        self.buffer = np.zeros(capacity, dtype=EVENT)
+        self.count = 0
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def reserve(self, n):
+        """Makes room for n more collisions."""
+        if self.count + n <= len(self.buffer):
+            return
+        capacity = len(self.buffer)
+        while capacity < self.count + n:
+            capacity *= 2
+        buffer = np.zeros(capacity, dtype=EVENT)
+        buffer[:self.count] = self.buffer[:self.count]
+        self.buffer = buffer
+
+    def emit(self, ball, obstacle, vertex, point, vel_in, vel_out):
+        """Adds one collision."""
+        self.reserve(1)
+        record = self.buffer[self.count]
+        record["ball"], record["obstacle"], record["vertex"] = ball, obstacle, vertex
+        record["point"], record["vel_in"], record["vel_out"] = point, vel_in, vel_out
+        self.count += 1
+
+    def emit_many(self, balls, obstacle, vertex, point, vel_in, vel_out):
+        """Adds collisions of several balls. Arguments are arrays with one row for each ball, obstacle and vertex can
+        also be numbers."""
+        n = len(balls)
+        if n == 0:
+            return
+        self.reserve(n)
+        records = self.buffer[self.count:self.count + n]
+        records["ball"], records["obstacle"], records["vertex"] = balls, obstacle, vertex
+        records["point"], records["vel_in"], records["vel_out"] = point, vel_in, vel_out
+        self.count += n
+
+    def emit_pairs(self, first, second, pos, vel_in, vel_out):
+        """Adds collisions of pairs of balls as found by physics.collide_balls, one for each ball of a pair.
+
+        :param pos, vel_in, vel_out: coordinates of all balls and their velocities before and after collisions.
+        """
+        point = (pos[first] + pos[second]) / 2
+        balls = np.concatenate((first, second))
+        others = np.concatenate((second, first))
+        self.emit_many(balls, BALL, others, np.concatenate((point, point)), vel_in[balls], vel_out[balls])
+
+    def publish(self, tick):
+        """Passes collisions of the step to subscribers and starts the next step."""
+        if self.count == 0:
+            return
+        events = self.buffer[:self.count]
+        events["tick"] = tick
+        for callback in self.subscribers:
+            callback(events)
+        self.count = 0
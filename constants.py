@@ -0,0 +1,4 @@
+WINDOW_SIZE = WINDOW_WIDTH, WINDOW_HEIGHT = 800, 600
+FPS = 60
+DT = FPS / 100
+BG_COLOR = (255, 255, 255)
@@ -1,18 +1,30 @@
 import os
+import struct
 import pygame
-from main import WINDOW_SIZE
+from constants import WINDOW_SIZE
 import numpy as np
 import json
+import physics
+
+field_maps = {}  # level number: (line of the level file, physics.FieldMap made from it)
 
 
 def read_map(level):
     """Reads data from file about borders and positions of ball and pocket.
 
-    :return: array, consisting of list of points forming polygon and positions of ball and pocket.
+    A level can also have a line "field x y step columns rows values...", which describes magnetic field that changes
+    across the table: values are multipliers of the field set by player in nodes of a grid that starts at (x, y), row
+    by row. If there are several "ball" lines, the first one is the ball player hits and the others are balls it can
+    knock.
+
+    :return: array, consisting of positions of ball and pocket, list of points forming the edge, list of obstacles,
+        physics.FieldMap or None if the field is uniform and list of positions of other balls.
     """
     inp = open("levels/level_" + str(level) + ".txt", 'r')
 
     ball_pos, pocket_pos, edge, obstacles = [], [], [], []
+    field_map = None
+    other_balls = []
 
     for line in inp:
         if len(line.strip()) == 0 or line[0] == '#':
@@ -20,7 +32,10 @@ def read_map(level):
         line = line.split()
 
         if line[0] == "ball":
-            ball_pos = [int(line[1]), int(line[2])]
+            if ball_pos:
+                other_balls.append([int(line[1]), int(line[2])])
+            else:
+                ball_pos = [int(line[1]), int(line[2])]
         elif line[0] == "pocket":
             pocket_pos = [int(line[1]), int(line[2])]
         elif line[0] == "edge":
@@ -31,10 +46,26 @@ def read_map(level):
             for i in range(1, len(line), 2):
                 obstacle.append([int(line[i]), int(line[i + 1])])
             obstacles.append(obstacle)
+        elif line[0] == "field":
+            field_map = read_field_map(level, line)
 
     inp.close()
 
-    return [ball_pos, pocket_pos, edge, obstacles]
+    return [ball_pos, pocket_pos, edge, obstacles, field_map, other_balls]
+
+
+def read_field_map(level, line):
+    """Makes field map from a split "field" line of the level file. The map is cached, so the grid is parsed again
+    only when the line changes.
+    """
+    cached = field_maps.get(level)
+    if cached is not None and cached[0] == line:
+        return cached[1]
+    x, y, step, columns, rows = float(line[1]), float(line[2]), float(line[3]), int(line[4]), int(line[5])
+    values = np.array(line[6:6 + columns * rows], dtype=float).reshape(rows, columns)
+    field_map = physics.FieldMap((x, y), step, values)
+    field_maps[level] = (line, field_map)
+    return field_map
 
 
 def save_map(field, level):
@@ -68,26 +99,45 @@ def save_map(field, level):
                                                        'images/levels', "level_" + str(level) + ".png"))
 
 
+def format_level(map_data):
+    """
+    :param map_data: data about the level in the same format as read_map returns.
+    :return: text of the level file that read_map reads back.
+    """
+    def points(vertices):
+        return "".join(str(int(x)) + " " + str(int(y)) + " " for x, y in vertices)
+
+    text = "ball " + points([map_data[0]])[:-1] + "\n"
+    text += "pocket " + points([map_data[1]])[:-1] + "\n"
+    text += "edge " + points(map_data[2]) + "\n"
+    for obstacle in map_data[3]:
+        text += "obstacle " + points(obstacle) + "\n"
+    field_map = map_data[4] if len(map_data) > 4 else None
+    if field_map is not None:
+        rows, columns = field_map.values.shape
+        values = " ".join(str(value) for value in field_map.values.ravel().tolist())
+        text += f"field {field_map.origin[0]} {field_map.origin[1]} {field_map.step} {columns} {rows} {values}\n"
+    for ball in map_data[5] if len(map_data) > 5 else []:
+        text += "ball " + points([ball])[:-1] + "\n"
+    return text
+
+
 def save_level_data(constructor):
     """Saves data about level field to file in folder levels"""
-    output = open("levels/level_" + str(constructor.level) + ".txt", 'w')
+    with open("levels/level_" + str(constructor.level) + ".txt", 'w') as output:
+        output.write(format_level(constructor.map_data()))
 
-    ball_data = str(int(constructor.ball.pos[0])) + " " + str(int(constructor.ball.pos[1]))
-    pocket_data = str(int(constructor.pocket.pos[0])) + " " + str(int(constructor.pocket.pos[1]))
-    output.write("ball " + ball_data + "\n")
-    output.write("pocket " + pocket_data + "\n")
 
-    edge_data = ""
-    for vertex in constructor.obstacles[0].vertices:
-        edge_data += str(int(vertex[0])) + " " + str(int(vertex[1])) + " "
-    output.write("edge " + edge_data + "\n")
+def level_picture_outdated(level):
+    """
 
-    for i, obstacle in enumerate(constructor.obstacles[1:]):
-        obstacle_data = ""
-        for vertex in obstacle.vertices:
-            obstacle_data += str(int(vertex[0])) + " " + str(int(vertex[1])) + " "
-        output.write("obstacle " + obstacle_data + "\n")
-    output.close()
+    :return: True if picture or button theme of the level is missing or picture is older than the level file.
+    """
+    picture = os.path.join(os.path.dirname(__file__), 'images/levels', "level_" + str(level) + ".png")
+    theme = os.path.join("themes", "buttons", "level_" + str(level) + ".json")
+    if not os.path.exists(picture) or not os.path.exists(theme):
+        return True
+    return os.path.getmtime(picture) < os.path.getmtime(os.path.join("levels", "level_" + str(level) + ".txt"))
 
 
 def make_level_button_theme(level):
@@ -136,12 +186,110 @@ def get_levels_scores():
 
 
 def write_score(level, score):
-    """Writes score to file."""
+    """Writes score to file.
+
+    :return: True if the score is a new high score.
+    """
     data = get_levels_scores()
     if data.get(level, 0) < score:
         data[level] = score
         with open(os.path.join("levels", "high_scores.txt"), "w", encoding="utf8") as f:
             f.write("\n".join([f"{k} {v}" for k, v in data.items()]))
+        return True
+    return False
+
+
+def save_replay(level, raw):
+    """Saves record of the game that has set the high score to folder replays."""
+    os.makedirs("replays", exist_ok=True)
+    with open(os.path.join("replays", "level_" + str(level) + ".bin"), "wb") as f:
+        f.write(raw)
+
+
+def read_replay(level):
+    """
+
+    :return: record of the game that has set the high score, None if there is no record.
+    """
+    path = os.path.join("replays", "level_" + str(level) + ".bin")
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def checkpoint_paths(level):
+    """
+    :return: paths of the files with the state of the chaos study of the level and with its Poincare section.
+    """
+    folder = os.path.join("checkpoints", "chaos_level_" + str(level))
+    return os.path.join(folder, "state.npz"), os.path.join(folder, "section.bin")
+
+
+def save_checkpoint(level, state, chunks, section_size):
+    """Saves a snapshot of the chaos study to folder checkpoints.
+
+    Points of the Poincare section are only appended to their file, the state is written to a new file that then
+    replaces the old one. The state keeps the size of the section file it goes with, so if saving is interrupted,
+    the previous snapshot stays whole. A new section file is only started after a state that needs none of the old
+    one has replaced the previous state. Numbers are little-endian, so snapshots can be moved to another machine.
+
+    :param state: dictionary of arrays and numbers, as made by ChaosStudy.checkpoint_state.
+    :param chunks: list of tuples (balls, length, angles) of the section that are not in the file yet.
+    :param section_size: size of the section file in bytes with the previous chunks, 0 to start a new file.
+    :return: new size of the section file.
+    """
+    state_path, section_path = checkpoint_paths(level)
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+
+    def write_state(size):
+        with open(state_path + ".tmp", "wb") as f:
+            np.savez(f, section_size=size, **state)
+        os.replace(state_path + ".tmp", state_path)
+
+    if not section_size:
+        write_state(0)
+    with open(section_path, "r+b" if section_size else "wb") as f:
+        f.seek(section_size)
+        f.truncate()
+        for balls, length, angles in chunks:
+            f.write(struct.pack("<I", len(balls)))
+            f.write(np.asarray(balls, dtype="<i8").tobytes())
+            f.write(np.asarray(length, dtype="<f8").tobytes())
+            f.write(np.asarray(angles, dtype="<f8").tobytes())
+        section_size = f.tell()
+    write_state(section_size)
+    return section_size
+
+
+def read_checkpoint(level):
+    """
+    :return: tuple (state, chunks, section_size) with the last snapshot of the chaos study of the level saved by
+        save_checkpoint, None if there is no snapshot. If the section file is lost or cut, the section is empty.
+    """
+    state_path, section_path = checkpoint_paths(level)
+    if not os.path.exists(state_path):
+        return None
+    with np.load(state_path) as f:
+        state = {name: f[name] for name in f.files}
+    section_size = int(state.pop("section_size"))
+    if not os.path.exists(section_path):
+        return state, [], 0
+    with open(section_path, "rb") as f:
+        raw = f.read(section_size)
+    if len(raw) < section_size:
+        return state, [], 0
+    chunks = []
+    offset = 0
+    while offset < len(raw):
+        n, = struct.unpack_from("<I", raw, offset)
+        offset += 4
+        balls = np.frombuffer(raw, dtype="<i8", count=n, offset=offset).astype(int)
+        length = np.frombuffer(raw, dtype="<f8", count=n, offset=offset + 8 * n).astype(float)
+        angles = np.frombuffer(raw, dtype="<f8", count=n, offset=offset + 16 * n).astype(float)
+        offset += 24 * n
+        chunks.append((balls, length, angles))
+    return state, chunks, section_size
 
 
 def read_info(fname):
@@ -152,3 +300,64 @@ def read_info(fname):
             line = line.replace("\n", "")
             text = text + line
     return text
+
+
+def golden_path(level):
+    """
+    :return: path of the file with reference runs of the level.
+    """
+    return os.path.join("golden", f"level_{level}.npz")
+
+
+def save_golden(level, arrays):
+    """Saves reference runs of the level to folder golden.
+
+    :param arrays: dictionary of arrays, as made by golden.Run.arrays.
+    """
+    path = golden_path(level)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(path + ".tmp", path)
+
+
+def read_golden(level):
+    """
+    :return: dictionary of arrays saved by save_golden, None if there is none.
+    """
+    path = golden_path(level)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
+
+
+def landscape_path(level, field):
+    """
+    :return: path of the file with the shot outcome landscape of the level for the magnetic field.
+    """
+    return os.path.join("landscapes", f"level_{level}_field_{field:g}.npz")
+
+
+def save_landscape(level, field, arrays):
+    """Saves a shot outcome landscape to folder landscapes.
+
+    :param arrays: dictionary of arrays and numbers, as made by Landscape.arrays.
+    """
+    path = landscape_path(level, field)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(path + ".tmp", path)
+
+
+def read_landscape(level, field):
+    """
+    :return: dictionary of arrays saved by save_landscape, None if there is none or the level has been changed since.
+    """
+    path = landscape_path(level, field)
+    if not os.path.exists(path) or \
+            os.path.getmtime(path) < os.path.getmtime(os.path.join("levels", "level_" + str(level) + ".txt")):
+        return None
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files}
@@ -0,0 +1,268 @@
+import numpy as np
+import pygame
+
+
+class VertexBuffer:
+    """Vertices of a polygon kept in an array that grows by doubling, so adding a vertex doesn't copy the whole
+    polygon.
+
+    Attributes:
+        data: array of shape (capacity, 2), first count rows of which are vertices.
+        count: number of vertices.
+    """
+    def __init__(self, vertices=(), capacity=16):
+        vertices = np.array(vertices, dtype=int).reshape(-1, 2)
+        self.data = np.zeros((max(capacity, len(vertices)), 2), dtype=int)
+        self.data[:len(vertices)] = vertices
+        self.count = len(vertices)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def vertices(self):
+        return self.data[:self.count]
+
+    def insert(self, index, vertex):
+        if self.count == len(self.data):
+            data = np.zeros((2 * len(self.data), 2), dtype=int)
+            data[:self.count] = self.data[:self.count]
+            self.data = data
+        self.data[index + 1:self.count + 1] = self.data[index:self.count].copy()
+        self.data[index] = vertex
+        self.count += 1
+
+    def delete(self, index):
+        """
+        :return: deleted vertex.
+        """
+        vertex = tuple(self.data[index])
+        self.data[index:self.count - 1] = self.data[index + 1:self.count].copy()
+        self.count -= 1
+        return vertex
+
+    def move(self, index, vertex):
+        """
+        :return: previous position of the vertex.
+        """
+        old = tuple(self.data[index])
+        self.data[index] = vertex
+        return old
+
+    def rect(self):
+        """
+        :return: rectangle, containing the polygon, None if there are no vertices.
+        """
+        if self.count == 0:
+            return None
+        low, high = self.vertices.min(axis=0), self.vertices.max(axis=0)
+        return pygame.Rect(int(low[0]), int(low[1]), int(high[0] - low[0]) + 1, int(high[1] - low[1]) + 1)
+
+
+class Layout:
+    """Polygons of a level that is being constructed, all drawn on one image. When a polygon changes, only the region
+    it covered before and after the change is drawn again.
+
+    Attributes:
+        polygons: list of VertexBuffer objects. The first one is edge of the table, others are obstacles.
+        finished: number of polygons that are finished. The polygon after them is being drawn.
+        image: transparent surface with all polygons.
+        edge_color, fill_color, border_color (pygame.Color): colors of the edge of the table, of obstacles and of
+            borders of polygons, the same as objects.Obstacle uses.
+    """
+    def __init__(self, size):
+        self.polygons = []
+        self.finished = 0
+        self.image = pygame.Surface(size, pygame.SRCALPHA)
+        self.edge_color = pygame.Color("#0060ff")
+        self.fill_color = pygame.Color("white")
+        self.border_color = pygame.Color("#fa0041")
+
+    def add_polygon(self, polygon=None):
+        self.polygons.append(VertexBuffer() if polygon is None else polygon)
+        self.redraw(self.polygons[-1].rect())
+
+    def remove_polygon(self):
+        """Removes the last polygon.
+
+        :return: removed VertexBuffer.
+        """
+        polygon = self.polygons.pop()
+        self.redraw(polygon.rect())
+        return polygon
+
+    def insert(self, number, index, vertex):
+        self.change(number, lambda polygon: polygon.insert(index, vertex))
+
+    def delete(self, number, index):
+        return self.change(number, lambda polygon: polygon.delete(index))
+
+    def move(self, number, index, vertex):
+        return self.change(number, lambda polygon: polygon.move(index, vertex))
+
+    def change(self, number, edit):
+        """Changes polygon number `number` by calling edit with it and redraws what the polygon covered before and
+        after the change.
+
+        :return: what edit returns.
+        """
+        polygon = self.polygons[number]
+        before = polygon.rect()
+        result = edit(polygon)
+        after = polygon.rect()
+        if before is None:
+            self.redraw(after)
+        elif after is None:
+            self.redraw(before)
+        else:
+            self.redraw(before.union(after))
+        return result
+
+    def redraw(self, rect):
+        """Clears the region of the image and draws in it the polygons that cross it."""
+        if rect is None:
+            return
+        rect = rect.inflate(4, 4).clip(self.image.get_rect())
+        self.image.fill((0, 0, 0, 0), rect)
+        self.image.set_clip(rect)
+        for i, polygon in enumerate(self.polygons):
+            polygon_rect = polygon.rect()
+            if polygon_rect is None or not polygon_rect.inflate(2, 2).colliderect(rect):
+                continue
+            vertices = polygon.vertices.tolist()
+            if len(vertices) >= 3:
+                pygame.draw.polygon(self.image, self.fill_color if i else self.edge_color, vertices, 0)
+                pygame.draw.polygon(self.image, self.border_color, vertices, 1)
+            elif len(vertices) == 2:
+                pygame.draw.line(self.image, self.border_color, vertices[0], vertices[1], 1)
+        self.image.set_clip(None)
+
+    def vertex_at(self, pos, max_distance=6):
+        """
+        :return: tuple (number of polygon, number of vertex) of the vertex closest to pos, None if there is no vertex
+            closer than max_distance.
+        """
+        best, best_distance = None, max_distance ** 2
+        for number, polygon in enumerate(self.polygons):
+            if len(polygon) == 0:
+                continue
+            distance = ((polygon.vertices - pos) ** 2).sum(axis=1)
+            index = int(distance.argmin())
+            if distance[index] <= best_distance:
+                best, best_distance = (number, index), distance[index]
+        return best
+
+
+class AddVertex:
+    """Adds a vertex to the end of a polygon. If the polygon doesn't exist yet, it is created."""
+    def __init__(self, number, vertex):
+        self.number = number
+        self.vertex = vertex
+        self.created = False
+
+    def do(self, layout):
+        self.created = self.number == len(layout.polygons)
+        if self.created:
+            layout.add_polygon()
+        layout.insert(self.number, len(layout.polygons[self.number]), self.vertex)
+
+    def undo(self, layout):
+        layout.delete(self.number, len(layout.polygons[self.number]) - 1)
+        if self.created:
+            layout.remove_polygon()
+
+
+class DeleteVertex:
+    """Deletes a vertex of a polygon."""
+    def __init__(self, number, index):
+        self.number = number
+        self.index = index
+        self.vertex = None
+
+    def do(self, layout):
+        self.vertex = layout.delete(self.number, self.index)
+
+    def undo(self, layout):
+        layout.insert(self.number, self.index, self.vertex)
+
+
+class MoveVertex:
+    """Moves a vertex of a polygon."""
+    def __init__(self, number, index, old, new):
+        self.number = number
+        self.index = index
+        self.old = old
+        self.new = new
+
+    def do(self, layout):
+        layout.move(self.number, self.index, self.new)
+
+    def undo(self, layout):
+        layout.move(self.number, self.index, self.old)
+
+
+class RemovePolygon:
+    """Removes the last polygon."""
+    def __init__(self):
+        self.polygon = None
+
+    def do(self, layout):
+        self.polygon = layout.remove_polygon()
+
+    def undo(self, layout):
+        layout.add_polygon(self.polygon)
+
+
+class FinishPolygon:
+    """Finishes drawing of the current polygon."""
+    def do(self, layout):
+        layout.finished += 1
+
+    def undo(self, layout):
+        layout.finished -= 1
+
+
+class History:
+    """Log of edits that can be undone and redone.
+
+    Attributes:
+        layout: Layout object that is edited.
+        done: list of commands that were done, the last one first to undo.
+        undone: list of commands that were undone, the last one first to redo.
+    """
+    def __init__(self, layout):
+        self.layout = layout
+        self.done = []
+        self.undone = []
+
+    def do(self, command):
+        command.do(self.layout)
+        self.done.append(command)
+        self.undone = []
+
+    def record(self, command):
+        """Adds a command that has already been applied, e.g. vertex that was dragged."""
+        self.done.append(command)
+        self.undone = []
+
+    def undo(self):
+        """
+        :return: undone command, None if there is nothing to undo.
+        """
+        if not self.done:
+            return None
+        command = self.done.pop()
+        command.undo(self.layout)
+        self.undone.append(command)
+        return command
+
+    def redo(self):
+        """
+        :return: redone command, None if there is nothing to redo.
+        """
+        if not self.undone:
+            return None
+        command = self.undone.pop()
+        command.do(self.layout)
+        self.done.append(command)
+        return command
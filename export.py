@@ -0,0 +1,235 @@
+import argparse
+import math
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+# frames may be written to standard output, pygame mustn't greet there
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import pygame
+
+import data
+import game
+import objects
+import solver
+from constants import DT, FPS, WINDOW_SIZE
+
+QUEUE_SIZE = 32  # frames that wait to be written, drawing stops while the queue is full
+
+
+def encode_png(frames, folder, size):
+    """Runs in a worker process: takes frames from the queue and saves them as PNG files until it gets None."""
+    while True:
+        item = frames.get()
+        if item is None:
+            break
+        number, raw = item
+        pygame.image.save(pygame.image.fromstring(raw, size, "RGB"), os.path.join(folder, f"frame_{number:06d}.png"))
+
+
+class PngWriter:
+    """Saves frames as numbered PNG files in several processes. Frames get to them through a bounded queue, so
+    drawing waits for encoding instead of filling the memory.
+
+    Attributes:
+        folder: folder for the files.
+        size: size of the frames.
+        frames: queue of tuples (number, bytes of RGB pixels).
+        processes: list of worker processes.
+        count: number of frames written.
+        blocked: time in seconds drawing has waited for the queue.
+    """
+    def __init__(self, folder, size, processes=None, queue_size=QUEUE_SIZE):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.size = size
+        # processes are spawned, not forked, so that they don't inherit the display
+        context = multiprocessing.get_context("spawn")
+        self.frames = context.Queue(queue_size)
+        self.processes = [context.Process(target=encode_png, args=(self.frames, folder, size), daemon=True)
+                          for _ in range(processes or os.cpu_count() or 1)]
+        for process in self.processes:
+            process.start()
+        self.count = 0
+        self.blocked = 0.0
+
+    def write(self, surface):
+        start = time.perf_counter()
+        self.frames.put((self.count, pygame.image.tostring(surface, "RGB")))
+        self.blocked += time.perf_counter() - start
+        self.count += 1
+
+    def close(self):
+        """Waits until all frames are saved."""
+        for _ in self.processes:
+            self.frames.put(None)
+        for process in self.processes:
+            process.join()
+
+
+class RawWriter:
+    """Writes frames one after another as RGB24 pixels to a file or to standard output, to be piped to a video
+    encoder. Frames are written in a thread and get to it through a bounded queue.
+
+    Attributes:
+        output: binary file.
+        frames: queue of bytes of frames.
+        thread: thread that writes frames.
+        count: number of frames written.
+        blocked: time in seconds drawing has waited for the queue.
+    """
+    def __init__(self, path, queue_size=QUEUE_SIZE):
+        self.output = sys.stdout.buffer if path == "-" else open(path, "wb")
+        self.frames = queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.count = 0
+        self.blocked = 0.0
+
+    def run(self):
+        while True:
+            raw = self.frames.get()
+            if raw is None:
+                break
+            self.output.write(raw)
+
+    def write(self, surface):
+        start = time.perf_counter()
+        self.frames.put(pygame.image.tostring(surface, "RGB"))
+        self.blocked += time.perf_counter() - start
+        self.count += 1
+
+    def close(self):
+        """Waits until all frames are written."""
+        self.frames.put(None)
+        self.thread.join()
+        self.output.flush()
+        if self.output is not sys.stdout.buffer:
+            self.output.close()
+
+
+def game_frames(level, angle, power, field, ticks_per_frame=1, hold=FPS, max_frames=100000):
+    """Plays a shot in Game as it goes in the game and draws it.
+
+    :param angle, power, field: cue angle, cue value and magnetic field of the shot.
+    :param ticks_per_frame: number of time steps between frames.
+    :param hold: number of frames that are drawn after the ball has stopped or got into the pocket.
+    :return: generator of surfaces with frames. Surfaces are reused, so a frame has to be written before the next one
+        is taken.
+    """
+    play = game.Game(level, save=False)
+    play.B.value = field
+    play.ball.vel = solver.shot_velocity(angle, power)
+    for _ in range(max_frames):
+        for _ in range(ticks_per_frame):
+            if play.win or play.is_still():
+                break
+            play.step(DT)
+        play.draw_on_field()
+        yield play.field
+        if play.win or play.is_still():
+            break
+    for _ in range(hold):
+        yield play.field
+
+
+def chaos_frames(level, pos, angle, power, field, balls=1000, d_coord=1.0, d_angle=np.pi / 400, interacting=False,
+                 density=False, ticks_per_frame=1, frames=600):
+    """Runs a chaos study of the level as ChaosStudy goes when player starts it and draws it.
+
+    :param pos: position around which balls are placed.
+    :param angle, power, field: cue angle, cue value and magnetic field of the shot.
+    :param balls, d_coord, d_angle: number of balls and spreads of their positions and velocities, as sliders set them.
+    :param density: if True, the density map of trajectories is drawn.
+    :return: generator of surfaces with frames, see game_frames.
+    """
+    study = game.ChaosStudy(level)
+    study.checkpoint_every = math.inf  # exports don't touch saved studies
+    study.interacting = interacting
+    study.B.value = field
+    study.update_variables([d_coord, d_angle, balls])
+    if not study.make_balls(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=pos, button=1)):
+        raise ValueError(f"balls can't be placed at {pos}")
+    study.cue = objects.Cue(study.all_sprites, study.balls.pos[0], max_vel=solver.MAX_VEL)
+    study.set_vel(solver.shot_velocity(angle, power))
+    study.density_on = density
+    try:
+        for _ in range(frames):
+            for _ in range(ticks_per_frame):
+                study.update([], DT, [d_coord, d_angle, balls])
+            study.draw_on_field()
+            yield study.field
+    finally:
+        study.stop_workers()
+
+
+def export(frames, writer):
+    """Draws frames and passes them to the writer.
+
+    :return: tuple (count, seconds, blocked): number of frames, time of the export and time drawing waited for the
+        writer.
+    """
+    start = time.perf_counter()
+    try:
+        for surface in frames:
+            writer.write(surface)
+    finally:
+        writer.close()
+    return writer.count, time.perf_counter() - start, writer.blocked
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Draws a shot of a level or a chaos study without a window, faster "
+                                                 "than real time, and saves the frames as PNG files or as a raw RGB24 "
+                                                 f"stream of {WINDOW_SIZE[0]}x{WINDOW_SIZE[1]} frames, for example "
+                                                 f"for 'ffmpeg -f rawvideo -pix_fmt rgb24 -s "
+                                                 f"{WINDOW_SIZE[0]}x{WINDOW_SIZE[1]} -r {FPS} -i - clip.mp4'.")
+    parser.add_argument("scene", choices=("game", "chaos"), help="what to draw")
+    parser.add_argument("level", type=int, help="level number")
+    parser.add_argument("--angle", type=float, default=0.0, help="cue angle in degrees")
+    parser.add_argument("--power", type=float, default=50.0, help="cue value from 0 to 100")
+    parser.add_argument("--field", type=float, default=0.05, help="magnetic field")
+    parser.add_argument("--pos", type=float, nargs=2, help="position of the balls in a chaos study, the ball of the "
+                                                           "level by default")
+    parser.add_argument("--balls", type=int, default=1000, help="number of balls in a chaos study")
+    parser.add_argument("--d-coord", type=float, default=1.0, help="spread of positions of balls in a chaos study")
+    parser.add_argument("--d-angle", type=float, default=np.pi / 400,
+                        help="spread of angles of velocities of balls in a chaos study")
+    parser.add_argument("--interacting", action="store_true", help="balls of a chaos study collide with each other")
+    parser.add_argument("--density", action="store_true", help="draw the density map in a chaos study")
+    parser.add_argument("--frames", type=int, default=10 * FPS, help="number of frames of a chaos study")
+    parser.add_argument("--ticks-per-frame", type=int, default=1, help="time steps between frames")
+    parser.add_argument("--png", metavar="FOLDER", help="save frames as PNG files to the folder")
+    parser.add_argument("--raw", metavar="PATH", help="write frames as a raw RGB24 stream to the file, - for standard "
+                                                      "output")
+    parser.add_argument("--processes", type=int, help="number of processes that encode PNG files, all cores by "
+                                                      "default")
+    args = parser.parse_args()
+    if (args.png is None) == (args.raw is None):
+        parser.error("either --png or --raw is needed")
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    writer = PngWriter(args.png, WINDOW_SIZE, args.processes) if args.png else RawWriter(args.raw)
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+    angle = np.radians(args.angle)
+    if args.scene == "game":
+        frames = game_frames(args.level, angle, args.power, args.field, args.ticks_per_frame)
+    else:
+        pos = args.pos or data.read_map(args.level)[0]
+        frames = chaos_frames(args.level, tuple(pos), angle, args.power, args.field, args.balls, args.d_coord,
+                              args.d_angle, args.interacting, args.density, args.ticks_per_frame, args.frames)
+    count, seconds, blocked = export(frames, writer)
+    print(f"{count} frames in {seconds:.1f} s, {count / seconds:.0f} frames per second, "
+          f"{blocked / seconds:.0%} of the time waiting for the writer", file=sys.stderr)
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
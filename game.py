@@ -1,9 +1,17 @@
+import threading
+import time
 import pygame
 import objects
+import collisions
 import data
+import editor
+import replay
+import preview
+import physics
+import parallel
+import profiler
 import numpy as np
-from main import WINDOW_SIZE, WINDOW_HEIGHT,  BG_COLOR
-import matplotlib.pyplot as plt
+from constants import WINDOW_SIZE, WINDOW_HEIGHT, BG_COLOR, DT
 
 
 class Game:
@@ -13,8 +21,12 @@ class Game:
         field: surface to which every game object is blitted.
         all_sprites: group that contains all game objects.
         level: level number.
+        save: shows if the picture of the level, high scores and replays are saved. Games that programs play don't save
+            anything.
 
         ball: object that represents a ball which player tries to put in the pocket.
+        others: ensemble of other balls of the level that the ball can knock, None if there are none. Other balls that
+            get into the pocket are removed.
         cue: object that represents cue using which player can hit a ball.
         pocket: object that represents a place where the player is supposed to put the ball.
         obstacles: array, containing objects that represent edges of the table and obstacles on the table.
@@ -27,16 +39,30 @@ class Game:
         first_hit: variable that shows if it's the first time player has hit the ball.
 
         map_data: contains data about the level.
+        field_map: magnetic field that changes across the table, None if the field is uniform.
+        field_image: picture of field_map that is drawn on the table.
+
+        tick: number of the current time step.
+        collisions: collisions.CollisionBus with collisions of balls, the ball player hits is number 0 in it and other
+            balls follow it. Score is reduced by subscribing to it.
+        seed: seed of numpy random generator used in the game.
+        recorder: object that records player's actions, so the game can be replayed.
+        preview: object that predicts and draws the path of the ball while player aims.
+
+        fast_forward: variable that shows if time is sped up while balls move.
+        warp: number of time steps in a frame when time is sped up.
     """
-    def __init__(self, level):
+    def __init__(self, level, save=True):
         self.field = pygame.Surface(WINDOW_SIZE)
         pygame.draw.rect(self.field, pygame.Color("white"), ((0, 0), WINDOW_SIZE))
 
         self.all_sprites = pygame.sprite.Group()
 
         self.level = level
+        self.save = save
 
         self.ball = None
+        self.others = None
         self.cue = None
         self.pocket = None
         self.obstacles = None
@@ -46,16 +72,29 @@ class Game:
         self.win = False
         self.score = 10
         self.first_hit = True
+        self.fast_forward = False
+        self.warp = 16
 
         self.map_data = data.read_map(level)
+        self.field_map = self.map_data[4]
+        self.field_image = None
         self.make_map(level)
 
+        self.tick = 0
+        self.collisions = collisions.CollisionBus()
+        self.collisions.subscribe(self.count_collisions)
+        self.seed = np.random.randint(2 ** 31)
+        np.random.seed(self.seed)
+        self.recorder = replay.ShotRecorder(level, self.seed, DT, self.friction, self.ball.radius, self.pocket.radius)
+
     def make_map(self, level):
         """
         Creates all game objects. Then calls draw_on_field method to blit them to field. After that calls save_map
         function to save the map.
         """
         self.ball = objects.Ball(self.all_sprites, 10, self.map_data[0])
+        if self.map_data[5]:
+            self.others = objects.Ensemble(10, self.map_data[5], [pygame.Color("#ffcc00")], [0] * len(self.map_data[5]))
         self.cue = objects.Cue(self.all_sprites, self.ball.pos, max_vel=15)
         self.pocket = objects.Pocket(self.all_sprites, 10, self.map_data[1])
         # edges of the field
@@ -64,15 +103,24 @@ class Game:
         for i, obstacle in enumerate(self.map_data[3]):
             self.obstacles.append(objects.Obstacle(self.all_sprites, WINDOW_SIZE, self.map_data[3][i],
                                                    fill_color=pygame.Color("white")))
+        self.preview = preview.TrajectoryPreview(self.map_data, self.friction, DT,
+                                                 self.ball.radius, self.pocket.radius)
+        if self.field_map is not None:
+            self.field_image = objects.field_map_image(self.field_map, self.map_data[2], WINDOW_SIZE)
 
         self.draw_on_field()
-        data.save_map(self.field.subsurface(self.obstacles[0].polygon_rect), level)
+        if self.save:
+            data.save_map(self.field.subsurface(self.obstacles[0].polygon_rect), level)
 
     def draw_on_field(self):
         """Blits game objects to field."""
         self.field.fill(BG_COLOR)
         for i in range(len(self.obstacles)):
             self.field.blit(self.obstacles[i].image, (0, 0))
+            if i == 0 and self.field_image is not None:
+                self.field.blit(self.field_image, (0, 0))
+        if self.others is not None:
+            self.others.draw(self.field)
         if not self.win:
             self.field.blit(self.ball.image,
                             (self.ball.pos[0] - self.ball.radius,
@@ -82,9 +130,9 @@ class Game:
         self.field.blit(self.pocket.image,
                         (self.pocket.pos[0] - self.pocket.radius,
                          self.pocket.pos[1] - self.pocket.radius))
-        if self.ball.vel_value() < 0.01 and not self.win:
+        if self.ball.vel_value() == 0 and not self.win:
+            self.preview.draw(self.field)
             self.field.blit(self.cue.image, self.cue.rect)
-            self.ball.vel = np.zeros(2, dtype=float)
 
         if self.win:
             self.field.blit(win_screen(self.score), (0, 0))
@@ -92,7 +140,8 @@ class Game:
     def display_score(self):
         """Displays score."""
         font = pygame.font.Font(None, 30)
-        text = font.render(f"SCORE: {self.score}", 1, pygame.Color('black'))
+        warp = f"   >> x{self.warp}" if self.fast_forward else ""
+        text = font.render(f"SCORE: {self.score}{warp}", 1, pygame.Color('black'))
         text_x = 20
         text_y = 20
         text_w = text.get_width()
@@ -124,6 +173,7 @@ class Game:
                                 self.reduce_score(2)
 
                             self.ball.vel = self.cue.get_vel()
+                            self.recorder.shot(self.tick, self.ball.vel)
                         if self.B.rect.collidepoint(event.pos):
                             if btn == 4:  # mousewheel up
                                 self.B.change_value(1)
@@ -140,24 +190,123 @@ class Game:
                             self.B.change_value(1)
                         if btn == 5:  # mousewheel down
                             self.B.change_value(-1)
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_f:
+                self.fast_forward = not self.fast_forward
+
+        self.recorder.field(self.tick, self.B.value)
 
         self.cue.update(pygame.mouse.get_pos())
         self.cue.pos = self.ball.pos
+        profiler.frames.mark("events")
+        if self.ball.vel_value() == 0:
+            self.preview.update(self.ball.pos, self.cue.get_vel(), self.B.value)
+
+        self.step(dt)
+        if self.fast_forward:
+            ticks = 1
+            while ticks < self.warp and not self.win and not self.is_still():
+                ticks += self.skip(dt, self.warp - ticks)
+                if ticks < self.warp and not self.win and not self.is_still():
+                    self.step(dt)
+                    ticks += 1
+
+    def step(self, dt):
+        """Moves balls during one time step and checks what they have hit."""
+        b = self.B.value
+        if self.field_map is not None:
+            b *= self.field_map.sample(*self.ball.pos.tolist())
+        self.ball.update(b, self.friction, dt)
+        if self.others is not None:
+            self.others.update(self.B.value, self.friction, dt, self.field_map)
+        profiler.frames.mark("physics")
+        for number, obstacle in enumerate(self.obstacles):
+            obstacle.collide(self.ball, self.collisions, number)
+            if self.others is not None:
+                self.others.collide(obstacle.segment_array, self.collisions, number, first_ball=1)
+        if self.others is not None:
+            self.collide_balls()
+        profiler.frames.mark("collision")
+        self.collisions.publish(self.tick)
+
+        if self.pocket.check_win(self.ball.pos, self.ball.prev_pos):
+            self.ball.vel = np.zeros(2, dtype=float)
+            self.win = True
+            self.recorder.end(self.tick, self.score)
+            if self.save and data.write_score(self.level, self.score):
+                data.save_replay(self.level, self.recorder.to_bytes())
+        elif self.ball.vel_value() < physics.STOP_VEL:
+            self.ball.vel = np.zeros(2, dtype=float)
+        if self.others is not None:
+            self.others.keep(~self.pocket.check_win_many(self.others.pos, self.others.prev_pos))
+            self.others.vel[(self.others.vel ** 2).sum(axis=1) < physics.STOP_VEL ** 2] = 0
 
-        self.ball.update(self.B.value, self.friction, dt)
-        collided = False
+        self.tick += 1
+
+    def skip(self, dt, limit):
+        """Moves the ball through time steps in which it can't touch anything without checking collisions. The path of
+        the ball is found in closed form by physics.roll, the steps that are left before it comes close to an obstacle or
+        the pocket, or stops, are then made exactly as in step, so the game goes the same way as without skipping.
+
+        :param limit: maximum number of time steps to skip.
+        :return: number of skipped time steps.
+        """
+        if self.others is not None or self.field_map is not None or self.ball.vel_value() == 0:
+            return 0
+        x, y = self.ball.pos.tolist()
+        vx, vy = self.ball.vel.tolist()
+        b = self.B.value
+        pos, speed = physics.roll(x, y, vx, vy, b, self.friction, dt, limit)
+        margin = 1e-6  # much larger than the difference between roll and step
+        free = speed >= physics.STOP_VEL
         for obstacle in self.obstacles:
-            if obstacle.collide(self.ball)[0]:
-                collided = True
+            free &= physics.polygon_distance(pos, obstacle.segment_array) > self.ball.radius + margin
+        free &= physics.segment_distance_many(np.concatenate(([[x, y]], pos[:-1])), pos,
+                                              np.asarray(self.pocket.pos, dtype=float)) > self.pocket.radius + margin
+        count = limit if free.all() else int(free.argmin())
+        if count == 0:
+            return 0
+        for _ in range(count - 1):
+            x, y, vx, vy = physics.step(x, y, vx, vy, b, self.friction, dt)
+        self.ball.prev_pos = np.array([x, y])
+        self.ball.prev_vel = np.array([vx, vy])
+        x, y, vx, vy = physics.step(x, y, vx, vy, b, self.friction, dt)
+        self.ball.pos = np.array([x, y])
+        self.ball.vel = np.array([vx, vy])
+        self.ball.rect = self.ball.image.get_rect(center=self.ball.pos.astype(int))
+        self.tick += count
+        return count
+
+    def is_still(self):
+        """
+        :return: True if no ball moves and the ball isn't in the pocket.
+        """
+        return not self.win and self.ball.vel_value() == 0 and (self.others is None or not self.others.vel.any())
 
-        if collided:
+    def is_idle(self):
+        """
+        :return: True if the game is won or no ball moves and the preview of the shot is complete, so the game only
+            changes when player does something.
+        """
+        if self.win:
+            return True
+        return self.is_still() and (self.preview.current is None or self.preview.current.done)
+
+    def collide_balls(self):
+        """Calculates collisions between all balls."""
+        pos = np.concatenate((self.ball.pos[None], self.others.pos))
+        vel = np.concatenate((self.ball.vel[None], self.others.vel))
+        first, second, new_vel = physics.collide_balls(pos, vel, self.ball.radius)
+        if len(first) == 0:
+            return
+        self.collisions.emit_pairs(first, second, pos, vel, new_vel)
+        self.ball.vel = new_vel[0]
+        self.others.vel = new_vel[1:]
+
+    def count_collisions(self, events):
+        """Reduces score if the ball player hits collided with something during the time step."""
+        if (events["ball"] == 0).any():
             self.reduce_score(1)
 
-        if self.pocket.check_win(self.ball.pos):
-            self.ball.vel = np.zeros(2, dtype=float)
-            self.win = True
-            data.write_score(self.level, self.score)
-
 
 def win_screen(score):
     """Creates a surface which is blitted after the game was won."""
@@ -191,23 +340,30 @@ class Constructor:
 
         pocket: object that represents a place where the player is supposed to put the ball.
         ball: object that represents a ball which player tries to put in the pocket.
-        obstacles: array, containing objects that represent edges of the table and obstacles on the table.
+        layout: polygons of the level and their image. First polygon is edge of the table, others are obstacles.
+        obstacles: list of vertex buffers of the polygons, the same list as layout.polygons.
+        history: log of edits of the polygons that can be undone and redone.
+        dragged: tuple (number of polygon, number of vertex, position before dragging) for the vertex that is being
+            dragged, None if no vertex is dragged.
 
         stages: dictionary that contains names of the stages.
         stage: constructing a level consists of four stages:
             0) Drawing obstacles. First obstacle is edge of the table. Other obstacles are optional. Player picks points
-            by right clicking on the screen. To finish drawing an obstacle player needs to press "space".
+            by right clicking on the screen. To finish drawing an obstacle player needs to press "space". Vertices can
+            be dragged and deleted, edits can be undone with ctrl+z and redone with ctrl+y.
             1) Picking where the pocket is. To do it player is supposed to right click on the screen.
             2) Picking where the ball is. To do it player is supposed to right click on the screen.
             3) Saving the level. If player reached the stage, he can now go to menu where levels are selected and he'll
             see his level.
             Player can switch between stages using left and right arrow buttons.
 
-        obstacle_number: number of obstacle that is being drawn.
         line_pos: coordinates of two lines that connect mouse to first and last vertex of the obstacle that is being
             drawn.
 
         level: level number.
+        unsolvable: variable that shows if the solver has found no shot that puts the ball in the pocket.
+        check: thread in which the solver checks the level before it is saved, None if it isn't being checked.
+        solvable: result of the last check.
     """
     def __init__(self, level):
         self.all_sprites = pygame.sprite.Group()
@@ -217,74 +373,145 @@ class Constructor:
 
         self.pocket = None
         self.ball = None
-        self.obstacles = []
+        self.layout = editor.Layout(WINDOW_SIZE)
+        self.obstacles = self.layout.polygons
+        self.history = editor.History(self.layout)
+        self.dragged = None
         self.stages = {0: "obstacles", 1: "pocket", 2: "ball", 3: "done"}
         self.stage = 0
-        self.obstacle_number = 0
         self.line_pos = []
 
         self.level = level
+        self.unsolvable = False
+        self.check = None
+        self.solvable = False
 
     def update(self, events):
-        """Handles the events."""
+        """Handles the events. While the level is being checked, events are ignored and the result is waited for."""
+        if self.check is not None:
+            if not self.check.is_alive():
+                self.finish_check()
+            return
         for event in events:
             if event.type == pygame.MOUSEMOTION:
                 if self.stage == 0:
-                    if len(self.obstacles) > self.obstacle_number \
-                            and len(self.obstacles[self.obstacle_number].vertices) > 0:
-                        start_pos = [self.obstacles[self.obstacle_number].vertices[-1],
-                                     self.obstacles[self.obstacle_number].vertices[0]]
-                        self.line_pos = [[start_pos[0], event.pos], [start_pos[1], event.pos]]
+                    if self.dragged is not None:
+                        self.layout.move(self.dragged[0], self.dragged[1], event.pos)
+                    self.update_lines(event.pos)
             if event.type == pygame.MOUSEBUTTONDOWN:
                 if event.pos[1] < WINDOW_HEIGHT - 50 * 3 // 2:
                     if event.button == 1:
                         if self.stage == 0:
-                            if len(self.obstacles) <= self.obstacle_number:
-                                self.obstacles.append(objects.Obstacle(self.all_sprites, WINDOW_SIZE,
-                                                                       np.array(event.pos, ndmin=2)))
+                            vertex = self.layout.vertex_at(event.pos)
+                            if vertex is not None:
+                                self.dragged = vertex + (tuple(self.obstacles[vertex[0]].vertices[vertex[1]]),)
                             else:
-                                if self.obstacle_number:
-                                    fill_color = pygame.Color("white")
-                                else:
-                                    fill_color = pygame.Color("#0060ff")
-                                new_vertices = np.concatenate((self.obstacles[self.obstacle_number].vertices,
-                                                               np.array(event.pos, ndmin=2)),
-                                                              axis=0)
-                                self.obstacles[self.obstacle_number] = objects.Obstacle(self.all_sprites, WINDOW_SIZE,
-                                                                                        new_vertices,
-                                                                                        fill_color=fill_color)
+                                self.history.do(editor.AddVertex(self.layout.finished, event.pos))
+                            self.update_lines(event.pos)
                         elif self.stage == 1:
+                            if self.pocket is not None:
+                                self.pocket.kill()
                             self.pocket = objects.Pocket(self.all_sprites, 10, event.pos)
                         elif self.stage == 2:
+                            if self.ball is not None:
+                                self.ball.kill()
                             self.ball = objects.Ball(self.all_sprites, 10, event.pos)
+                            self.unsolvable = False
+                    elif event.button == 3 and self.stage == 0:
+                        vertex = self.layout.vertex_at(event.pos)
+                        # finished polygons have to keep at least three vertices
+                        if vertex is not None and (vertex[0] == self.layout.finished or
+                                                   len(self.obstacles[vertex[0]]) > 3):
+                            self.history.do(editor.DeleteVertex(*vertex))
+                            self.update_lines(event.pos)
+            elif event.type == pygame.MOUSEBUTTONUP:
+                if event.button == 1 and self.dragged is not None:
+                    number, index, old = self.dragged
+                    new = tuple(self.obstacles[number].vertices[index])
+                    if new != old:
+                        self.history.record(editor.MoveVertex(number, index, old, new))
+                    self.dragged = None
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_RIGHT:
                     if self.stage == 0 and len(self.obstacles) > 0 or \
                             self.stage == 1 and self.pocket is not None or\
                             self.stage == 2 and self.ball is not None:
                         self.stage += 1
+                        self.dragged = None
                 elif event.key == pygame.K_LEFT:
                     if self.stage >= 1:
                         self.stage -= 1
                 elif event.key == pygame.K_SPACE:
-                    if self.stage == 0 and len(self.obstacles) > self.obstacle_number:
-                        if len(self.obstacles[self.obstacle_number].vertices) > 2:  # if obstacle is at least a line
-                            self.obstacle_number += 1
+                    if self.stage == 0 and len(self.obstacles) > self.layout.finished:
+                        if len(self.obstacles[self.layout.finished]) > 2:  # if obstacle is at least a line
+                            self.history.do(editor.FinishPolygon())
                             self.line_pos = []
                         else:
-                            self.obstacles.pop()
+                            self.history.do(editor.RemovePolygon())
+                elif event.key in (pygame.K_z, pygame.K_y) and event.mod & pygame.KMOD_CTRL:
+                    if self.stage == 0 and self.dragged is None:
+                        if event.key == pygame.K_z and not event.mod & pygame.KMOD_SHIFT:
+                            self.history.undo()
+                        else:
+                            self.history.redo()
+                        self.update_lines(pygame.mouse.get_pos())
 
         if self.stage == 3:
+            self.start_check()
+
+    def start_check(self):
+        """Starts checking if the level can be solved. The solver takes seconds, so it runs in a thread and the
+        window keeps being drawn."""
+        import solver  # multiprocessing is loaded only when a level is saved
+
+        def run(map_data):
+            self.solvable = solver.is_solvable(map_data)
+
+        self.solvable = False
+        self.check = threading.Thread(target=run, args=(self.map_data(),), daemon=True)
+        self.check.start()
+
+    def finish_check(self):
+        """Saves the level if the check has found a shot that solves it, otherwise goes back to placing the ball."""
+        self.check = None
+        if self.solvable:
             data.save_level_data(self)
-            data.save_map(self.field.subsurface(self.obstacles[0].polygon_rect), self.level)
+            data.save_map(self.field.subsurface(self.obstacles[0].rect()), self.level)
             data.make_level_button_theme(self.level)
+        else:
+            self.stage = 2
+            self.unsolvable = True
+
+    def is_idle(self):
+        """
+        :return: False while the level is being checked, so that the result is picked up without waiting for events.
+        """
+        return self.check is None
+
+    def update_lines(self, mouse_pos):
+        """Connects the mouse to the first and the last vertex of the obstacle that is being drawn."""
+        if len(self.obstacles) > self.layout.finished and len(self.obstacles[self.layout.finished]) > 0:
+            vertices = self.obstacles[self.layout.finished].vertices
+            self.line_pos = [[vertices[-1], mouse_pos], [vertices[0], mouse_pos]]
+        else:
+            self.line_pos = []
+
+    def map_data(self):
+        """
+
+        :return: data about the level in the same format as data.read_map returns.
+        """
+        return [[int(self.ball.pos[0]), int(self.ball.pos[1])],
+                [int(self.pocket.pos[0]), int(self.pocket.pos[1])],
+                self.obstacles[0].vertices.astype(int).tolist(),
+                [obstacle.vertices.astype(int).tolist() for obstacle in self.obstacles[1:]],
+                None,
+                []]
 
     def draw(self):
         """Draws everything that was created so far on the map."""
         self.field.fill(BG_COLOR)
-        if len(self.obstacles) >= 0:
-            for i in range(len(self.obstacles)):
-                self.field.blit(self.obstacles[i].image, (0, 0))
+        self.field.blit(self.layout.image, (0, 0))
         if self.stage == 0 and len(self.line_pos) > 0:
             pygame.draw.line(self.field, pygame.Color("#fa0041"), self.line_pos[0][0], self.line_pos[0][1], 1)
             pygame.draw.line(self.field, pygame.Color("#fa0041"), self.line_pos[1][0], self.line_pos[1][1], 1)
@@ -297,7 +524,12 @@ class Constructor:
     def display_stage(self):
         """Displays the stage of construction."""
         font = pygame.font.Font(None, 30)
-        text = font.render(f"Stage: {self.stages[self.stage]}", 1, pygame.Color('black'))
+        stage = self.stages[self.stage]
+        if self.check is not None:
+            stage += " (checking that a shot puts the ball in the pocket...)"
+        elif self.unsolvable:
+            stage += " (no shot puts the ball in the pocket)"
+        text = font.render(f"Stage: {stage}", 1, pygame.Color('black'))
         text_x = 20
         text_y = 20
         text_w = text.get_width()
@@ -327,7 +559,11 @@ class ChaosStudy:
         ball_number: number of balls being simulated
         level: level number.
 
-        balls: array of objects that represent balls.
+        balls: ensemble of balls, None until player has picked a place for them.
+        colors: colors that balls can have. They are limited so that balls share images.
+        point_cloud_from: number of balls from which they are drawn as points instead of images.
+        density: map of density of trajectories of the balls.
+        density_on: variable that shows if the density map is drawn.
         cue: object that represents cue using which player can hit a ball.
         obstacles: array, containing objects that represent edges of the table and obstacles on the table.
         B: object that represents magnetic field arrow. Magnetic field is perpendicular to the table.
@@ -335,16 +571,37 @@ class ChaosStudy:
         friction: friction coefficient between the ball and the table.
 
         map_data: contains data about the level.
+        field_map: magnetic field that changes across the table, None if the field is uniform.
+        field_image: picture of field_map that is drawn on the table.
 
         d_angle: twice the maximum angle between the velocity player has chosen and a ball's velocity.
         d_coord: twice the maximum difference of a coordinate between the position player has chosen and a ball's
             position.
 
         plot_on: variable that shows if Poincare section is on the screen.
-        length: array of distance coordinates in the border coordinate system.
-        angles: array of angle coordinates in the border coordinate system.
+        vertex_coords: distance coordinates of the vertices of the edge in the border coordinate system.
+        section: list of tuples (balls, length, angles) of arrays with numbers of balls and their distance and angle
+            coordinates in the border coordinate system, one tuple for each moment of time when balls hit the edge.
+        interacting: variable that shows if balls collide with each other.
+        tick: number of time steps balls have moved.
+        collisions: collisions.CollisionBus with collisions of balls. Poincare section is recorded by subscribing to
+            it.
+
+        processes: number of processes that move balls if there are many of them.
+        parallel_from: number of balls from which they are moved in several processes. Interacting balls are always
+            moved in this one.
+        workers: parallel.EnsembleWorkers that move the balls, None if they are moved in this process.
+
+        checkpoint_every: time in seconds between snapshots of the study, which are saved while balls move.
+        last_checkpoint: time when the last snapshot was taken.
+        writer: thread that saves the last snapshot.
+        section_saved: number of items of section that are saved.
+        section_size: size of the saved section file in bytes.
     """
-    def __init__(self, level):
+    def __init__(self, level, resume=False):
+        """
+        :param resume: if True, the study continues from the last saved snapshot of the level, if there is one.
+        """
         self.field = pygame.Surface(WINDOW_SIZE)
         pygame.draw.rect(self.field, pygame.Color("white"), ((0, 0), WINDOW_SIZE))
 
@@ -355,21 +612,44 @@ class ChaosStudy:
 
         self.ball_number = 10
 
-        self.balls = []
+        self.balls = None
+        self.colors = objects.palette(64)
+        self.point_cloud_from = 1000
+        self.density = objects.DensityMap(WINDOW_SIZE)
+        self.density_on = False
         self.cue = None
         self.obstacles = None
         self.B = objects.MagneticField(0.05)
         self.friction = 0.0
 
         self.map_data = data.read_map(level)
+        self.field_map = self.map_data[4]
+        self.field_image = None
         self.make_map()
 
         self.d_angle = np.pi / 400
         self.d_coord = 1
 
         self.plot_on = False
-        self.length = []
-        self.angles = []
+        self.section = []
+        self.interacting = False
+        self.tick = 0
+        self.collisions = collisions.CollisionBus()
+        self.collisions.subscribe(self.record_section)
+
+        self.processes = parallel.default_processes()
+        # a step of workers costs about 0.4 ms more than in this process whatever the number of balls, which is as
+        # much as moving 2500 balls takes in half the time, see chaos_step and chaos_step_parallel benchmarks
+        self.parallel_from = 5000
+        self.workers = None
+
+        self.checkpoint_every = 30
+        self.last_checkpoint = time.perf_counter()
+        self.writer = None
+        self.section_saved = 0
+        self.section_size = 0
+        if resume:
+            self.resume()
 
     def make_map(self):
         """Makes a map of the level."""
@@ -379,6 +659,10 @@ class ChaosStudy:
         for i, obstacle in enumerate(self.map_data[3]):
             self.obstacles.append(objects.Obstacle(self.all_sprites, WINDOW_SIZE, self.map_data[3][i],
                                                    fill_color=pygame.Color("white")))
+        sides = np.linalg.norm(np.diff(self.obstacles[0].vertices, axis=0), axis=1)
+        self.vertex_coords = np.concatenate(([0], np.cumsum(sides)))
+        if self.field_map is not None:
+            self.field_image = objects.field_map_image(self.field_map, self.map_data[2], WINDOW_SIZE)
 
         self.draw_on_field()
 
@@ -387,13 +671,18 @@ class ChaosStudy:
         self.field.fill(BG_COLOR)
         for i in range(len(self.obstacles)):
             self.field.blit(self.obstacles[i].image, (0, 0))
+            if i == 0 and self.field_image is not None:
+                self.field.blit(self.field_image, (0, 0))
         self.field.blit(self.B.image, self.B.rect)
-        for ball in self.balls:
-            self.field.blit(ball.image,
-                            (ball.pos[0] - ball.radius,
-                             ball.pos[1] - ball.radius))
-        if len(self.balls) >= 1 and self.balls[0].vel_value() == 0:
-            self.field.blit(self.cue.image, self.cue.rect)
+        if self.density_on:
+            self.density.draw(self.field)
+        if self.balls is not None:
+            if len(self.balls) >= self.point_cloud_from:
+                self.balls.draw_points(self.field)
+            else:
+                self.balls.draw(self.field)
+            if self.balls.vel_value() == 0:
+                self.field.blit(self.cue.image, self.cue.rect)
 
     def update(self, events, dt, variables):
         """Handles events and updates balls"""
@@ -401,17 +690,17 @@ class ChaosStudy:
             if event.type == pygame.MOUSEBUTTONDOWN:
                 if event.pos[1] < WINDOW_HEIGHT - 50 * 3 // 2:
                     btn = event.button
-                    if len(self.balls) == 0:
+                    if self.balls is None:
                         if btn == 1:
                             self.update_variables(variables)
-                            self.make_balls(event)
-                            self.cue = objects.Cue(self.all_sprites, self.balls[0].pos, max_vel=15)
+                            if self.make_balls(event):
+                                self.cue = objects.Cue(self.all_sprites, self.balls.pos[0], max_vel=15)
                         if self.B.rect.collidepoint(event.pos):
                             if btn == 4:  # mousewheel up
                                 self.B.change_value(1)
                             if btn == 5:  # mousewheel down
                                 self.B.change_value(-1)
-                    elif self.balls[0].vel_value() == 0:
+                    elif self.balls.vel_value() == 0:
                         if btn == 1:  # rightclick
                             self.update_variables(variables)
                             self.set_vel(self.cue.get_vel())
@@ -421,88 +710,293 @@ class ChaosStudy:
                             if btn == 5:  # mousewheel down
                                 self.B.change_value(-1)
                         else:
-                            if self.balls[0].vel_value() == 0:
+                            if self.balls.vel_value() == 0:
                                 if btn == 4:  # mousewheel up
                                     self.cue.change_value(5)
                                 if btn == 5:  # mousewheel down
                                     self.cue.change_value(-5)
             elif event.type == pygame.KEYDOWN:
-                if self.balls[0].vel_value() == 0 and event.key == pygame.K_LEFT:
-                    self.balls = []
+                if self.balls is not None and self.balls.vel_value() == 0 and event.key == pygame.K_LEFT:
+                    self.stop_workers()
+                    self.balls = None
                     self.cue = None
                 elif event.key == pygame.K_SPACE:
                     if self.stop:
                         self.plot_on = False
                     self.stop = not self.stop
+                elif event.key == pygame.K_h:
+                    self.density_on = not self.density_on
+                    self.density.clear()
+                elif event.key == pygame.K_g and self.balls is None:
+                    self.interacting = not self.interacting
 
         if self.cue is not None:
             self.cue.update(pygame.mouse.get_pos())
-            self.cue.pos = self.balls[0].pos
+            self.cue.pos = self.balls.pos[0]
 
+        profiler.frames.mark("events")
         if not self.stop:
-            for ball in self.balls:
-                if np.linalg.norm(ball.vel) > 0:
-                    ball.update(self.B.value, self.friction, dt)
-            # cycles that check for collisions and put points on Poincare section
-            for i, ball in enumerate(self.balls):
-                if np.linalg.norm(ball.vel) > 0:
-                    for obstacle in self.obstacles:
-                        ball_data = obstacle.collide(ball)
-                        if obstacle == self.obstacles[0] and ball_data[0]:
-                            # put a point on the section
-                            length = self.boundary_coords(ball_data[1], ball_data[2])
-                            angle = np.dot(ball.vel/np.linalg.norm(ball.vel), obstacle.tangent[ball_data[2]])
-                            self.length[i].append(length)
-                            self.angles[i].append(angle)
+            left = dt
+            while left > 0:
+                # collisions of interacting balls change their speeds, so the rest of the step is split again
+                part = left / self.substeps(left)
+                left -= part
+                if self.workers is not None and self.step_workers(part):
+                    profiler.frames.mark("physics")
+                    # workers collide balls as well, points are put on Poincare section by record_section
+                    self.collisions.emit_many(*self.workers.hits())
+                elif self.balls is not None:
+                    self.balls.update(self.B.value, self.friction, part, self.field_map)
+                    profiler.frames.mark("physics")
+                    # check for collisions, points are put on Poincare section by record_section
+                    for number, obstacle in enumerate(self.obstacles):
+                        self.balls.collide(obstacle.segment_array, self.collisions, number)
+                    if self.interacting:
+                        self.balls.collide_balls(self.collisions)
+                profiler.frames.mark("collision")
+            if self.balls is not None:
+                self.collisions.publish(self.tick)
+                self.tick += 1
+                if self.density_on:
+                    self.density.add(self.balls.pos)
+            profiler.frames.mark("collision")
+            if self.balls is not None and time.perf_counter() - self.last_checkpoint > self.checkpoint_every:
+                self.save_checkpoint()
         elif not self.plot_on:
             self.draw_section()
 
+    def is_idle(self):
+        """
+        :return: True if balls don't move and no snapshot is being saved, so the study only changes when player does
+            something.
+        """
+        if self.writer is not None and self.writer.is_alive():
+            return False
+        return self.balls is None or self.stop or not self.balls.vel.any()
+
+    def substeps(self, dt):
+        """Interacting balls pass speed to each other, and a ball that moves as far as its radius in one step may
+        jump over the edge of the table. For them the time step is split into parts in which no ball moves further
+        than half of its radius.
+
+        :return: number of parts of the time step.
+        """
+        if self.balls is None or not self.interacting or len(self.balls) == 0:
+            return 1
+        speed = np.sqrt((self.balls.vel ** 2).sum(axis=1)).max()
+        return max(int(np.ceil(2 * speed * dt / self.balls.radius)), 1)
+
+    def record_section(self, events):
+        """Puts points on the section for collisions with the edge of the table."""
+        edge = events[events["obstacle"] == 0]
+        if len(edge):
+            self.add_to_section(edge["ball"], edge["point"], edge["vertex"], edge["vel_out"])
+
+    def add_to_section(self, balls, point, vertex_num, vel):
+        """Puts points on the section for balls that have hit the edge of the table with velocities vel."""
+        length, angles = physics.section_coords(self.obstacles[0].vertices, point, vertex_num, vel)
+        self.section.append((balls, length, angles))
+
     def make_balls(self, event):
-        """Creates balls."""
-        ball_coords = [np.array(event.pos)]
-        self.balls.append(objects.Ball(self.all_sprites, 10, ball_coords[0]))
-        self.length.append([])
-        self.angles.append([])
-        for i in range(self.ball_number * 10):
-            if len(self.balls) < self.ball_number:
-                color = pygame.Color(np.random.randint(0, 255), np.random.randint(0, 255), np.random.randint(0, 255))
-                coords = ball_coords[0] + self.d_coord * (np.random.rand(2) - 0.5 * np.ones(2))
-                new_ball = objects.Ball(self.all_sprites, 10, coords, color=color)
-                collide = False
-                for obstacle in self.obstacles:
-                    if obstacle.collide(new_ball)[0]:
-                        collide = True
-                        break
-                if not collide:
-                    self.balls.append(new_ball)
-                    self.length.append([])
-                    self.angles.append([])
-            else:
+        """Creates balls. Their positions are sampled around the place player has picked, all at once, until there are
+        exactly ball_number positions that are inside the table and don't touch its edge and obstacles. If the picked
+        place itself isn't like that, no balls are created. If balls interact, they mustn't overlap, so they are placed
+        by spread_positions instead, and there may be fewer of them if the table is full.
+
+        :return: True if balls were created.
+        """
+        radius = 10
+        center = np.array(event.pos, dtype=float)
+        if not self.free_positions(center[None], radius)[0]:
+            return False
+        coords = [center[None]]
+        found = 1
+        if self.interacting:
+            coords.append(self.spread_positions(center, radius, self.ball_number - 1))
+            found += len(coords[-1])
+        tried = accepted = 0
+        while found < self.ball_number and not self.interacting:
+            missing = self.ball_number - found
+            # sample enough candidates to get the missing ones in one go at the acceptance rate seen so far
+            rate = max(accepted / tried, 0.01) if tried else 1
+            candidates = center + self.d_coord * (np.random.rand(int(missing / rate) + 1, 2) - 0.5)
+            valid = candidates[self.free_positions(candidates, radius)][:missing]
+            tried += len(candidates)
+            accepted += len(valid)
+            coords.append(valid)
+            found += len(valid)
+        # the first ball is white, others take colors from the palette
+        color_index = np.concatenate(([0], np.random.randint(len(self.colors), size=found - 1) + 1))
+        self.balls = objects.Ensemble(radius, np.concatenate(coords), [pygame.Color("white")] + self.colors,
+                                      color_index)
+        self.start_workers()
+        if self.writer is not None:
+            self.writer.join()  # it mustn't finish saving the previous section after it is started again
+        self.section = []
+        self.section_saved = self.section_size = 0
+        self.tick = 0
+        self.density.clear()
+        return True
+
+    def spread_positions(self, center, radius, number):
+        """Picks positions for balls that mustn't overlap: nodes of a square grid around the center, with a step a bit
+        larger than the diameter of a ball and shifted randomly a little. The grid grows until it has enough free
+        nodes. If the grid covers the window and there are still not enough of them, the table is full, and fewer
+        positions are returned.
+
+        :return: array of positions closest to the center, at most number of them.
+        """
+        step = 2.2 * radius
+        size = np.sqrt(number) * step
+        while True:
+            half = int(size / step / 2) + 1
+            offsets = np.arange(-half, half + 1) * step
+            x, y = np.meshgrid(offsets, offsets)
+            nodes = np.stack((x.ravel(), y.ravel()), axis=1)
+            nodes = nodes[(nodes != 0).any(axis=1)]  # the node in the center is taken by the first ball
+            nodes = center + nodes + (step - 2 * radius) * (np.random.rand(len(nodes), 2) - 0.5)
+            nodes = nodes[self.free_positions(nodes, radius)]
+            if len(nodes) >= number or size > 2 * max(WINDOW_SIZE):
                 break
+            size *= 1.5
+        nearest = np.argsort(((nodes - center) ** 2).sum(axis=1), kind="stable")
+        return nodes[nearest[:number]]
+
+    def free_positions(self, points, radius):
+        """Checks which balls with centers at the points would be inside the table and wouldn't touch its edge and
+        obstacles.
+
+        :param points: array of shape (n, 2).
+        :return: boolean array of shape (n,).
+        """
+        free = physics.inside_polygon(points, self.obstacles[0].segment_array)
+        for i, obstacle in enumerate(self.obstacles):
+            if i > 0:
+                free &= ~physics.inside_polygon(points, obstacle.segment_array)
+            free &= physics.polygon_distance(points, obstacle.segment_array) >= radius
+        return free
 
     def set_vel(self, vel):
-        """Gives balls velocity."""
-        vel = np.array(vel)
-        for ball in self.balls:
-            if ball == self.balls[0]:
-                ball.vel = vel
-            else:
-                angle = self.d_angle * (np.random.rand() - 0.5)
-                new_vel = np.dot(np.array([[np.cos(angle), np.sin(angle)], [-np.sin(angle), np.cos(angle)]]), vel)
-                ball.vel = new_vel
+        """Gives balls velocity. The first ball gets the velocity itself, others get it turned by random angles."""
+        angle = self.d_angle * (np.random.rand(len(self.balls)) - 0.5)
+        angle[0] = 0
+        cos, sin = np.cos(angle), np.sin(angle)
+        vx, vy = vel[0], vel[1]
+        # balls may be moved by workers, so velocities are written to the same array
+        self.balls.vel[:] = np.stack((cos * vx + sin * vy, -sin * vx + cos * vy), axis=1)
+
+    def start_workers(self):
+        """Starts processes that move balls if there are enough of them."""
+        self.stop_workers()
+        if len(self.balls) >= self.parallel_from and self.processes > 1 and not self.interacting:
+            self.workers = parallel.EnsembleWorkers(self.balls, [obstacle.segment_array for obstacle in self.obstacles],
+                                                    self.field_map, self.processes)
+
+    def step_workers(self, dt):
+        """Moves balls in worker processes. If a worker has failed or hung, the workers are stopped and balls are moved
+        in this process from then on. Balls of workers that have finished the failed step are moved by it twice.
+
+        :return: True if the workers have made the step.
+        """
+        try:
+            self.workers.step(self.B.value, self.friction, dt)
+        except threading.BrokenBarrierError:
+            self.stop_workers()
+            return False
+        return True
+
+    def stop_workers(self):
+        """Stops processes that move balls, if there are any."""
+        if self.workers is not None:
+            self.workers.close()
+            self.workers = None
+            if self.cue is not None:
+                self.cue.pos = self.balls.pos[0]  # the old position was a view of the freed shared memory
+
+    def checkpoint_state(self):
+        """
+        :return: dictionary with copies of everything needed to continue the study, except the section.
+        """
+        rng = np.random.get_state()
+        return {"edge": np.array(self.map_data[2]), "radius": self.balls.radius, "pos": self.balls.pos.copy(),
+                "vel": self.balls.vel.copy(), "prev_pos": self.balls.prev_pos.copy(),
+                "color_index": self.balls.color_index.copy(), "b": self.B.value, "friction": self.friction,
+                "d_coord": self.d_coord, "d_angle": self.d_angle, "ball_number": self.ball_number,
+                "interacting": self.interacting, "tick": self.tick, "rng_keys": rng[1], "rng_pos": rng[2],
+                "rng_has_gauss": rng[3], "rng_gauss": rng[4]}
+
+    def save_checkpoint(self, wait=False):
+        """Saves a snapshot of the study in a background thread. Only the part of the section that appeared since the
+        last snapshot is written. If the previous snapshot is still being saved, this one is skipped.
+
+        :param wait: if True, waits for the previous snapshot and for this one to be saved.
+        """
+        self.last_checkpoint = time.perf_counter()
+        if self.balls is None:
+            return
+        if self.writer is not None and self.writer.is_alive():
+            if not wait:
+                return
+            self.writer.join()
+        state = self.checkpoint_state()
+        chunks = self.section[self.section_saved:]
+        self.section_saved = len(self.section)
+        section_size = self.section_size
+
+        def write():
+            self.section_size = data.save_checkpoint(self.level, state, chunks, section_size)
+
+        self.writer = threading.Thread(target=write, daemon=True)
+        self.writer.start()
+        if wait:
+            self.writer.join()
+
+    def resume(self):
+        """Continues the study from the last saved snapshot, if it was taken on the same table.
+
+        :return: True if the study was resumed.
+        """
+        checkpoint = data.read_checkpoint(self.level)
+        if checkpoint is None:
+            return False
+        state, section, section_size = checkpoint
+        if not np.array_equal(state["edge"], self.map_data[2]):
+            return False
+        self.balls = objects.Ensemble(int(state["radius"]), state["pos"], [pygame.Color("white")] + self.colors,
+                                      state["color_index"])
+        self.balls.vel[:] = state["vel"]
+        self.balls.prev_pos[:] = state["prev_pos"]
+        self.B.value = float(state["b"])
+        self.B.image, self.B.rect = self.B.create_image()
+        self.friction = float(state["friction"])
+        self.d_coord = float(state["d_coord"])
+        self.d_angle = float(state["d_angle"])
+        self.ball_number = int(state["ball_number"])
+        self.interacting = bool(state["interacting"])
+        self.tick = int(state["tick"]) if "tick" in state else 0
+        np.random.set_state(("MT19937", state["rng_keys"], int(state["rng_pos"]), int(state["rng_has_gauss"]),
+                             float(state["rng_gauss"])))
+        self.section = section
+        self.section_saved = len(section)
+        self.section_size = section_size
+        self.cue = objects.Cue(self.all_sprites, self.balls.pos[0], max_vel=15)
+        self.start_workers()
+        return True
+
+    def close(self):
+        """Saves a snapshot, so that the study can be resumed, and stops processes that move balls."""
+        self.save_checkpoint(wait=True)
+        self.stop_workers()
 
     def boundary_coords(self, point, vertex_num):
-        """Calculates coordinates to plot on Poincare section."""
-        if vertex_num == 0:
-            vertex_num = len(self.obstacles[0].vertices - 1)
-        coord = 0
-        for i in range(vertex_num-1):
-            coord += np.linalg.norm(self.obstacles[0].vertices[i+1] - self.obstacles[0].vertices[i])
-        coord += np.linalg.norm(point - self.obstacles[0].vertices[vertex_num-1])
-        return coord
+        """Calculates coordinates to plot on Poincare section. Takes a point or arrays of points and vertex numbers."""
+        vertices = self.obstacles[0].vertices
+        previous = (np.asarray(vertex_num) - 1) % len(vertices)
+        return self.vertex_coords[previous] + np.linalg.norm(np.asarray(point) - vertices[previous], axis=-1)
 
     def draw_section(self):
         """Draws Poincare section."""
+        import matplotlib.pyplot as plt  # matplotlib takes most of the start time, so it is loaded on first use
         self.plot_on = True
         plot = plt.figure()
         section = plot.add_subplot(111)
@@ -515,9 +1009,10 @@ class ChaosStudy:
             length = self.boundary_coords(vertex, i) * np.ones(2)
             angle = np.array([-1.05, 1.05])
             section.plot(length, angle, color="blue")
-        for i, ball in enumerate(self.balls):
-            color = (ball.color[0]/255, ball.color[1]/255, ball.color[2]/255)
-            section.scatter(self.length[i], self.angles[i], color=color, s=20)
+        if self.section:
+            balls, length, angles = (np.concatenate(arrays) for arrays in zip(*self.section))
+            colors = self.balls.color_values[self.balls.color_index[balls]] / 255
+            section.scatter(length, angles, color=colors, s=20)
         plt.show()
 
     def update_variables(self, variables):
@@ -0,0 +1,229 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import data
+import physics
+import solver
+
+AREA = (100, 75, 740, 490)  # part of the window where tables are placed: left, top, right, bottom
+GAP = 2 * solver.BALL_RADIUS + 10  # the ball must be able to pass between obstacles and the edge
+MIN_DISTANCE = 150  # minimum distance between the ball and the pocket
+
+# shots that are tried to rate a level: cue angles, cue values and magnetic fields
+ANGLES = 120
+POWERS = (20, 40, 60, 80, 100)
+FIELDS = (-0.1, 0.0, 0.1)
+# a shot is good if it wins with at most this number of collisions, that is with a score of 8 or more. Almost any
+# table can be won by a shot that bounces long enough, so only good shots tell how hard a level is
+MAX_COLLISIONS = 2
+
+
+def star_polygon(rng, center, radius, vertices, jitter):
+    """
+    :return: array of integer vertices of a polygon around the center. Angles of the vertices are spread evenly with
+        some noise and increase, so the polygon is simple. Each vertex is at a distance from radius * (1 - jitter) to
+        radius from the center.
+    """
+    spacing = 2 * np.pi / vertices
+    angles = rng.uniform(0, 2 * np.pi) + spacing * (np.arange(vertices) + rng.uniform(-0.4, 0.4, vertices))
+    distance = radius * rng.uniform(1 - jitter, 1, vertices)
+    points = np.asarray(center) + distance[:, None] * np.stack((np.cos(angles), np.sin(angles)), axis=1)
+    return np.round(points).astype(int)
+
+
+def make_edge(rng):
+    """
+    :return: vertices of the edge of the table: either a box with up to two notches or a star-shaped polygon
+        stretched to fill AREA.
+    """
+    left, top, right, bottom = AREA
+    if rng.rand() < 0.4:
+        x0, x1 = rng.randint(left, left + 100), rng.randint(right - 100, right)
+        y0, y1 = rng.randint(top, top + 80), rng.randint(bottom - 80, bottom)
+        vertices = [(x0, y0), (x1, y0)]
+        right_notch = None
+        if rng.rand() < 0.5:  # a notch in the right side
+            y_a = rng.randint(y0 + 60, (y0 + y1) // 2)
+            y_b = rng.randint(y_a + 60, y1 - 40)
+            depth = rng.randint(60, (x1 - x0) // 3)
+            vertices += [(x1, y_a), (x1 - depth, y_a), (x1 - depth, y_b), (x1, y_b)]
+            right_notch = x1 - depth, y_b
+        vertices.append((x1, y1))
+        if rng.rand() < 0.5:  # a notch in the bottom side
+            x_a = rng.randint((x0 + x1) // 2, x1 - 120)
+            x_b = rng.randint(x0 + 60, x_a - 80)
+            depth = rng.randint(60, (y1 - y0) // 2)
+            if right_notch is None or x_a + GAP < right_notch[0] or right_notch[1] + GAP < y1 - depth:
+                vertices += [(x_a, y1), (x_a, y1 - depth), (x_b, y1 - depth), (x_b, y1)]
+        vertices.append((x0, y1))
+        return np.array(vertices)
+    polygon = star_polygon(rng, (0, 0), 1000, rng.randint(3, 10), 0.5)
+    low, high = polygon.min(axis=0), polygon.max(axis=0)
+    scale = np.array([right - left, bottom - top]) / (high - low)
+    return np.round([left, top] + (polygon - low) * scale).astype(int)
+
+
+def outline(vertices, step=5):
+    """
+    :return: points along the sides of the polygon, not further than step from each other.
+    """
+    points = []
+    for a, b in zip(vertices, np.roll(vertices, -1, axis=0)):
+        count = max(int(np.hypot(*(b - a)) / step), 1)
+        points.append(a + (b - a) * np.arange(count)[:, None] / count)
+    return np.concatenate(points)
+
+
+def make_obstacles(rng, edge, count, tries=50):
+    """
+    :return: list of vertices of obstacles that lie inside the edge, at least GAP away from it and from each other.
+    """
+    edge_segments = physics.make_segment_array(edge)
+    low, high = edge.min(axis=0), edge.max(axis=0)
+    obstacles = []
+    for _ in range(tries):
+        if len(obstacles) == count:
+            break
+        radius = rng.uniform(25, 70)
+        center = rng.uniform(low + radius, high - radius)
+        obstacle = star_polygon(rng, center, radius, rng.randint(3, 7), 0.4)
+        points = outline(obstacle)
+        if not physics.inside_polygon(points, edge_segments).all() or \
+                physics.polygon_distance(points, edge_segments).min() < GAP:
+            continue
+        segments = physics.make_segment_array(obstacle)
+        if physics.inside_polygon(edge.astype(float), segments).any():
+            continue
+        if any(physics.polygon_distance(points, physics.make_segment_array(other)).min() < GAP or
+               physics.inside_polygon(outline(other), segments).any() for other in obstacles):
+            continue
+        obstacles.append(obstacle)
+    return obstacles
+
+
+def free_points(rng, edge, obstacles, count=200):
+    """
+    :return: random points where the ball or the pocket can be placed: inside the table, not closer than the radius
+        of the ball to the edge and to obstacles.
+    """
+    low, high = edge.min(axis=0), edge.max(axis=0)
+    points = rng.uniform(low, high, (count, 2))
+    polygons = [physics.make_segment_array(edge)] + [physics.make_segment_array(obstacle) for obstacle in obstacles]
+    free = physics.inside_polygon(points, polygons[0])
+    for i, segments in enumerate(polygons):
+        if i > 0:
+            free &= ~physics.inside_polygon(points, segments)
+        free &= physics.polygon_distance(points, segments) >= solver.BALL_RADIUS + 2
+    return np.round(points[free]).astype(int)
+
+
+def make_level(rng):
+    """
+    :return: data about a random level in the same format as data.read_map returns, None if the ball and the pocket
+        couldn't be placed.
+    """
+    edge = make_edge(rng)
+    obstacles = make_obstacles(rng, edge, rng.randint(0, 4))
+    points = free_points(rng, edge, obstacles)
+    if len(points) < 2:
+        return None
+    ball = points[0]
+    far = points[np.hypot(*(points - ball).T) >= MIN_DISTANCE]
+    if len(far) == 0:
+        return None
+    pocket = far[0]
+    return [ball.tolist(), pocket.tolist(), edge.tolist(), [obstacle.tolist() for obstacle in obstacles], None, []]
+
+
+def rate(map_data):
+    """Simulates a grid of shots on the level. Shots are stopped as soon as they have too many collisions to be good.
+
+    :return: tuple (good_rate, shot): fraction of good shots and the solver.Shot with the best score, None if no shot
+        is good.
+    """
+    angle, power, field = (axis.ravel() for axis in np.meshgrid(np.linspace(0, 2 * np.pi, ANGLES, endpoint=False),
+                                                                 POWERS, FIELDS, indexing="ij"))
+    shots = solver.evaluate(map_data, angle, power, field[:, None], max_collisions=MAX_COLLISIONS)
+    wins = [shot for shot in shots if shot.win]
+    if not wins:
+        return 0.0, None
+    return len(wins) / len(shots), min(wins, key=solver.rank)
+
+
+def candidate(args):
+    """Makes and rates a level in a worker process.
+
+    :return: tuple (seed, text of the level file or None, reason why it was dropped or None).
+    """
+    seed, max_good_rate = args
+    rng = np.random.RandomState(seed)
+    map_data = make_level(rng)
+    if map_data is None:
+        return seed, None, "no room"
+    good_rate, shot = rate(map_data)
+    if shot is None:
+        return seed, None, "unsolvable"
+    if good_rate > max_good_rate:
+        return seed, None, "trivial"
+    difficulty = -np.log10(good_rate)
+    fields = " ".join(f"{b:g}" for b in shot.fields)
+    header = (f"# generated from seed {seed}\n"
+              f"# difficulty {difficulty:.2f}: {good_rate:.2%} of {ANGLES * len(POWERS) * len(FIELDS)} shots win "
+              f"with a score of {10 - MAX_COLLISIONS} or more, best score {shot.score()}\n"
+              f"# best shot: angle {np.degrees(shot.angle):.1f}, power {shot.power}, field {fields}\n")
+    return seed, header + data.format_level(map_data), None
+
+
+def generate(count, output, seed=0, processes=None, max_good_rate=0.02):
+    """Makes levels until count of them pass the filter and saves them to the output folder. Candidates are made and
+    rated in parallel, and saved as soon as they are ready.
+
+    :param max_good_rate: levels where a larger fraction of shots are good are dropped as trivial.
+    :return: dictionary with numbers of saved levels and of levels dropped for each reason.
+    """
+    os.makedirs(output, exist_ok=True)
+    stats = {"saved": 0, "no room": 0, "unsolvable": 0, "trivial": 0}
+    start = time.perf_counter()
+    pool = multiprocessing.Pool(processes)
+    try:
+        seeds = ((seed + i, max_good_rate) for i in range(2 ** 31 - seed))
+        for level_seed, text, reason in pool.imap_unordered(candidate, seeds):
+            if text is None:
+                stats[reason] += 1
+                continue
+            stats["saved"] += 1
+            with open(os.path.join(output, f"level_{stats['saved']}.txt"), "w", encoding="utf8") as f:
+                f.write(text)
+            hours = (time.perf_counter() - start) / 3600
+            print(f"level {stats['saved']} from seed {level_seed}, {stats['saved'] / hours:.0f} levels per hour, "
+                  f"dropped: {stats['no room']} without room, {stats['unsolvable']} unsolvable, "
+                  f"{stats['trivial']} trivial", file=sys.stderr)
+            if stats["saved"] == count:
+                break
+    finally:
+        pool.terminate()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates random levels and keeps those that can be won with a good "
+                                                 "score, but not by many shots. Levels are written as level_<n>.txt "
+                                                 "files, which can be copied to the levels folder.")
+    parser.add_argument("count", type=int, help="number of levels to make")
+    parser.add_argument("--output", default="generated", help="folder for the levels")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first candidate")
+    parser.add_argument("--processes", type=int, help="number of worker processes, all cores by default")
+    parser.add_argument("--max-good-rate", type=float, default=0.02,
+                        help="levels where a larger fraction of shots win with a score of 8 or more are dropped as "
+                             "trivial")
+    args = parser.parse_args()
+    generate(args.count, args.output, args.seed, args.processes, args.max_good_rate)
+
+
+if __name__ == "__main__":
+    main()
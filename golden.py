@@ -0,0 +1,324 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import pygame
+
+import collisions
+import data
+import game
+import physics
+import solver
+from constants import DT
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# reference shots of every level: cue angles, cue values and magnetic fields. Angles are turned a bit, so that shots
+# don't go along sides of rectangular tables
+ANGLES = (np.arange(8) + 0.3) * np.pi / 4
+POWERS = (35, 70, 100)
+FIELDS = (0.0, 0.05)
+MAX_TICKS = 3000  # the fastest ball stops after 2500 ticks
+TOLERANCE = 1e-6  # largest allowed difference of coordinates, velocities and coordinates on Poincare section
+# chaos study with interacting balls, they pass speed to each other and mustn't get through the edge of the table
+ENSEMBLE_BALLS = 200
+ENSEMBLE_TICKS = 600
+
+
+def shots():
+    """
+    :return: tuple of arrays (angle, power, field) of reference shots.
+    """
+    angle, power, field = np.meshgrid(ANGLES, POWERS, FIELDS, indexing="ij")
+    return angle.ravel(), power.ravel().astype(float), field.ravel()
+
+
+def level_hash(level):
+    """
+    :return: hash of the level file, runs recorded on another version of the level can't be compared.
+    """
+    with open(os.path.join("levels", "level_" + str(level) + ".txt"), "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class Run:
+    """Reference shots of a level played by Game.
+
+    Attributes:
+        level_hash: hash of the level file.
+        angle, power, field: arrays with cue angles, cue values and magnetic fields of the shots.
+        win: array that shows which shots put the ball in the pocket.
+        score: array with scores of the shots.
+        ticks: array with numbers of ticks after which the ball stopped or got into the pocket.
+        pos, vel: arrays of shape (shots, 2) with the state of the ball at the end.
+        events: collisions.EVENT records of all collisions of all balls, in order of shots and ticks.
+        shot: array with number of the shot of each event.
+        section: array of shape (events, 2) with coordinates of collisions of the ball with the edge on Poincare
+            section, as ChaosStudy plots them, NaN for other collisions.
+    """
+    def __init__(self, level_hash, angle, power, field, win, score, ticks, pos, vel, events, shot, section):
+        self.level_hash = str(level_hash)
+        self.angle = angle
+        self.power = power
+        self.field = field
+        self.win = win
+        self.score = score
+        self.ticks = ticks
+        self.pos = pos
+        self.vel = vel
+        self.events = events
+        self.shot = shot
+        self.section = section
+
+    def arrays(self):
+        return {"level_hash": np.array(self.level_hash), "angle": self.angle, "power": self.power, "field": self.field,
+                "win": self.win, "score": self.score, "ticks": self.ticks, "pos": self.pos, "vel": self.vel,
+                "events": self.events, "shot": self.shot, "section": self.section}
+
+    def describe(self, shot):
+        return (f"shot {shot} (angle {np.degrees(self.angle[shot]):.1f}, power {self.power[shot]:g}, "
+                f"field {self.field[shot]:g})")
+
+
+def init_worker():
+    """Prepares pygame in a worker process, games are played without a window."""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.chdir(ROOT)
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+
+
+def play(level, angle, power, field):
+    """Plays one shot in Game without drawing anything, exactly as the game does it with time running normally.
+
+    :return: tuple (win, score, ticks, pos, vel, events) with the state of the ball at the end and the array of
+        collisions.EVENT records.
+    """
+    play_game = game.Game(level, save=False)
+    play_game.B.value = field
+    play_game.ball.vel = solver.shot_velocity(angle, power)
+    events = []
+    play_game.collisions.subscribe(lambda tick_events: events.append(tick_events.copy()))
+    while play_game.tick < MAX_TICKS and not play_game.win and not play_game.is_still():
+        play_game.step(DT)
+    events = np.concatenate(events) if events else np.zeros(0, dtype=collisions.EVENT)
+    return (play_game.win, play_game.score, play_game.tick, play_game.ball.pos.copy(), play_game.ball.vel.copy(),
+            events)
+
+
+def _play_shot(job):
+    """Plays a reference shot in a worker process."""
+    level, shot = job
+    angle, power, field = shots()
+    return play(level, float(angle[shot]), float(power[shot]), float(field[shot]))
+
+
+def map_jobs(function, jobs, processes=None, chunksize=1):
+    """
+    :return: list of results of the function for the jobs, computed in worker processes.
+    """
+    pool = multiprocessing.Pool(processes, initializer=init_worker)
+    try:
+        results = pool.map(function, jobs, chunksize=chunksize)
+        # workers are let to finish, SDL catches the signal that terminate sends them
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.join()
+    return results
+
+
+def run_levels(levels, processes=None):
+    """Plays reference shots of the levels, splitting them between worker processes.
+
+    :return: dictionary {level: Run}.
+    """
+    angle, power, field = shots()
+    jobs = [(level, shot) for level in levels for shot in range(len(angle))]
+    results = map_jobs(_play_shot, jobs, processes, chunksize=4)
+    runs = {}
+    for i, level in enumerate(levels):
+        win, score, ticks, pos, vel, events = zip(*results[i * len(angle):(i + 1) * len(angle)])
+        shot = np.repeat(np.arange(len(angle)), [len(shot_events) for shot_events in events])
+        events = np.concatenate(events)
+        section = np.full((len(events), 2), np.nan)
+        edge = (events["ball"] == 0) & (events["obstacle"] == 0)
+        section[edge] = np.stack(physics.section_coords(data.read_map(level)[2], events["point"][edge],
+                                                        events["vertex"][edge], events["vel_out"][edge]), axis=1)
+        runs[level] = Run(level_hash(level), angle, power, field, np.array(win), np.array(score), np.array(ticks),
+                          np.array(pos), np.array(vel), events, shot, section)
+    return runs
+
+
+def escape(level, balls=ENSEMBLE_BALLS, ticks=ENSEMBLE_TICKS):
+    """Runs a chaos study of the level with interacting balls placed around the ball of the level and hit with the
+    strongest cue, as ChaosStudy goes when player starts it.
+
+    :return: tuple (tick, ball, pos) for the first ball that has got out of the edge of the table, None if all balls
+        have stayed on it.
+    """
+    np.random.seed(0)
+    study = game.ChaosStudy(level)
+    study.checkpoint_every = np.inf
+    study.interacting = True
+    study.B.value = FIELDS[-1]
+    variables = [20, np.pi / 360, balls]
+    study.update_variables(variables)
+    pos = tuple(study.map_data[0])
+    if not study.make_balls(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=pos, button=1)):
+        raise ValueError(f"balls can't be placed at {pos}")
+    study.set_vel(solver.shot_velocity(ANGLES[0], POWERS[-1]))
+    edge = physics.make_segment_array(study.map_data[2])
+    for tick in range(ticks):
+        study.update([], DT, variables)
+        outside = np.flatnonzero(~physics.inside_polygon(study.balls.pos, edge))
+        if len(outside):
+            return tick, int(outside[0]), study.balls.pos[outside[0]].round().tolist()
+    return None
+
+
+def check_escapes(levels, processes=None):
+    """Checks that interacting balls stay on the table of each level.
+
+    :return: number of levels where a ball has got out.
+    """
+    failed = 0
+    for level, result in zip(levels, map_jobs(escape, levels, processes)):
+        if result is None:
+            print(f"level {level}: {ENSEMBLE_BALLS} interacting balls stayed on the table for {ENSEMBLE_TICKS} ticks",
+                  file=sys.stderr)
+        else:
+            tick, ball, pos = result
+            print(f"level {level}: interacting ball {ball} got out of the table to {pos} at tick {tick}",
+                  file=sys.stderr)
+            failed += 1
+    return failed
+
+
+def compare(reference, run, tolerance=TOLERANCE, tick_tolerance=0):
+    """Finds where shots of a run go differently from the reference. Collisions of each shot are compared one by one
+    until the first one that differs, then the outcomes are compared.
+
+    :param tolerance: largest allowed difference of coordinates, velocities and coordinates on Poincare section.
+    :param tick_tolerance: largest allowed difference of ticks of collisions and of the ends of shots.
+    :return: tuple (divergences, deviation): list of descriptions of the first difference of each shot that went
+        differently, and the largest difference of coordinates and velocities among collisions that matched.
+    """
+    divergences = []
+    if run.level_hash != reference.level_hash:
+        divergences.append("the level has been changed since the reference was recorded")
+    deviation = 0.0
+    for shot in range(len(reference.angle)):
+        expected = reference.events[reference.shot == shot]
+        actual = run.events[run.shot == shot]
+        expected_section = reference.section[reference.shot == shot]
+        actual_section = run.section[run.shot == shot]
+        difference = None
+        for k in range(min(len(expected), len(actual))):
+            a, b = expected[k], actual[k]
+            where = f"collision {k} at tick {b['tick']}"
+            if abs(int(a["tick"]) - int(b["tick"])) > tick_tolerance:
+                difference = f"{where} instead of tick {a['tick']}"
+            elif (a["ball"], a["obstacle"], a["vertex"]) != (b["ball"], b["obstacle"], b["vertex"]):
+                difference = (f"{where}: ball {b['ball']} hits obstacle {b['obstacle']} at side {b['vertex']} instead "
+                              f"of ball {a['ball']}, obstacle {a['obstacle']}, side {a['vertex']}")
+            else:
+                point = np.abs(a["point"] - b["point"]).max()
+                vel = max(np.abs(a["vel_in"] - b["vel_in"]).max(), np.abs(a["vel_out"] - b["vel_out"]).max())
+                section = np.nan_to_num(np.abs(expected_section[k] - actual_section[k])).max()
+                if point > tolerance:
+                    difference = f"{where}: the point of collision is {point:.3g} away"
+                elif vel > tolerance:
+                    difference = f"{where}: velocity differs by {vel:.3g}"
+                elif section > tolerance:
+                    difference = f"{where}: Poincare section coordinates differ by {section:.3g}"
+                else:
+                    deviation = max(deviation, point, vel)
+            if difference is not None:
+                break
+        if difference is None and len(expected) != len(actual):
+            difference = f"{len(actual)} collisions instead of {len(expected)}"
+        if difference is None:
+            if run.win[shot] != reference.win[shot]:
+                difference = "the ball got into the pocket" if run.win[shot] else "the ball missed the pocket"
+            elif run.score[shot] != reference.score[shot]:
+                difference = f"score {run.score[shot]} instead of {reference.score[shot]}"
+            elif abs(int(run.ticks[shot]) - int(reference.ticks[shot])) > tick_tolerance:
+                difference = f"the shot ended at tick {run.ticks[shot]} instead of {reference.ticks[shot]}"
+            elif np.abs(run.pos[shot] - reference.pos[shot]).max() > tolerance:
+                difference = f"the ball ended {np.abs(run.pos[shot] - reference.pos[shot]).max():.3g} away"
+        if difference is not None:
+            divergences.append(f"{reference.describe(shot)}: {difference}")
+    return divergences, deviation
+
+
+def read(level):
+    """
+    :return: reference Run of the level, None if it wasn't recorded.
+    """
+    arrays = data.read_golden(level)
+    return Run(**arrays) if arrays is not None else None
+
+
+def record(levels, processes=None):
+    """Plays reference shots of the levels and saves them to folder golden."""
+    for level, run in run_levels(levels, processes).items():
+        data.save_golden(level, run.arrays())
+        print(f"level {level}: {len(run.angle)} shots, {run.win.sum()} win, {len(run.events)} collisions recorded",
+              file=sys.stderr)
+
+
+def check(levels, processes=None, tolerance=TOLERANCE, tick_tolerance=0):
+    """Plays reference shots of the levels and compares them with the recorded ones, then checks that interacting
+    balls stay on the tables.
+
+    :return: number of shots that went differently, levels without a reference and levels where interacting balls got
+        out count as one.
+    """
+    references = {level: read(level) for level in levels}
+    failed = 0
+    for level in levels:
+        if references[level] is None:
+            print(f"level {level}: no reference, run with record first", file=sys.stderr)
+            failed += 1
+    runs = run_levels([level for level in levels if references[level] is not None], processes)
+    for level, run in runs.items():
+        divergences, deviation = compare(references[level], run, tolerance, tick_tolerance)
+        print(f"level {level}: {len(divergences)} of {len(run.angle)} shots diverged, largest deviation "
+              f"{deviation:.3g}", file=sys.stderr)
+        for divergence in divergences:
+            print("    " + divergence, file=sys.stderr)
+        failed += len(divergences)
+    return failed + check_escapes(levels, processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Records reference shots of every level played by the game and "
+                                                 "checks that changes to the physics play them the same way.")
+    parser.add_argument("command", choices=("record", "check"), help="record the reference or check against it")
+    parser.add_argument("levels", type=int, nargs="*", help="level numbers, all levels by default")
+    parser.add_argument("--processes", type=int, help="number of worker processes, all cores by default")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="largest allowed difference of coordinates and velocities")
+    parser.add_argument("--tick-tolerance", type=int, default=0,
+                        help="largest allowed difference of ticks of collisions")
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    levels = args.levels or list(range(1, data.number_of_levels() + 1))
+    start = time.perf_counter()
+    if args.command == "record":
+        record(levels, args.processes)
+        failed = 0
+    else:
+        failed = check(levels, args.processes, args.tolerance, args.tick_tolerance)
+    print(f"{len(levels) * len(shots()[0])} shots played in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pygame
+
+import data
+import generator
+import physics
+import solver
+
+# segments that marching squares put in a cell for each of 16 cases. The case is 8 * top left + 4 * top right +
+# 2 * bottom right + bottom left, where a corner is 1 if its pixel is light. Segments go between midpoints of the
+# sides of the cell: 0 top, 1 right, 2 bottom, 3 left, and the light side is on their right. Diagonal corners of cases
+# 5 and 10 are not joined, so every midpoint starts exactly one segment and ends exactly one
+CASES = {1: [(3, 2)], 2: [(2, 1)], 3: [(3, 1)], 4: [(1, 0)], 5: [(1, 0), (3, 2)], 6: [(2, 0)], 7: [(3, 0)],
+         8: [(0, 3)], 9: [(0, 2)], 10: [(0, 3), (2, 1)], 11: [(0, 1)], 12: [(1, 3)], 13: [(1, 2)], 14: [(2, 3)]}
+# midpoints of the sides of a cell in half pixels from its top left corner
+MIDPOINTS = np.array([(1, 0), (2, 1), (1, 2), (0, 1)])
+
+
+def segment_tables():
+    """
+    :return: tuple of arrays (start, end) of shape (2, 16) with sides of the cell where the first and the second
+        segment of each case start and end, -1 if there is no such segment.
+    """
+    start = np.full((2, 16), -1)
+    end = np.full((2, 16), -1)
+    for case, segments in CASES.items():
+        for k, (a, b) in enumerate(segments):
+            start[k, case], end[k, case] = a, b
+    return start, end
+
+
+def read_mask(path, threshold=128):
+    """
+    :return: boolean array of shape (height, width) that shows light pixels of the picture, they are the table.
+    """
+    pixels = pygame.surfarray.array3d(pygame.image.load(path)).transpose(1, 0, 2)
+    return pixels.mean(axis=2) >= threshold
+
+
+def trace_contours(mask):
+    """Finds borders between light and dark pixels by marching squares. All cells are handled at once, then segments
+    are joined into closed contours by matching their ends.
+
+    :param mask: boolean array of shape (height, width).
+    :return: list of arrays of shape (n, 2) with points of contours in pixels. Light pixels are on the right of each
+        contour, so outer borders of light regions go clockwise on the screen and borders of dark holes go
+        counterclockwise.
+    """
+    padded = np.pad(mask, 1).astype(int)  # the border is dark, so all contours are closed
+    case = 8 * padded[:-1, :-1] + 4 * padded[:-1, 1:] + 2 * padded[1:, 1:] + padded[1:, :-1]
+    start_side, end_side = segment_tables()
+    starts, ends = [], []
+    for k in range(2):
+        rows, columns = np.nonzero(start_side[k][case] >= 0)
+        corner = 2 * np.stack((columns, rows), axis=1)
+        starts.append(corner + MIDPOINTS[start_side[k][case[rows, columns]]])
+        ends.append(corner + MIDPOINTS[end_side[k][case[rows, columns]]])
+    starts, ends = np.concatenate(starts), np.concatenate(ends)
+    if len(starts) == 0:
+        return []
+
+    # the segment that follows each one starts where it ends
+    width = 2 * padded.shape[1] + 1
+    start_keys = starts[:, 1] * width + starts[:, 0]
+    order = np.argsort(start_keys)
+    following = order[np.searchsorted(start_keys[order], ends[:, 1] * width + ends[:, 0])]
+
+    contours = []
+    visited = np.zeros(len(starts), dtype=bool)
+    following = following.tolist()
+    for first in range(len(starts)):
+        if visited[first]:
+            continue
+        chain = []
+        segment = first
+        while not visited[segment]:
+            visited[segment] = True
+            chain.append(segment)
+            segment = following[segment]
+        # midpoints are in half pixels of the padded picture, centers of pixels get integer coordinates plus 0.5
+        contours.append(starts[chain] / 2 - 0.5)
+    return contours
+
+
+def signed_area(points):
+    """
+    :return: area of the polygon, positive if it goes clockwise on the screen.
+    """
+    x, y = points[:, 0], points[:, 1]
+    return (x * np.roll(y, -1) - np.roll(x, -1) * y).sum() / 2
+
+
+def douglas_peucker(points, tolerance):
+    """Simplifies an open polyline: keeps its ends and, recursively, the point farthest from the chord while it is
+    further than tolerance.
+
+    :return: boolean array that shows which points are kept.
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a, b = points[first], points[last]
+        chord = b - a
+        inner = points[first + 1:last] - a
+        length = np.hypot(*chord)
+        if length > 0:
+            distance = np.abs(chord[0] * inner[:, 1] - chord[1] * inner[:, 0]) / length
+        else:
+            distance = np.hypot(inner[:, 0], inner[:, 1])
+        farthest = int(distance.argmax())
+        if distance[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack += [(first, middle), (middle, last)]
+    return keep
+
+
+def simplify(polygon, tolerance, max_vertices=None):
+    """Simplifies a closed polygon by Douglas-Peucker. It is split into two polylines at the point farthest from the
+    first one. If max_vertices is given, tolerance grows until the polygon has no more vertices than that.
+
+    :return: array of vertices of the simplified polygon.
+    """
+    split = int(((polygon - polygon[0]) ** 2).sum(axis=1).argmax())
+    closed = np.concatenate((polygon, polygon[:1]))
+    while True:
+        keep = np.concatenate((douglas_peucker(closed[:split + 1], tolerance)[:-1],
+                               douglas_peucker(closed[split:], tolerance)[:-1]))
+        if max_vertices is None or keep.sum() <= max_vertices:
+            return polygon[keep]
+        tolerance *= 1.5
+
+
+def to_level(contours, min_area):
+    """Finds the edge of the table and obstacles among contours and fits them into generator.AREA.
+
+    :param min_area: dark spots with a smaller area in pixels of the picture are ignored.
+    :return: tuple (edge, obstacles, scale, offset): contours in coordinates of the level and the transform from
+        coordinates of the picture, level = picture * scale + offset.
+    """
+    areas = [signed_area(contour) for contour in contours]
+    outer = [i for i, area in enumerate(areas) if area > 0]
+    if not outer:
+        raise ValueError("the picture has no light table")
+    edge = contours[max(outer, key=lambda i: areas[i])]
+    segments = physics.make_segment_array(edge)
+    obstacles = [contours[i] for i, area in enumerate(areas)
+                 if area < -min_area and physics.inside_polygon(contours[i][:1], segments)[0]]
+
+    left, top, right, bottom = generator.AREA
+    low, high = edge.min(axis=0), edge.max(axis=0)
+    scale = min((right - left) / (high - low)[0], (bottom - top) / (high - low)[1])
+    offset = np.array([(left + right) / 2, (top + bottom) / 2]) - (low + high) / 2 * scale
+    return edge * scale + offset, [obstacle * scale + offset for obstacle in obstacles], scale, offset
+
+
+def is_free(pos, edge, obstacles):
+    """
+    :return: True if a ball at the position is inside the table and doesn't touch its edge and obstacles.
+    """
+    point = np.array([pos], dtype=float)
+    polygons = [physics.make_segment_array(edge)] + [physics.make_segment_array(obstacle) for obstacle in obstacles]
+    free = physics.inside_polygon(point, polygons[0])[0]
+    for i, segments in enumerate(polygons):
+        if i > 0:
+            free &= not physics.inside_polygon(point, segments)[0]
+        free &= physics.polygon_distance(point, segments)[0] >= solver.BALL_RADIUS
+    return bool(free)
+
+
+def place_ball_and_pocket(edge, obstacles, ball=None, pocket=None, seed=0):
+    """Checks the positions of the ball and the pocket or picks them: the ball at a random free point, the pocket at
+    the free point farthest from it.
+
+    :return: tuple (ball, pocket) of integer positions.
+    """
+    for name, pos in (("ball", ball), ("pocket", pocket)):
+        if pos is not None and not is_free(pos, edge, obstacles):
+            raise ValueError(f"the {name} at {np.round(pos).astype(int).tolist()} is not on the table")
+    if ball is None or pocket is None:
+        points = generator.free_points(np.random.RandomState(seed), edge, obstacles, count=2000)
+        if len(points) == 0:
+            raise ValueError("there is no room for the ball on the table")
+        if ball is None:
+            ball = points[0]
+        if pocket is None:
+            pocket = points[np.hypot(*(points - ball).T).argmax()]
+    return np.round(ball).astype(int).tolist(), np.round(pocket).astype(int).tolist()
+
+
+def import_level(path, tolerance=2.0, max_vertices=32, threshold=128, min_area=50, ball=None, pocket=None):
+    """Traces a picture of a table: the largest light region is the table, dark regions inside it are obstacles.
+
+    :param tolerance: largest distance in pixels of the level between a traced border and the simplified polygon.
+    :param max_vertices: largest number of vertices of a polygon, tolerance is increased for polygons that have more.
+    :param ball, pocket: positions of the ball and the pocket on the picture, they are picked if not given.
+    :return: data about the level in the same format as data.read_map returns.
+    """
+    mask = read_mask(path, threshold)
+    edge, obstacles, scale, offset = to_level(trace_contours(mask), min_area)
+    polygons = []
+    for polygon in [edge] + obstacles:
+        vertices = np.round(simplify(polygon, tolerance, max_vertices)).astype(int)
+        vertices = vertices[(vertices != np.roll(vertices, 1, axis=0)).any(axis=1)]
+        if len(vertices) >= 3:
+            polygons.append(vertices)
+    if ball is not None:
+        ball = np.asarray(ball) * scale + offset
+    if pocket is not None:
+        pocket = np.asarray(pocket) * scale + offset
+    ball, pocket = place_ball_and_pocket(polygons[0], polygons[1:], ball, pocket)
+    return [ball, pocket, polygons[0].tolist(), [obstacle.tolist() for obstacle in polygons[1:]], None, []]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Makes a level from a picture of a table: the largest light region "
+                                                 "is the table, dark regions inside it are obstacles. Their borders "
+                                                 "are traced and simplified to polygons with few vertices, and the "
+                                                 "level is written as a level_<n>.txt file, which can be copied to "
+                                                 "the levels folder.")
+    parser.add_argument("picture", help="path of the picture")
+    parser.add_argument("--output", default="imported", help="folder for the level")
+    parser.add_argument("--tolerance", type=float, default=2.0,
+                        help="largest distance in pixels between a border and its polygon")
+    parser.add_argument("--max-vertices", type=int, default=32, help="largest number of vertices of a polygon")
+    parser.add_argument("--threshold", type=int, default=128, help="brightness from 0 to 255 from which pixels are "
+                                                                   "the table")
+    parser.add_argument("--min-area", type=float, default=50, help="smaller dark spots in pixels are ignored")
+    parser.add_argument("--ball", type=float, nargs=2, help="position of the ball on the picture")
+    parser.add_argument("--pocket", type=float, nargs=2, help="position of the pocket on the picture")
+    args = parser.parse_args()
+
+    map_data = import_level(args.picture, args.tolerance, args.max_vertices, args.threshold, args.min_area,
+                            args.ball, args.pocket)
+    os.makedirs(args.output, exist_ok=True)
+    number = 1
+    while os.path.exists(os.path.join(args.output, f"level_{number}.txt")):
+        number += 1
+    path = os.path.join(args.output, f"level_{number}.txt")
+    with open(path, "w", encoding="utf8") as f:
+        f.write(f"# imported from {os.path.basename(args.picture)}\n" + data.format_level(map_data))
+    sides = [len(map_data[2])] + [len(obstacle) for obstacle in map_data[3]]
+    print(f"{path}: edge with {sides[0]} vertices, {len(sides) - 1} obstacles, {sum(sides)} sides in all",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import pygame
+
+import data
+import solver
+
+ANGLES = 360  # number of cue angles in the coarse grid
+POWERS = 50  # number of cue values in the coarse grid, from 2 to 100
+PANEL_SIZE = 480, 200  # size of the landscape on the picture
+
+
+class Landscape:
+    """Outcomes of shots of a level over a grid of cue angles and cue values with constant magnetic field.
+
+    The grid is first computed at ANGLES x POWERS points. Each refinement doubles its resolution, but only points
+    between shots with different outcomes are simulated, the rest take the outcome of their neighbour.
+
+    Attributes:
+        field: magnetic field.
+        angles: array of cue angles of the grid, from 0 to 2 pi.
+        powers: array of cue values of the grid.
+        win: array of shape (angles, powers) that shows which shots put the ball in the pocket.
+        collisions: array of shape (angles, powers) with numbers of collisions of the ball with obstacles in each shot.
+        stop: array of shape (angles, powers, 2) with positions where the ball stops or gets in the pocket.
+        simulated: array that shows which points of the grid were simulated, not copied from a neighbour.
+    """
+    def __init__(self, field, angles, powers, win, collisions, stop, simulated):
+        self.field = field
+        self.angles = angles
+        self.powers = powers
+        self.win = win
+        self.collisions = collisions
+        self.stop = stop
+        self.simulated = simulated
+
+    def score(self):
+        """
+        :return: array with scores the shots get, as solver.Shot.score.
+        """
+        return np.where(self.win, np.maximum(10 - self.collisions, 0), 0)
+
+    def outcome(self):
+        """
+        :return: array with the score of each winning shot and -1 for other shots. Points of the grid are refined
+            where it changes.
+        """
+        return np.where(self.win, self.score(), -1)
+
+    def arrays(self):
+        return {"field": self.field, "angles": self.angles, "powers": self.powers, "win": self.win,
+                "collisions": self.collisions, "stop": self.stop, "simulated": self.simulated}
+
+    def image(self, pocket, size=PANEL_SIZE):
+        """Draws the landscape: cue angle goes right, cue value goes up. Winning shots are green, brighter for higher
+        scores, other shots are grey, darker for those that stop closer to the pocket.
+
+        :param pocket: position of the pocket.
+        :return: pygame.Surface.
+        """
+        score = self.score()
+        distance = np.sqrt(((self.stop - pocket) ** 2).sum(axis=2))
+        grey = 255 - 155 * np.exp(-distance / 100)
+        colors = np.stack((grey, grey, grey), axis=2)
+        colors[self.win] = np.stack((40 + 10 * score, 120 + 13 * score, 40 + 5 * score), axis=2)[self.win]
+        picture = pygame.surfarray.make_surface(colors[:, ::-1].astype(np.uint8))
+        return pygame.transform.scale(picture, size)
+
+
+def _simulate_chunk(args):
+    """Runs solver.simulate_shots in a worker process."""
+    map_data, angle, power, field = args
+    win, collisions, miss, ticks, stop = solver.simulate_shots(map_data, solver.shot_velocity(angle, power),
+                                                               np.full((len(angle), 1), field))
+    return win, collisions, stop
+
+
+def simulate(map_data, angle, power, field, pool=None, chunk=2048):
+    """Simulates shots given by arrays of cue angles and cue values, splitting them between processes of the pool.
+
+    :return: tuple of arrays (win, collisions, stop).
+    """
+    jobs = [(map_data, angle[i:i + chunk], power[i:i + chunk], field) for i in range(0, len(angle), chunk)]
+    if not jobs:
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=int), np.zeros((0, 2))
+    results = pool.map(_simulate_chunk, jobs) if pool is not None else [_simulate_chunk(job) for job in jobs]
+    return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+
+def refine(landscape, map_data, pool=None):
+    """Doubles resolution of the grid. Points between shots with different outcomes are simulated, the others take
+    the outcome of their neighbour.
+
+    :return: new Landscape.
+    """
+    n_angles, n_powers = landscape.win.shape
+    # point j of the new grid lies between points j // 2 and (j + 1) // 2 of the old one, angles go round
+    a = np.arange(2 * n_angles)
+    p = np.arange(2 * n_powers - 1)
+    a0, a1 = (a // 2)[:, None], ((a + 1) // 2 % n_angles)[:, None]
+    p0, p1 = (p // 2)[None, :], ((p + 1) // 2)[None, :]
+    outcome = landscape.outcome()
+    corner = outcome[a0, p0]
+    boundary = (outcome[a1, p0] != corner) | (outcome[a0, p1] != corner) | (outcome[a1, p1] != corner)
+    boundary &= (a[:, None] % 2 == 1) | (p[None, :] % 2 == 1)  # old points are already known
+
+    angles = np.arange(2 * n_angles) * np.pi / n_angles
+    powers = np.interp(p / 2, np.arange(n_powers), landscape.powers)
+    win, collisions, stop = landscape.win[a0, p0], landscape.collisions[a0, p0], landscape.stop[a0, p0]
+    simulated = landscape.simulated[a0, p0] & (a[:, None] % 2 == 0) & (p[None, :] % 2 == 0)
+    rows, columns = np.nonzero(boundary)
+    win[rows, columns], collisions[rows, columns], stop[rows, columns] = simulate(
+        map_data, angles[rows], powers[columns], landscape.field, pool)
+    simulated[rows, columns] = True
+    return Landscape(landscape.field, angles, powers, win, collisions, stop, simulated)
+
+
+def compute(map_data, field, refinements=1, processes=None):
+    """Computes the landscape of the level: the coarse grid, then refinements near boundaries of outcomes.
+
+    :return: Landscape.
+    """
+    angles = np.arange(ANGLES) * 2 * np.pi / ANGLES
+    powers = np.linspace(100 / POWERS, 100, POWERS)
+    angle, power = (axis.ravel() for axis in np.meshgrid(angles, powers, indexing="ij"))
+    # processes are spawned, not forked, so that they don't inherit pygame state of the process that asks for the
+    # landscape
+    pool = multiprocessing.get_context("spawn").Pool(processes) if processes != 1 else None
+    try:
+        win, collisions, stop = simulate(map_data, angle, power, field, pool)
+        landscape = Landscape(field, angles, powers, win.reshape(ANGLES, POWERS),
+                              collisions.reshape(ANGLES, POWERS), stop.reshape(ANGLES, POWERS, 2),
+                              np.ones((ANGLES, POWERS), dtype=bool))
+        for _ in range(refinements):
+            landscape = refine(landscape, map_data, pool)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return landscape
+
+
+def get(level, field, refinements=1, processes=None):
+    """
+    :return: landscape of the level from folder landscapes, it is computed and saved there if it is missing, older
+        than the level or has fewer refinements.
+    """
+    arrays = data.read_landscape(level, field)
+    if arrays is not None and len(arrays["angles"]) >= ANGLES * 2 ** refinements:
+        return Landscape(**{name: arrays[name] for name in ("angles", "powers", "win", "collisions", "stop",
+                                                            "simulated")}, field=float(arrays["field"]))
+    landscape = compute(data.read_map(level), field, refinements, processes)
+    data.save_landscape(level, field, landscape.arrays())
+    return landscape
+
+
+def save_picture(level, landscape):
+    """Saves the picture of the level with its landscape beside it to folder images/levels."""
+    panel = landscape.image(np.array(data.read_map(level)[1], dtype=float))
+    font = pygame.font.Font(None, 20)
+    thumbnail_path = os.path.join(os.path.dirname(__file__), "images", "levels", "level_" + str(level) + ".png")
+    thumbnail = pygame.image.load(thumbnail_path) if os.path.exists(thumbnail_path) else pygame.Surface((0, 0))
+    width, height = PANEL_SIZE
+    picture = pygame.Surface((thumbnail.get_width() + width + 40, height + 30))
+    picture.fill(pygame.Color("white"))
+    picture.blit(thumbnail, (0, (height - thumbnail.get_height()) // 2))
+    left = thumbnail.get_width() + 30
+    picture.blit(panel, (left, 0))
+    black = pygame.Color("black")
+    picture.blit(font.render("angle", True, black), (left + width // 2 - 15, height + 8))
+    picture.blit(font.render("0", True, black), (left, height + 8))
+    picture.blit(font.render("360", True, black), (left + width - 20, height + 8))
+    power = pygame.transform.rotate(font.render("power", True, black), 90)
+    picture.blit(power, (left - power.get_width() - 4, height // 2 - 20))
+    picture.blit(font.render(f"B = {landscape.field:g}", True, black), (4, height + 8))
+    pygame.image.save(picture, os.path.join(os.path.dirname(__file__), "images", "levels",
+                                            "landscape_" + str(level) + ".png"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Computes outcomes of shots of a level over cue angles and cue "
+                                                 "values with constant magnetic field and draws them beside the "
+                                                 "picture of the level.")
+    parser.add_argument("level", type=int, help="level number")
+    parser.add_argument("--field", type=float, default=0.0, help="magnetic field")
+    parser.add_argument("--refine", type=int, default=1, help="number of refinements near outcome boundaries")
+    parser.add_argument("--processes", type=int, help="number of worker processes, all cores by default")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    landscape = get(args.level, args.field, args.refine, args.processes)
+    pygame.font.init()
+    save_picture(args.level, landscape)
+    print(f"level {args.level}: {landscape.win.mean():.1%} of shots win, "
+          f"{(landscape.score() >= 8).mean():.1%} with a score of 8 or more, best score {landscape.score().max()}, "
+          f"{landscape.simulated.sum()} shots simulated in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
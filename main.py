@@ -3,12 +3,11 @@ import pygame_gui
 import game
 import data
 import numpy as np
-import webbrowser
+import profiler
+from constants import WINDOW_SIZE, WINDOW_WIDTH, WINDOW_HEIGHT, FPS, DT, BG_COLOR
 
-WINDOW_SIZE = WINDOW_WIDTH, WINDOW_HEIGHT = 800, 600
-FPS = 60
-DT = FPS / 100
-BG_COLOR = pygame.Color('white')
+IDLE_EVENT = pygame.USEREVENT + 1  # wakes up the main cycle when it waits for events
+IDLE_TIMEOUT = 250  # longest wait for events in milliseconds, so that menus still redraw now and then
 
 
 class Manager:
@@ -114,7 +113,8 @@ class Manager:
                                                         manager=self.manager,
                                                         object_id="menu_button")
         self.lb_managers = []
-        self.level_buttons = self.make_level_buttons()
+        # level buttons are made when level selection menu is opened for the first time
+        self.level_buttons = []
         self.new_level_button = pygame_gui.elements.UIButton(relative_rect=self.slb_rect[0],
                                                              text='New level',
                                                              manager=self.manager,
@@ -141,11 +141,16 @@ class Manager:
                                                            visible=0,
                                                            object_id="menu_button")
 
-    def make_level_pictures(self):
-        """Makes pictures of fields of all levels."""
-        for i in range(self.level_number):
-            game.Game(i + 1)
-            data.make_level_button_theme(i + 1)
+    def make_level_pictures(self, levels=None, force=False):
+        """Makes pictures of fields of the levels, if they are missing or older than the levels.
+
+        :param levels: numbers of levels, all levels by default.
+        :param force: if True, pictures are made even if they are up to date.
+        """
+        for level in levels or range(1, self.level_number + 1):
+            if force or data.level_picture_outdated(level):
+                game.Game(level)
+                data.make_level_button_theme(level)
 
     def make_level_buttons(self, hor=4, vert=3):
         """Makes buttons for all levels."""
@@ -168,11 +173,13 @@ class Manager:
 
     def process(self, screen):
         """Runs the game."""
+        profiler.frames.start_frame()
         self.handle_events()
 
         self.manager.update(DT)
         for manager in self.lb_managers:
             manager.update(DT)
+        profiler.frames.mark("gui")
 
         screen.fill(BG_COLOR)
 
@@ -189,11 +196,14 @@ class Manager:
             screen.blit(self.chaos_study.field, (0, 0))
             for i in range(3):
                 screen.blit(self.slider_values[i], (self.sliders_rect[i][0], self.sliders_rect[i][1] + 50))
+        profiler.frames.mark("draw")
 
         self.manager.draw_ui(screen)
         for manager in self.lb_managers:
             manager.draw_ui(screen)
         self.update_buttons()
+        profiler.frames.draw(screen)
+        profiler.frames.mark("gui")
 
     def handle_events(self):
         """Handles the events."""
@@ -201,6 +211,11 @@ class Manager:
         for event in events:
             if event.type == pygame.QUIT:
                 self.running = False
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_F3:
+                    profiler.frames.toggle()
+                elif event.key == pygame.K_F4 and profiler.frames.enabled:
+                    profiler.frames.export_csv("frame_times.csv")
             if event.type == pygame.USEREVENT:
                 if event.user_type == pygame_gui.UI_BUTTON_PRESSED:
                     if event.ui_element == self.credits_button:
@@ -247,6 +262,7 @@ class Manager:
                             self.update_value()
                 if event.user_type == pygame_gui.UI_TEXT_BOX_LINK_CLICKED:
                     if event.ui_element == self.text_box:
+                        import webbrowser
                         if event.link_target == 'chaos_1':
                             webbrowser.open_new_tab("https://www.youtube.com/watch?v=alvgk5N_U_o&list=WL&index=2")
                         elif event.link_target == 'credits':
@@ -254,18 +270,18 @@ class Manager:
             self.manager.process_events(event)
             for manager in self.lb_managers:
                 manager.process_events(event)
+        profiler.frames.mark("events")
 
         if not self.info_on:
             if self.game_on:
                 if not self.game.win:
                     self.game.update(events, DT)
-                else:
-                    self.win_game()
+                    if self.game.win:
+                        self.win_game()
             if self.chaos_on:
-                variables = [slider.get_current_value() for slider in self.sliders]
-                self.chaos_study.update(events, DT, variables)
+                self.chaos_study.update(events, DT, self.chaos_variables())
             if self.construction:
-                if not self.constructor.stage == 3:
+                if not self.constructor.stage == 3 or self.constructor.check is not None:
                     self.constructor.update(events)
 
     def main_menu(self):
@@ -296,12 +312,15 @@ class Manager:
         self.construction = False
         self.constructor = None
         self.chaos_on = False
+        self.leave_chaos_study()
         self.chaos_study = None
 
         self.delete_sliders()
 
     def select_level(self):
         """Actions after select level button was pushed."""
+        if not self.level_buttons:
+            self.level_buttons = self.make_level_buttons()
         self.main_menu_button.visible = 1
         self.main_menu_button.rect = self.mmb_rect[0]
         self.main_menu_button.rebuild()
@@ -322,6 +341,7 @@ class Manager:
         self.construction = False
         self.constructor = None
         self.chaos_on = False
+        self.leave_chaos_study()
         self.chaos_study = None
         self.delete_sliders()
 
@@ -374,7 +394,7 @@ class Manager:
 
     def win_game(self):
         """Actions after game was won."""
-        self.make_level_pictures()
+        self.make_level_pictures([self.game.level], force=True)
         self.level_buttons = self.make_level_buttons()
         self.main_menu_button.rect = self.mmb_rect[1]
         self.main_menu_button.rebuild()
@@ -387,7 +407,8 @@ class Manager:
         """Updates buttons."""
         if self.level_number < data.number_of_levels():
             self.level_number = data.number_of_levels()
-            self.level_buttons = self.make_level_buttons()
+            if self.level_buttons:
+                self.level_buttons = self.make_level_buttons()
 
     def start_chaos_study(self, level):
         """Actions before the chaos study begins."""
@@ -401,7 +422,7 @@ class Manager:
         for level_button in self.level_buttons:
             level_button.visible = 0
         self.chaos_on = True
-        self.chaos_study = game.ChaosStudy(level)
+        self.chaos_study = game.ChaosStudy(level, resume=True)
 
     def build_sliders(self):
         """Creates sliders."""
@@ -418,8 +439,8 @@ class Manager:
                                                                    manager=self.manager,
                                                                    visible=1))
         self.sliders.append(pygame_gui.elements.UIHorizontalSlider(relative_rect=self.sliders_rect[2],
-                                                                   start_value=10,
-                                                                   value_range=(1, 100),
+                                                                   start_value=1.0,
+                                                                   value_range=(0.0, 5.0),
                                                                    object_id="menu_button",
                                                                    manager=self.manager,
                                                                    visible=1))
@@ -431,13 +452,18 @@ class Manager:
             slider.kill()
             self.sliders = []
 
+    def chaos_variables(self):
+        """Returns values of the sliders. The number of balls slider is logarithmic, from 1 to 100000 balls."""
+        variables = [slider.get_current_value() for slider in self.sliders]
+        variables[2] = int(round(10 ** variables[2]))
+        return variables
+
     def update_value(self):
         """Updates text that shows the value of the slider."""
         texts = ["Coord", "Angle", "Balls"]
-        for i, slider in enumerate(self.sliders):
+        for i, value in enumerate(self.chaos_variables()):
             self.slider_values[i].fill(BG_COLOR)
             font = pygame.font.Font(None, 20)
-            value = slider.get_current_value()
             if i == 1:
                 value = value / np.pi * 180
             value = int(100 * value) / 100
@@ -451,13 +477,44 @@ class Manager:
         if self.game_on:
             self.game = game.Game(self.game.level)
         elif self.chaos_on:
+            self.leave_chaos_study()
             self.chaos_study = game.ChaosStudy(self.chaos_study.level)
         elif self.construction:
             self.constructor = game.Constructor(self.level_number + 1)
 
+    def is_idle(self):
+        """
+        :return: True if nothing moves on the screen, so frames only need to be drawn when events come.
+        """
+        if self.game_on and not self.info_on:
+            return self.game.is_idle()
+        if self.chaos_on and not self.info_on:
+            return self.chaos_study.is_idle()
+        if self.construction and not self.info_on:
+            return self.constructor.is_idle()
+        return True
+
+    def leave_chaos_study(self):
+        """Saves the chaos study, if there is one, so that it is resumed next time it is started."""
+        if self.chaos_study is not None:
+            self.chaos_study.close()
+
+
+def wait_for_event(timeout):
+    """Sleeps until an event comes or timeout milliseconds pass. The event is left in the queue.
+
+    pygame.event.wait can't be given a timeout in pygame 1.9, so a timer event ends the wait.
+    """
+    pygame.time.set_timer(IDLE_EVENT, timeout)
+    event = pygame.event.wait()
+    pygame.time.set_timer(IDLE_EVENT, 0)
+    if event.type != IDLE_EVENT:
+        pygame.event.post(event)
+
 
 def main():
-    """Creates main cycle and the screen. Calls manager."""
+    """Creates main cycle and the screen. Calls manager. While nothing moves, the cycle sleeps until an event comes
+    instead of drawing FPS frames a second."""
     pygame.init()
     screen = pygame.display.set_mode(WINDOW_SIZE)
     pygame.scrap.init()
@@ -468,13 +525,18 @@ def main():
     running = True
 
     while running:
+        if manager.is_idle():
+            wait_for_event(IDLE_TIMEOUT)
         clock.tick(FPS)
 
         manager.process(screen)
         running = manager.running
 
         pygame.display.update()
+        profiler.frames.mark("display")
+        profiler.frames.end_frame()
 
+    manager.leave_chaos_study()
     pygame.quit()
 
 
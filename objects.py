@@ -1,6 +1,7 @@
 import pygame
 import numpy as np
 import os
+import physics
 
 
 class Ball(pygame.sprite.Sprite):
@@ -14,7 +15,7 @@ class Ball(pygame.sprite.Sprite):
         prev_pos numpy(int, int): center coordinates at previous moment of time.
         color (pygame.Color) - color of the ball.
 
-        image: image of the ball.
+        image: image of the ball, shared by all balls of the same radius and color.
         rect: rectangle, that contains the ball.
     """
     def __init__(self, group, radius, pos, color=pygame.Color("white")):
@@ -26,8 +27,7 @@ class Ball(pygame.sprite.Sprite):
         self.prev_pos = np.zeros(2, dtype=float)
         self.color = color
 
-        self.image = pygame.Surface((2 * radius, 2 * radius), pygame.SRCALPHA)
-        pygame.draw.circle(self.image, color, (radius, radius), radius)
+        self.image = ball_image(radius, color)
         self.rect = self.image.get_rect(center=self.pos.astype(int))
 
     def vel_value(self):
@@ -41,18 +41,168 @@ class Ball(pygame.sprite.Sprite):
         :param friction: friction coefficient with the table.
         :param dt: time step.
         """
-        b = np.array([0, 0, b])
         self.prev_pos = self.pos
-        self.pos = self.pos + self.vel * dt
-        vel_abs = np.linalg.norm(self.vel)
         self.prev_vel = self.vel
-        self.vel = self.vel + np.resize(np.cross(self.vel, b), 2) * dt
-        if np.linalg.norm(self.vel) != 0:
-            self.vel = self.vel / np.linalg.norm(self.vel) * vel_abs
-            self.vel -= friction * self.vel / np.linalg.norm(self.vel) * dt
+        x, y, vx, vy = physics.step(*self.pos.tolist(), *self.vel.tolist(), b, friction, dt)
+        self.pos = np.array([x, y])
+        self.vel = np.array([vx, vy])
         self.rect = self.image.get_rect(center=self.pos.astype(int))
 
 
+class Ensemble:
+    """Many balls of the same radius that move together. Their state is kept in arrays, so that they are moved and
+    drawn without going through balls one by one.
+
+    Attributes:
+        radius: radius of the balls.
+        pos numpy(n, 2): center coordinates.
+        vel numpy(n, 2): velocities.
+        prev_pos numpy(n, 2): center coordinates at previous moment of time.
+        colors: list of pygame.Color that balls can have.
+        color_index numpy(n): number of the color of each ball in colors.
+
+        images: images of balls for each color.
+        color_values numpy(k, 3): colors as an array, used to draw balls as points.
+    """
+    def __init__(self, radius, pos, colors, color_index):
+        self.radius = radius
+        self.pos = np.array(pos, dtype=float).reshape(-1, 2)
+        self.vel = np.zeros_like(self.pos)
+        self.prev_pos = self.pos.copy()
+        self.colors = colors
+        self.color_index = np.array(color_index, dtype=int)
+
+        self.images = [ball_image(radius, color) for color in colors]
+        self.color_values = np.array([tuple(color)[:3] for color in colors], dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def color(self, i):
+        return self.colors[self.color_index[i]]
+
+    def vel_value(self, i=0):
+        """Returns absolute value of a velocity of the ball number i"""
+        return float((self.vel[i] ** 2).sum() ** 0.5)
+
+    def update(self, b, friction, dt, field_map=None):
+        """Updates positions and velocities of moving balls as Ball.update does.
+
+        :param b: magnetic field.
+        :param friction: friction coefficient with the table.
+        :param dt: time step.
+        :param field_map: physics.FieldMap if the field changes across the table, then b is multiplied by its value
+            at each ball.
+        """
+        self.pos, self.vel, self.prev_pos = physics.advance_many(self.pos, self.vel, self.prev_pos, b, friction, dt,
+                                                                 field_map)
+
+    def collide(self, segments, collisions=None, number=0, first_ball=0):
+        """Calculates collisions of moving balls with a polygon as Obstacle.collide does.
+
+        :param segments: sides of the polygon made by physics.make_segment_array.
+        :param collisions: collisions.CollisionBus to which collisions are added.
+        :param number: number of the polygon in collisions.
+        :param first_ball: number of the first ball of the ensemble in collisions.
+        :return: numbers of balls that collided the polygon.
+        """
+        vel = self.vel
+        balls, point, vertex_num, self.pos, self.vel = physics.collide_moving(segments, self.radius, self.pos,
+                                                                              self.vel, self.prev_pos)
+        if collisions is not None:
+            collisions.emit_many(balls + first_ball, number, vertex_num, point, vel[balls], self.vel[balls])
+        return balls
+
+    def collide_balls(self, collisions=None):
+        """Calculates elastic collisions of the balls with each other.
+
+        :param collisions: collisions.CollisionBus to which collisions are added.
+        :return: arrays with numbers of balls that collided in pairs.
+        """
+        vel = self.vel
+        first, second, self.vel = physics.collide_balls(self.pos, self.vel, self.radius)
+        if collisions is not None and len(first):
+            collisions.emit_pairs(first, second, self.pos, vel, self.vel)
+        return first, second
+
+    def keep(self, mask):
+        """Removes balls for which mask is False."""
+        self.pos, self.vel, self.prev_pos = self.pos[mask], self.vel[mask], self.prev_pos[mask]
+        self.color_index = self.color_index[mask]
+
+    def draw(self, surface):
+        """Blits images of the balls on the surface."""
+        images = self.images
+        surface.blits(list(zip([images[i] for i in self.color_index.tolist()], (self.pos - self.radius).tolist())),
+                      doreturn=False)
+
+    def draw_points(self, surface, size=2):
+        """Draws each ball as a square of size x size pixels right in the pixels of the surface. It takes the same
+        time for any number of balls, so it is used when there are too many balls to blit their images.
+        """
+        width, height = surface.get_size()
+        x, y = self.pos[:, 0].astype(int), self.pos[:, 1].astype(int)
+        inside = (x >= 0) & (x <= width - size) & (y >= 0) & (y <= height - size)
+        x, y = x[inside], y[inside]
+        colors = self.color_values[self.color_index[inside]]
+        pixels = pygame.surfarray.pixels3d(surface)
+        for dx in range(size):
+            for dy in range(size):
+                pixels[x + dx, y + dy] = colors
+        del pixels  # unlocks the surface
+
+
+class DensityMap:
+    """Shows where balls spend time. Positions of balls are added to a buffer of the size of the field each tick,
+    and the buffer fades exponentially, so old parts of trajectories disappear.
+
+    Attributes:
+        density numpy(width, height): accumulated density, float32.
+        decay: factor by which the density is multiplied each tick.
+        colormap numpy(256, 3): colors for density levels from zero to the maximum. Zero is black, which is
+            transparent on the image.
+        image: 8 bit surface with density levels, colored through its palette.
+    """
+    def __init__(self, size, decay=0.98, alpha=180):
+        self.density = np.zeros(size, dtype=np.float32)
+        self.decay = np.float32(decay)
+
+        level = np.linspace(0, 1, 256)[:, None]
+        self.colormap = (255 * np.clip(3 * level - np.arange(3), 0, 1)).astype(np.uint8)  # black, red, yellow, white
+        self.image = pygame.Surface(size, 0, 8)
+        self.image.set_palette([tuple(color) for color in self.colormap.tolist()])
+        self.image.set_colorkey(0)
+        self.image.set_alpha(alpha)
+
+    def clear(self):
+        self.density[:] = 0
+
+    def add(self, pos):
+        """Fades the density and adds balls at the given positions.
+
+        :param pos: array of shape (n, 2) with coordinates of balls.
+        """
+        self.density *= self.decay
+        width, height = self.density.shape
+        x, y = pos[:, 0].astype(int), pos[:, 1].astype(int)
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        cells = x[inside] * height + y[inside]
+        if len(cells) < self.density.size // 64:
+            # few balls are added one by one, counting them takes as long as the whole field
+            np.add.at(self.density.reshape(-1), cells, 1)
+        else:
+            self.density += np.bincount(cells, minlength=width * height).reshape(width, height)
+
+    def draw(self, surface):
+        """Colors the density and blits it on the surface."""
+        top = self.density.max()
+        if top == 0:
+            return
+        level = np.sqrt(self.density * np.float32(255 ** 2 / top)).astype(np.uint8)
+        pygame.surfarray.blit_array(self.image, level)
+        surface.blit(self.image, (0, 0))
+
+
 class Cue(pygame.sprite.Sprite):
     """Handles how user hits the ball.
 
@@ -130,8 +280,18 @@ class Pocket(pygame.sprite.Sprite):
         pygame.draw.circle(self.image, pygame.Color("black"), (radius, radius), radius)
         self.rect = self.image.get_rect(center=pos)
 
-    def check_win(self, ball_pos):
-        return ((ball_pos - self.pos) ** 2).sum() <= self.radius ** 2
+    def check_win(self, ball_pos, prev_pos=None):
+        """
+        :param prev_pos: position of the ball before the last time step. If it is given, the ball wins if it has passed
+            over the pocket during the step, not only if it has stopped there, so fast balls don't jump over it.
+        """
+        if prev_pos is None:
+            return ((ball_pos - self.pos) ** 2).sum() <= self.radius ** 2
+        return physics.segment_distance(*prev_pos.tolist(), *ball_pos.tolist(), *self.pos) <= self.radius
+
+    def check_win_many(self, pos, prev_pos):
+        """Does the same as check_win for arrays of positions of many balls."""
+        return physics.segment_distance_many(prev_pos, pos, np.asarray(self.pos, dtype=float)) <= self.radius
 
 
 class Obstacle(pygame.sprite.Sprite):
@@ -145,6 +305,8 @@ class Obstacle(pygame.sprite.Sprite):
         vertices (array of tuples (int, int)): vertices of a polygon.
 
         tangent, normal: arrays containing tangent and normal unit vectors for each side of the polygon.
+        segments: sides of the polygon prepared for physics.collide.
+        segment_array: sides of the polygon prepared for physics.collide_many.
         polygon_rect: rectangle, containing the polygon.
     """
     def __init__(self, group, window_size, vertices,
@@ -158,6 +320,8 @@ class Obstacle(pygame.sprite.Sprite):
                                      np.linalg.norm(self.vertices[i - 1] - self.vertices[i])
                                      for i in range(len(self.vertices))])
             self.normal = np.array([[self.tangent[i][1], -self.tangent[i][0]] for i in range(len(self.vertices))])
+            self.segments = physics.make_segments(self.vertices)
+            self.segment_array = physics.make_segment_array(self.vertices)
 
         self.fill_color = fill_color
         self.border_color = border_color
@@ -170,93 +334,27 @@ class Obstacle(pygame.sprite.Sprite):
             pygame.draw.line(self.image, border_color, vertices[0], vertices[1], 1)
         self.rect = self.image.get_rect(topleft=(0, 0))
 
-    def collide(self, ball):
+    def collide(self, ball, collisions=None, number=0, ball_number=0):
         """Calculates a collision between the ball and the obstacle.
 
         :param ball: a ball, for which the collision is calculated.
-        :return: If the collision happened returns an array, which consists of True constant, point where the ball
-            collided the obstacle and number of a vertex which is one of the ends of the side of the obstacle with which
-            the ball collided. If the collision didn't happen returns an array which consists of False constant.
+        :param collisions: collisions.CollisionBus to which the collision is added. It has the point where the ball
+            collided the obstacle and number of a vertex which is one of the ends of the side of the obstacle with
+            which the ball collided.
+        :param number: number of the obstacle in collisions.
+        :param ball_number: number of the ball in collisions.
+        :return: True if the collision happened.
         """
-        distance = np.infty
-        # point where the collision happens
-        point = np.zeros(2, dtype=float)
-        for i in range(len(self.vertices)):
-            r_1 = self.vertices[i] - ball.pos
-            r_2 = self.vertices[i-1] - ball.pos
-            if np.dot(r_1, self.tangent[i])*np.dot(r_2, self.tangent[i]) < 0:  # if the ball is going to hit an edge
-                dist = abs(np.dot(r_1, self.normal[i]))
-                if dist < distance and dist < ball.radius:
-                    # calculate the normal with correct direction
-                    r_perp = - np.dot(self.normal[i], r_1) * self.normal[i]
-                    r_perp = r_perp / np.linalg.norm(r_perp)
-                    if np.linalg.norm(ball.vel) > 0:
-                        p, v = self.calc_new_state(ball, r_perp, dist)
-                    else:
-                        p = ball.pos - dist * r_perp
-                        v = np.zeros(2)
-                    n = r_perp
-                    point = p
-                    velocity = v
-                    distance = dist
-                    normal = n
-                    vertex_num = i
-            else:  # if the ball is going to hit a vertex
-                dist = min(np.linalg.norm(r_1), np.linalg.norm(r_2))
-                if dist < distance and dist < ball.radius:
-                    distance = dist
-                    if dist == np.linalg.norm(r_1):
-                        p = self.vertices[i]
-                    else:
-                        p = self.vertices[i-1]
-                    n = (ball.pos - p) / np.linalg.norm(ball.pos - p)
-                    v = self.flip_vel(n, ball.vel)
-                    point = p
-                    velocity = v
-                    normal = n
-                    vertex_num = i
-        if distance > ball.radius:
-            return [False]
-        ball.pos = point + normal * ball.radius
-        ball.vel = velocity
-        return [True, point, vertex_num]
-
-    def flip_vel(self, axis, vel, coef_perp=1, coef_par=1):
-        """Changes the velocity of the ball as if it collided inelastically with a wall with normal vector "axis". """
-        axis = np.array(axis)
-        axis = axis / np.linalg.norm(axis)
-        vel_perp = vel.dot(axis) * axis
-        vel_par = vel - vel_perp
-        vel = -vel_perp * coef_perp + vel_par * coef_par
-        return vel
-
-    def calc_new_state(self, ball, r_perp, dist):
-        """Calculates the point where the ball hit the obstacle."""
-        gamma = np.arccos(np.dot(r_perp, ball.vel / np.linalg.norm(ball.vel))) - np.pi/2
-        d_pos = ball.pos - ball.prev_pos
-        cos_beta = np.dot(ball.vel / np.linalg.norm(ball.vel), d_pos / np.linalg.norm(d_pos))
-        if cos_beta > 1:
-            cos_beta = 1
-        elif cos_beta < -1:
-            cos_beta = -1
-        vec = ball.vel / np.linalg.norm(ball.vel)
-        if abs(cos_beta) != 1:  # If magnetic field is on
-            radius = np.linalg.norm(d_pos)/(2*(1-cos_beta**2)**0.5)  # Radius of the trajectory (which is a circle)
-
-            if abs(np.cos(gamma) - (ball.radius - dist)/radius) <= 1:
-                alpha = (np.arccos(np.cos(gamma) - (ball.radius - dist)/radius) - gamma) / 2
-                rot = np.array([[np.cos(alpha), -np.sin(alpha)], [np.sin(alpha), np.cos(alpha)]])
-                vec = np.dot(rot, vec)
-                p = ball.pos - vec * 2 * radius * np.sin(alpha) - ball.radius * r_perp
-                v = np.linalg.norm(ball.vel) * np.dot(rot, vec)
-                v = self.flip_vel(r_perp, v)
-            else:
-                p = np.zeros(2)
-                v = np.zeros(2)
-        else:
-            p = ball.pos - vec * (ball.radius - dist) / np.sin(gamma) - r_perp * ball.radius
-            v = self.flip_vel(r_perp, ball.vel)
-        return p, v
+        hit = physics.collide(self.segments, ball.radius, *ball.pos.tolist(), *ball.vel.tolist(),
+                              *ball.prev_pos.tolist())
+        if hit is None:
+            return False
+        point_x, point_y, vertex_num, x, y, vx, vy = hit
+        if collisions is not None:
+            collisions.emit(ball_number, number, vertex_num, (point_x, point_y), ball.vel, (vx, vy))
+        ball.pos = np.array([x, y])
+        ball.vel = np.array([vx, vy])
+        return True
 
 
 class MagneticField:
@@ -340,6 +438,60 @@ class MagneticField:
         self.image, self.rect = self.create_image()
 
 
+ball_images = {}
+
+
+def ball_image(radius, color):
+    """Returns image of a ball from the atlas of ball images. Image is drawn once for each radius and color, so any
+    number of balls takes memory only for different images.
+    """
+    key = (radius, tuple(pygame.Color(color)))
+    image = ball_images.get(key)
+    if image is None:
+        image = pygame.Surface((2 * radius, 2 * radius), pygame.SRCALPHA)
+        pygame.draw.circle(image, color, (radius, radius), radius)
+        ball_images[key] = image
+    return image
+
+
+def field_map_image(field_map, edge, size, cell=4):
+    """Draws magnetic field that changes across the table: inside the edge of the table each cell x cell square is
+    tinted blue where the field has the direction set by player and red where it is opposite. The stronger the field,
+    the brighter the tint.
+
+    :param field_map: physics.FieldMap.
+    :param edge: vertices of the edge of the table.
+    :return: transparent surface of the given size.
+    """
+    width, height = size[0] // cell, size[1] // cell
+    x, y = np.meshgrid((np.arange(width) + 0.5) * cell, (np.arange(height) + 0.5) * cell, indexing="ij")
+    centers = np.stack((x.ravel(), y.ravel()), axis=1)
+    value = field_map.sample_many(centers)
+    alpha = np.clip(np.abs(value) / 2, 0, 1) * 90
+    alpha[~physics.inside_polygon(centers, physics.make_segment_array(edge))] = 0
+
+    image = pygame.Surface((width, height), pygame.SRCALPHA)
+    colors = np.where((value >= 0)[:, None], [0, 0, 160], [200, 0, 0]).reshape(width, height, 3)
+    pygame.surfarray.blit_array(image, colors)
+    pixels = pygame.surfarray.pixels_alpha(image)
+    pixels[:] = alpha.reshape(width, height).astype(np.uint8)
+    del pixels  # unlocks the surface
+    return pygame.transform.scale(image, (width * cell, height * cell))
+
+
+def palette(number):
+    """Makes colors with evenly spaced hues.
+
+    :return: list of pygame.Color.
+    """
+    colors = []
+    for i in range(number):
+        color = pygame.Color(0, 0, 0)
+        color.hsva = (360 * i / number, 100 - 30 * (i % 2), 90 - 20 * (i // 2 % 2), 100)
+        colors.append(color)
+    return colors
+
+
 def rotate(surface, angle, pivot, offset):
     """Rotate the surface around the pivot point.
     Args:
@@ -0,0 +1,275 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import data
+import physics
+import solver
+from constants import DT
+
+
+class BoundaryMap:
+    """Map of Poincare section of a level to itself: takes coordinates of a bounce off the edge of the table (distance
+    along the edge and cosine of the angle between velocity and the side, as ChaosStudy plots them) and gives those of
+    the next bounce. Balls move without friction in uniform magnetic field, physics.fly moves them along exact circles.
+
+    Attributes:
+        vertices: vertices of the edge.
+        polygons: sides of the edge and obstacles made by physics.make_segment_array.
+        radius: radius of the ball.
+        kappa: curvature of trajectories.
+        perimeter: length of the edge, distance coordinate is periodic with it.
+    """
+    def __init__(self, map_data, b, speed, dt=DT, radius=solver.BALL_RADIUS):
+        """
+        :param b: magnetic field.
+        :param speed: absolute value of velocity of the ball, radius of trajectories depends on it.
+        """
+        if map_data[4] is not None:
+            raise ValueError("periodic orbits can only be found in uniform magnetic field")
+        self.vertices = np.asarray(map_data[2], dtype=float)
+        self.polygons = [physics.make_segment_array(map_data[2])] + \
+                        [physics.make_segment_array(obstacle) for obstacle in map_data[3]]
+        self.radius = radius
+        self.kappa = physics.curvature(speed, b, dt)
+        self.perimeter = np.linalg.norm(self.vertices - np.roll(self.vertices, 1, axis=0), axis=1).sum()
+
+    def __call__(self, length, angles):
+        """
+        :param length, angles: arrays with coordinates of bounces.
+        :return: tuple (ok, length, angles, side) of arrays, where side is the number of the side as in
+            physics.collide_many. ok is False if the ball can't be at such a point (it would overlap a side near a
+            corner) or doesn't return to the edge.
+        """
+        pos, vel, _ = physics.section_state(self.vertices, self.radius, length, angles)
+        ok = np.all([physics.polygon_distance(pos, segments) > self.radius * (1 - 1e-9)
+                     for segments in self.polygons], axis=0)
+        hit, point, side, pos, vel = physics.bounce_map(self.polygons, self.radius, pos[ok], vel[ok], self.kappa)
+        new_length, new_angles, new_side = np.full(len(ok), np.nan), np.full(len(ok), np.nan), np.zeros(len(ok), int)
+        new_length[ok], new_angles[ok] = physics.section_coords(self.vertices, point, side, vel)
+        new_side[ok] = side
+        ok[ok] = hit
+        return ok, new_length, new_angles, new_side
+
+    def iterate(self, length, angles, times):
+        """Applies the map several times.
+
+        :return: tuple (ok, length, angles) of arrays of shape (times + 1, n) with all bounces on the way, ok is False
+            for all bounces after a failed one, and tuple of arrays with the numbers of sides.
+        """
+        length, angles = np.asarray(length, dtype=float), np.asarray(angles, dtype=float)
+        ok = [np.ones(len(length), dtype=bool)]
+        points = [(length, angles)]
+        sides = []
+        for _ in range(times):
+            step_ok, length, angles, side = self(length, angles)
+            ok.append(ok[-1] & step_ok)
+            points.append((np.where(ok[-1], length, 0.0), np.where(ok[-1], angles, 0.0)))
+            length, angles = points[-1]
+            sides.append(side)
+        length, angles = (np.array(coords) for coords in zip(*points))
+        return np.array(ok), length, angles, tuple(sides)
+
+    def residual(self, z, period):
+        """
+        :param z: array of shape (n, 2) with coordinates of bounces.
+        :return: tuple (ok, difference between z and the coordinates after period bounces) of arrays, the distance is
+            taken along the shorter way around the edge.
+        """
+        ok, length, angles, _ = self.iterate(z[:, 0], z[:, 1], period)
+        r = np.stack((length[-1], angles[-1]), axis=1) - z
+        r[:, 0] = self.wrap(r[:, 0])
+        return ok[-1], r
+
+    def wrap(self, length):
+        """
+        :return: differences of distances along the edge taken along the shorter way around it.
+        """
+        return (length + self.perimeter / 2) % self.perimeter - self.perimeter / 2
+
+    def jacobian(self, z, period, steps=(1e-4, 1e-7), central=False):
+        """Finds derivatives of the period-th power of the map by finite differences.
+
+        :return: tuple (ok, residual, jacobian), jacobian has shape (n, 2, 2).
+        """
+        n = len(z)
+        shifts = [np.zeros(2)] + [np.eye(2)[i] * steps[i] for i in range(2)]
+        if central:
+            shifts += [-np.eye(2)[i] * steps[i] for i in range(2)]
+        ok, r = self.residual(np.concatenate([z + shift for shift in shifts]), period)
+        ok = ok.reshape(len(shifts), n).all(axis=0)
+        r = r.reshape(len(shifts), n, 2)
+        # residual already has z subtracted, derivatives of the map itself get the identity back
+        columns = []
+        for i in range(2):
+            difference = r[1 + i] - (r[3 + i] if central else r[0])
+            difference[:, 0] = self.wrap(difference[:, 0])
+            columns.append(difference / (steps[i] * (2 if central else 1)))
+        return ok, r[0], np.stack(columns, axis=2) + np.eye(2)
+
+
+class Orbit:
+    """Describes a periodic orbit of the ball.
+
+    Attributes:
+        period: number of bounces off the edge after which the ball comes back to the same state.
+        length: array of distances along the edge of the bounces.
+        angles: array of cosines of the angles of the bounces.
+        sides: numbers of the sides of the bounces.
+        trace: trace of the derivative of the map over one period. The map keeps area, so the orbit is stable
+            (elliptic) if the trace is less than 2 by absolute value and unstable (hyperbolic) if it is more.
+        lyapunov: Lyapunov exponent per bounce, 0 for stable orbits.
+    """
+    def __init__(self, period, length, angles, sides, trace, lyapunov):
+        self.period = period
+        self.length = length
+        self.angles = angles
+        self.sides = sides
+        self.trace = trace
+        self.lyapunov = lyapunov
+
+    def kind(self):
+        if abs(abs(self.trace) - 2) < 1e-6:
+            return "parabolic"
+        return "elliptic" if abs(self.trace) < 2 else "hyperbolic"
+
+    def __repr__(self):
+        points = ", ".join(f"({length:.2f}, {angle:.4f})" for length, angle in zip(self.length, self.angles))
+        return (f"Orbit(period={self.period}, {self.kind()}, trace={self.trace:.4f}, lyapunov={self.lyapunov:.4f}, "
+                f"points=[{points}])")
+
+
+def seed_grid(perimeter, seeds):
+    """
+    :return: array of shape (about seeds, 2) with points spread evenly over Poincare section.
+    """
+    rows = max(int(np.sqrt(seeds)), 1)
+    columns = max(seeds // rows, 1)
+    length = (np.arange(columns) + 0.5) * perimeter / columns
+    angles = (np.arange(rows) + 0.5) * 2 / rows - 1
+    return np.stack([axis.ravel() for axis in np.meshgrid(length, angles)], axis=1)
+
+
+def newton(boundary_map, z, period, iterations=40, tolerance=1e-9):
+    """Refines approximate fixed points of the period-th power of the map by Newton's method, all at once.
+
+    :return: tuple (converged, z).
+    """
+    z = z.copy()
+    active = np.arange(len(z))
+    converged = np.zeros(len(z), dtype=bool)
+    limit = np.array([boundary_map.perimeter / 20, 0.1])
+    for _ in range(iterations):
+        if len(active) == 0:
+            break
+        ok, r, jacobian = boundary_map.jacobian(z[active], period)
+        done = ok & (np.abs(r[:, 0]) < tolerance * boundary_map.perimeter) & (np.abs(r[:, 1]) < tolerance)
+        converged[active[done]] = True
+        keep = ok & ~done
+        active, r, jacobian = active[keep], r[keep], jacobian[keep]
+        # pseudo-inverse, because orbits in a table without field come in families, where the matrix is singular
+        step = -np.einsum("nij,nj->ni", np.linalg.pinv(jacobian - np.eye(2), rcond=1e-12), r)
+        step /= np.maximum(np.abs(step / limit).max(axis=1), 1)[:, None]
+        z[active] += step
+        z[active, 0] %= boundary_map.perimeter
+        inside = np.abs(z[active, 1]) < 1
+        active = active[inside]
+    return converged, z
+
+
+def find_orbits(boundary_map, period, seeds=4000, candidates=400):
+    """Finds periodic orbits by shooting from a grid of points on Poincare section: the points that come back closest
+    to themselves after period bounces are refined by Newton's method.
+
+    :param period: number of bounces, only orbits whose smallest period is this are returned.
+    :param seeds: number of points in the grid.
+    :param candidates: number of the best points that are refined.
+    :return: list of Orbit objects.
+    """
+    z = seed_grid(boundary_map.perimeter, seeds)
+    ok, r = boundary_map.residual(z, period)
+    distance = np.where(ok, np.abs(r[:, 0]) / boundary_map.perimeter + np.abs(r[:, 1]), np.inf)
+    best = np.argsort(distance)[:candidates]
+    converged, z = newton(boundary_map, z[best[np.isfinite(distance[best])]], period)
+    z = z[converged]
+    if len(z) == 0:
+        return []
+    ok, length, angles, sides = boundary_map.iterate(z[:, 0], z[:, 1], period)
+    ok, _, jacobian = boundary_map.jacobian(z, period, central=True)
+
+    orbits = []
+    for i in np.flatnonzero(ok):
+        points = np.stack((length[:period, i], angles[:period, i]), axis=1)
+        difference = np.abs(points[1:] - points[0])
+        difference[:, 0] = np.abs(boundary_map.wrap(difference[:, 0])) / boundary_map.perimeter
+        if (difference.max(axis=1) < 1e-6).any():
+            continue  # the smallest period is a divisor of period
+        trace = float(np.trace(jacobian[i]))
+        orbit_sides = tuple(int(side[i]) for side in sides)
+        orbit = Orbit(period, points[:, 0], points[:, 1], orbit_sides, trace,
+                      np.log(max(np.abs(np.linalg.eigvals(jacobian[i])))) / period if abs(trace) > 2 else 0.0)
+        if not any(same_orbit(boundary_map, orbit, other) for other in orbits):
+            orbits.append(orbit)
+    return orbits
+
+
+def same_orbit(boundary_map, orbit, other, tolerance=1e-5):
+    """
+    :return: True if the orbits pass through the same points. Parabolic orbits make families, where neighbouring
+        orbits bounce off the same sides, one orbit of each family is enough.
+    """
+    if orbit.period != other.period:
+        return False
+    if orbit.kind() == other.kind() == "parabolic" and sorted(orbit.sides) == sorted(other.sides):
+        return True
+    difference = np.abs(boundary_map.wrap(orbit.length[:, None] - other.length[None, :])) / boundary_map.perimeter
+    difference += np.abs(orbit.angles[:, None] - other.angles[None, :])
+    return bool((difference.min(axis=1) < tolerance).all())
+
+
+def draw(boundary_map, orbits):
+    """Draws orbits on Poincare section: stable ones in green, unstable ones in red."""
+    import matplotlib.pyplot as plt
+    plot = plt.figure()
+    section = plot.add_subplot(111)
+    section.set_ylim(-1.05, 1.05)
+    section.set_xlim(0, boundary_map.perimeter)
+    section.set_xlabel("$\\xi $")
+    section.set_ylabel("$\\cos \\varphi$")
+    section.set_title("Periodic orbits")
+    colors = {"elliptic": "green", "hyperbolic": "red", "parabolic": "blue"}
+    for orbit in orbits:
+        section.scatter(orbit.length, orbit.angles, color=colors[orbit.kind()], s=20)
+        for length, angle in zip(orbit.length, orbit.angles):
+            section.annotate(str(orbit.period), (length, angle), fontsize=8)
+    plt.show()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Finds periodic orbits of the ball on Poincare section of a level, "
+                                                 "as ChaosStudy shows it, and their stability.")
+    parser.add_argument("level", type=int, help="level number")
+    parser.add_argument("--field", type=float, default=0.05, help="magnetic field")
+    parser.add_argument("--speed", type=float, default=10, help="absolute value of velocity of the ball")
+    parser.add_argument("--periods", type=int, default=4, help="orbits with periods from 1 to this are found")
+    parser.add_argument("--seeds", type=int, default=4000, help="number of starting points for each period")
+    parser.add_argument("--plot", action="store_true", help="draw the orbits on Poincare section")
+    args = parser.parse_args()
+
+    boundary_map = BoundaryMap(data.read_map(args.level), args.field, args.speed)
+    orbits = []
+    for period in range(1, args.periods + 1):
+        start = time.perf_counter()
+        found = find_orbits(boundary_map, period, args.seeds)
+        print(f"period {period}: {len(found)} orbits in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+        for orbit in found:
+            print(orbit)
+        orbits += found
+    if args.plot:
+        draw(boundary_map, orbits)
+
+
+if __name__ == "__main__":
+    main()
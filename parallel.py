@@ -0,0 +1,196 @@
+import multiprocessing
+import os
+import threading
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import physics
+
+# arrays kept in shared memory: name, number of columns, type and if there is a row for each polygon
+ARRAYS = (("pos", 2, np.float64, False), ("vel", 2, np.float64, False), ("prev_pos", 2, np.float64, False),
+          ("hit_point", 2, np.float64, True), ("hit_vel_in", 2, np.float64, True), ("hit_vel", 2, np.float64, True),
+          ("hit_vertex", 1, np.int64, True))
+CONTROL = 4  # magnetic field, friction, time step and 1 while workers should keep running
+STEP_TIMEOUT = 10  # seconds a step may take before workers are given up, the first one includes starting them
+
+
+def default_processes():
+    """
+    :return: number of worker processes to use, all cores but one, which is left for drawing.
+    """
+    return max((os.cpu_count() or 1) - 1, 1)
+
+
+def shared_arrays(buffer, n, polygons=1):
+    """Makes arrays of the ensemble state on top of a buffer without copying it.
+
+    :param buffer: buffer of a shared memory block of at least shared_size(n, polygons) bytes.
+    :param n: number of balls.
+    :param polygons: number of polygons balls collide with, arrays of collisions have a row for each of them.
+    :return: dictionary of arrays, with "control" array of CONTROL values among them. It comes first in the buffer, so
+        it can be found without knowing n.
+    """
+    arrays = {"control": np.ndarray(CONTROL, dtype=np.float64, buffer=buffer)}
+    offset = CONTROL * 8
+    for name, columns, dtype, per_polygon in ARRAYS:
+        shape = (n, polygons) if per_polygon else (n,)
+        if columns > 1:
+            shape += (columns,)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset)
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return arrays
+
+
+def shared_size(n, polygons=1):
+    return sum(n * (polygons if per_polygon else 1) * columns * np.dtype(dtype).itemsize
+               for name, columns, dtype, per_polygon in ARRAYS) + CONTROL * 8
+
+
+def step_part(arrays, part, polygons, radius, field_map, b, friction, dt):
+    """Moves balls of a part of the ensemble during one time step and collides them with polygons as ChaosStudy does.
+    Collisions with each polygon are saved in its row of hit_point, hit_vel_in, hit_vel and hit_vertex, hit_vertex is
+    -1 for balls that didn't hit it.
+
+    :param arrays: arrays made by shared_arrays.
+    :param part: slice of balls to move.
+    :param polygons: sides of the polygons made by physics.make_segment_array.
+    """
+    pos, vel, prev_pos = physics.advance_many(arrays["pos"][part], arrays["vel"][part], arrays["prev_pos"][part], b,
+                                              friction, dt, field_map)
+    hit_vertex = arrays["hit_vertex"][part]
+    hit_vertex[:] = -1
+    for i, segments in enumerate(polygons):
+        balls, point, vertex_num, pos, new_vel = physics.collide_moving(segments, radius, pos, vel, prev_pos)
+        hit_vertex[balls, i] = vertex_num
+        arrays["hit_point"][part][balls, i] = point
+        arrays["hit_vel_in"][part][balls, i] = vel[balls]
+        arrays["hit_vel"][part][balls, i] = new_vel[balls]
+        vel = new_vel
+    # prev_pos may be a view of the old positions, so it is written first
+    arrays["prev_pos"][part] = prev_pos
+    arrays["vel"][part] = vel
+    arrays["pos"][part] = pos
+
+
+def polygon_hits(arrays):
+    """
+    :param arrays: arrays made by shared_arrays after step_part has moved all balls.
+    :return: tuple (balls, obstacle, vertex_num, point, vel_in, vel_out) with collisions of balls with the polygons,
+        as collisions.CollisionBus.emit_many takes them. They go polygon by polygon, as ChaosStudy emits them when it
+        moves balls itself.
+    """
+    obstacle, balls = np.nonzero(arrays["hit_vertex"].T >= 0)
+    return (balls, obstacle, arrays["hit_vertex"][balls, obstacle], arrays["hit_point"][balls, obstacle],
+            arrays["hit_vel_in"][balls, obstacle], arrays["hit_vel"][balls, obstacle])
+
+
+def work(name, n, part, polygons, radius, field_map, start, done):
+    """Runs in a worker process: moves its part of the ensemble each time all processes have reached the start
+    barrier, then waits at the done barrier. Stops when the control array says so or when the barriers are broken. If
+    the step fails, the done barrier is broken, so that the main process doesn't wait for it."""
+    memory = shared_memory.SharedMemory(name=name)
+    arrays = shared_arrays(memory.buf, n, len(polygons))
+    control = arrays["control"]
+    try:
+        while True:
+            start.wait()
+            b, friction, dt, running = control.tolist()
+            if not running:
+                break
+            step_part(arrays, part, polygons, radius, field_map, b, friction, dt)
+            done.wait()
+    except threading.BrokenBarrierError:  # the main process has given up the workers
+        pass
+    except BaseException:
+        done.abort()
+        raise
+    del arrays, control  # views of the buffer must be gone before it is closed
+    memory.close()
+
+
+def release(memory, processes, start):
+    """Stops worker processes and frees the shared memory."""
+    if memory.buf is not None:
+        control = shared_arrays(memory.buf, 0)["control"]
+        control[3] = 0
+        del control
+    try:
+        start.wait(timeout=1)
+    except Exception:
+        pass
+    for process in processes:
+        process.join(timeout=1)
+        if process.is_alive():
+            process.terminate()
+    try:
+        memory.close()
+    except BufferError:  # somebody still has a view of the block, it is unmapped when the view is gone
+        pass
+    memory.unlink()
+
+
+class EnsembleWorkers:
+    """Moves balls of an ensemble in several processes. State of the balls is moved to a shared memory block, each
+    process moves its own part of the balls in it, and the ensemble keeps views of the block, so balls are drawn from
+    it without copying. Processes start and finish each step together at two barriers.
+
+    Attributes:
+        ensemble: objects.Ensemble which is moved. It mustn't be updated, collided or changed in size by itself.
+        polygons: sides of the edge of the table and of obstacles made by physics.make_segment_array.
+        memory: shared memory block.
+        arrays: dictionary of arrays in the block, as made by shared_arrays.
+        processes: list of worker processes.
+        start: barrier at which processes wait for the next step.
+        done: barrier at which processes wait for each other to finish the step.
+    """
+    def __init__(self, ensemble, polygons, field_map=None, processes=None):
+        n = len(ensemble)
+        processes = processes or default_processes()
+        self.ensemble = ensemble
+        self.polygons = polygons
+        self.memory = shared_memory.SharedMemory(create=True, size=shared_size(n, len(polygons)))
+        self.arrays = shared_arrays(self.memory.buf, n, len(polygons))
+        for name in ("pos", "vel", "prev_pos"):
+            self.arrays[name][:] = getattr(ensemble, name)
+            setattr(ensemble, name, self.arrays[name])
+        self.arrays["hit_vertex"][:] = -1
+        self.arrays["control"][:] = 0, 0, 0, 1
+
+        # processes are spawned, not forked, so that they don't inherit the window
+        context = multiprocessing.get_context("spawn")
+        self.start = context.Barrier(processes + 1)
+        self.done = context.Barrier(processes + 1)
+        bounds = np.linspace(0, n, processes + 1).astype(int)
+        self.processes = [context.Process(target=work, daemon=True,
+                                          args=(self.memory.name, n, slice(bounds[i], bounds[i + 1]), polygons,
+                                                ensemble.radius, field_map, self.start, self.done))
+                          for i in range(processes)]
+        for process in self.processes:
+            process.start()
+        self.finalizer = weakref.finalize(self, release, self.memory, self.processes, self.start)
+
+    def step(self, b, friction, dt):
+        """Moves all balls during one time step and collides them with the polygons.
+
+        :raise threading.BrokenBarrierError: if a worker has failed or hasn't finished the step in STEP_TIMEOUT
+            seconds, then the workers can't be used any more.
+        """
+        self.arrays["control"][:3] = b, friction, dt
+        self.start.wait(STEP_TIMEOUT)
+        self.done.wait(STEP_TIMEOUT)
+
+    def hits(self):
+        """
+        :return: collisions of balls with the polygons during the last step, as polygon_hits returns them.
+        """
+        return polygon_hits(self.arrays)
+
+    def close(self):
+        """Stops processes and frees the shared memory. The ensemble gets copies of its arrays, other views of them
+        must be replaced, as they point to the freed memory."""
+        for name in ("pos", "vel", "prev_pos"):
+            setattr(self.ensemble, name, getattr(self.ensemble, name).copy())
+        self.arrays = None
+        self.finalizer()
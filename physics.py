@@ -0,0 +1,678 @@
+import math
+import numpy as np
+
+STOP_VEL = 0.01  # the ball is stopped when its velocity is lower than that
+
+
+def make_segments(vertices):
+    """Prepares sides of a polygon for collision checks.
+
+    :param vertices: vertices of a polygon.
+    :return: list of tuples (ax, ay, bx, by, tx, ty, nx, ny) for each vertex, where a is the vertex, b is the previous
+        vertex, t is the unit tangent vector from a to b and n is the unit normal to the side.
+    """
+    segments = []
+    for i in range(len(vertices)):
+        ax, ay = float(vertices[i][0]), float(vertices[i][1])
+        bx, by = float(vertices[i - 1][0]), float(vertices[i - 1][1])
+        length = math.sqrt((bx - ax) * (bx - ax) + (by - ay) * (by - ay))
+        tx, ty = (bx - ax) / length, (by - ay) / length
+        segments.append((ax, ay, bx, by, tx, ty, ty, -tx))
+    return segments
+
+
+def step(x, y, vx, vy, b, friction, dt):
+    """Moves a ball during one time step.
+
+    The ball moves along its velocity, then the velocity is turned by the magnetic field keeping its absolute value,
+    then the ball is slowed down by friction.
+
+    :param b: magnetic field.
+    :param friction: friction coefficient with the table.
+    :param dt: time step.
+    :return: new coordinates and velocity as a tuple (x, y, vx, vy).
+    """
+    x = x + vx * dt
+    y = y + vy * dt
+    vel_abs = math.sqrt(vx * vx + vy * vy)
+    # vel + [vel, b] * dt, where magnetic field is perpendicular to the table
+    vx, vy = vx + vy * b * dt, vy - vx * b * dt
+    norm = math.sqrt(vx * vx + vy * vy)
+    if norm != 0:
+        vx = vx / norm * vel_abs
+        vy = vy / norm * vel_abs
+        norm = math.sqrt(vx * vx + vy * vy)
+        vx -= friction * vx / norm * dt
+        vy -= friction * vy / norm * dt
+    return x, y, vx, vy
+
+
+def roll(x, y, vx, vy, b, friction, dt, ticks):
+    """Finds where a ball gets in the following time steps if it doesn't hit anything. step turns velocity by the same
+    angle and reduces its absolute value by the same amount each time, so velocities are found in closed form. That
+    holds while the absolute value is larger than friction * dt, which is so until the ball stops.
+
+    :param ticks: number of time steps.
+    :return: tuple (pos, speed): array of shape (ticks, 2) with coordinates and array with absolute values of velocity
+        after each step.
+    """
+    speed = math.sqrt(vx * vx + vy * vy)
+    k = np.arange(ticks)
+    turn = complex(1, -b * dt)
+    direction = complex(vx, vy) / speed * (turn / abs(turn)) ** k
+    vel = (speed - k * friction * dt) * direction
+    pos = np.array([x, y]) + np.cumsum(np.stack((vel.real, vel.imag), axis=1) * dt, axis=0)
+    return pos, speed - (k + 1) * friction * dt
+
+
+def segment_distance(ax, ay, bx, by, px, py):
+    """
+    :return: distance from point p to the segment from a to b.
+    """
+    dx, dy = bx - ax, by - ay
+    length_sq = dx * dx + dy * dy
+    t = min(max(((px - ax) * dx + (py - ay) * dy) / length_sq, 0.0), 1.0) if length_sq > 0 else 0.0
+    ex, ey = ax + t * dx - px, ay + t * dy - py
+    return math.sqrt(ex * ex + ey * ey)
+
+
+def segment_distance_many(a, b, point):
+    """Same as segment_distance for arrays a and b of shape (n, 2) with ends of segments.
+
+    :return: array of shape (n,).
+    """
+    d = b - a
+    length_sq = (d * d).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(length_sq > 0, np.clip(((point - a) * d).sum(axis=1) / length_sq, 0, 1), 0)
+    e = a + t[:, None] * d - point
+    return np.sqrt((e * e).sum(axis=1))
+
+
+def collide(segments, radius, x, y, vx, vy, prev_x, prev_y):
+    """Calculates a collision between a ball and a polygon.
+
+    :param segments: sides of the polygon made by make_segments.
+    :param radius: radius of the ball.
+    :param x, y: coordinates of the ball.
+    :param vx, vy: velocity of the ball.
+    :param prev_x, prev_y: coordinates of the ball at previous moment of time.
+    :return: None if the collision didn't happen. Otherwise a tuple (point_x, point_y, vertex_num, x, y, vx, vy) where
+        point is the point where the ball collided the polygon, vertex_num is number of a vertex which is one of the
+        ends of the side the ball collided with, and the rest is the state of the ball after the collision.
+    """
+    distance = math.inf
+    for i, (ax, ay, bx, by, tx, ty, nx, ny) in enumerate(segments):
+        r1x, r1y = ax - x, ay - y
+        r2x, r2y = bx - x, by - y
+        if (r1x * tx + r1y * ty) * (r2x * tx + r2y * ty) < 0:  # if the ball is going to hit an edge
+            r_dot_n = r1x * nx + r1y * ny
+            dist = abs(r_dot_n)
+            if dist < distance and dist < radius:
+                if r_dot_n == 0:  # the center of the ball is on the side, there is no way to pick the normal
+                    continue
+                # calculate the normal with correct direction
+                px, py = -r_dot_n * nx, -r_dot_n * ny
+                norm = math.sqrt(px * px + py * py)
+                px, py = px / norm, py / norm
+                if vx * px + vy * py < 0:
+                    point_x, point_y, new_vx, new_vy = calc_new_state(radius, x, y, vx, vy, prev_x, prev_y,
+                                                                      px, py, dist)
+                else:  # the ball rests or already moves away from the side, it is only put back at the radius
+                    point_x, point_y = x - dist * px, y - dist * py
+                    new_vx, new_vy = vx, vy
+                hit = (point_x, point_y, px, py, new_vx, new_vy)
+                distance = dist
+                vertex_num = i
+        else:  # if the ball is going to hit a vertex
+            d_1 = math.sqrt(r1x * r1x + r1y * r1y)
+            d_2 = math.sqrt(r2x * r2x + r2y * r2y)
+            dist = min(d_1, d_2)
+            if 0 < dist < distance and dist < radius:
+                distance = dist
+                if dist == d_1:
+                    point_x, point_y = ax, ay
+                else:
+                    point_x, point_y = bx, by
+                px, py = x - point_x, y - point_y
+                norm = math.sqrt(px * px + py * py)
+                px, py = px / norm, py / norm
+                new_vx, new_vy = flip_vel(px, py, vx, vy)
+                hit = (point_x, point_y, px, py, new_vx, new_vy)
+                vertex_num = i
+    if distance > radius:
+        return None
+    point_x, point_y, px, py, new_vx, new_vy = hit
+    return point_x, point_y, vertex_num, point_x + px * radius, point_y + py * radius, new_vx, new_vy
+
+
+def flip_vel(ax, ay, vx, vy):
+    """Reflects the velocity as if the ball collided elastically with a wall with normal vector (ax, ay)."""
+    norm = math.sqrt(ax * ax + ay * ay)
+    ax, ay = ax / norm, ay / norm
+    v_dot_a = vx * ax + vy * ay
+    perp_x, perp_y = v_dot_a * ax, v_dot_a * ay
+    return -perp_x + (vx - perp_x), -perp_y + (vy - perp_y)
+
+
+def calc_new_state(radius, x, y, vx, vy, prev_x, prev_y, px, py, dist):
+    """Calculates the point where the ball hit the side with normal (px, py) and the velocity after the hit.
+
+    Inside magnetic field the ball moves along a circle, whose radius is found from the last step of the ball.
+
+    :return: tuple (x, y, vx, vy).
+    """
+    speed = math.sqrt(vx * vx + vy * vy)
+    ux, uy = vx / speed, vy / speed
+    gamma = _acos(px * ux + py * uy) - math.pi / 2
+    dx, dy = x - prev_x, y - prev_y
+    d_pos = math.sqrt(dx * dx + dy * dy)
+    if d_pos > 0:
+        cos_beta = min(max(ux * (dx / d_pos) + uy * (dy / d_pos), -1.0), 1.0)
+    else:
+        cos_beta = 1.0
+    if abs(cos_beta) != 1:  # If magnetic field is on
+        circle = d_pos / (2 * (1 - cos_beta ** 2) ** 0.5)  # Radius of the trajectory (which is a circle)
+        cos_gamma = math.cos(gamma) - (radius - dist) / circle
+        if abs(cos_gamma) <= 1:
+            alpha = (math.acos(cos_gamma) - gamma) / 2
+            cos_a, sin_a = math.cos(alpha), math.sin(alpha)
+            ux, uy = cos_a * ux - sin_a * uy, sin_a * ux + cos_a * uy
+            point_x = x - ux * 2 * circle * sin_a - radius * px
+            point_y = y - uy * 2 * circle * sin_a - radius * py
+            new_vx = speed * (cos_a * ux - sin_a * uy)
+            new_vy = speed * (sin_a * ux + cos_a * uy)
+            new_vx, new_vy = flip_vel(px, py, new_vx, new_vy)
+            return point_x, point_y, new_vx, new_vy
+        return 0.0, 0.0, 0.0, 0.0
+    sin_gamma = math.sin(gamma)
+    if sin_gamma == 0:  # the ball moves along the side
+        return x - dist * px, y - dist * py, vx, vy
+    point_x = x - ux * (radius - dist) / sin_gamma - px * radius
+    point_y = y - uy * (radius - dist) / sin_gamma - py * radius
+    new_vx, new_vy = flip_vel(px, py, vx, vy)
+    return point_x, point_y, new_vx, new_vy
+
+
+def _acos(value):
+    """Arc cosine that tolerates rounding errors outside of [-1, 1]."""
+    return math.acos(min(max(value, -1.0), 1.0))
+
+
+def make_segment_array(vertices):
+    """Same as make_segments, but returns an array of shape (number of vertices, 8) for the functions that handle
+    many balls at once."""
+    return np.array(make_segments(vertices), dtype=float).reshape(-1, 8)
+
+
+def step_many(pos, vel, b, friction, dt):
+    """Moves many balls during one time step. Does the same as step.
+
+    :param pos: array of coordinates of shape (n, 2).
+    :param vel: array of velocities of shape (n, 2).
+    :param b: magnetic field, a number or an array of shape (n,).
+    :return: new coordinates and velocities.
+    """
+    pos = pos + vel * dt
+    vx, vy = vel[:, 0], vel[:, 1]
+    vel_abs = np.sqrt(vx * vx + vy * vy)
+    wx, wy = vx + vy * b * dt, vy - vx * b * dt
+    norm = np.sqrt(wx * wx + wy * wy)
+    moving = norm != 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        wx = np.where(moving, wx / norm * vel_abs, wx)
+        wy = np.where(moving, wy / norm * vel_abs, wy)
+        norm = np.sqrt(wx * wx + wy * wy)
+        wx = np.where(moving, wx - friction * wx / norm * dt, wx)
+        wy = np.where(moving, wy - friction * wy / norm * dt, wy)
+    return pos, np.stack((wx, wy), axis=1)
+
+
+def collide_many(segments, radius, pos, vel, prev_pos):
+    """Calculates collisions between many balls and a polygon. Does the same as collide.
+
+    :param segments: sides of the polygon made by make_segment_array.
+    :param radius: radius of the balls.
+    :param pos, vel, prev_pos: arrays of shape (n, 2) with coordinates, velocities and previous coordinates of the
+        balls.
+    :return: tuple (hit, point, vertex_num, pos, vel), where hit shows which balls collided the polygon, point and
+        vertex_num describe the collisions as in collide, pos and vel are the states of the balls after collisions.
+    """
+    n = len(pos)
+    ax, ay, bx, by, tx, ty, nx, ny = segments.T
+    x, y = pos[:, 0:1], pos[:, 1:2]
+    r1x, r1y = ax - x, ay - y
+    r2x, r2y = bx - x, by - y
+    on_edge = (r1x * tx + r1y * ty) * (r2x * tx + r2y * ty) < 0
+    r_dot_n = r1x * nx + r1y * ny
+    d_1 = np.sqrt(r1x * r1x + r1y * r1y)
+    d_2 = np.sqrt(r2x * r2x + r2y * r2y)
+    vertex_dist = np.minimum(d_1, d_2)
+    dist = np.where(on_edge, np.where(r_dot_n != 0, np.abs(r_dot_n), np.inf),
+                    np.where(vertex_dist > 0, vertex_dist, np.inf))
+    vertex_num = dist.argmin(axis=1)
+    rows = np.arange(n)
+    distance = dist[rows, vertex_num]
+    hit = distance < radius
+
+    point = np.zeros((n, 2))
+    new_pos = pos.copy()
+    new_vel = vel.copy()
+    if not hit.any():
+        return hit, point, vertex_num, new_pos, new_vel
+
+    a, b, normal = segments[:, 0:2], segments[:, 2:4], segments[:, 6:8]
+    idx = rows[hit]
+    k = vertex_num[hit]
+    p, v, x = pos[idx], vel[idx], prev_pos[idx]
+    dist = distance[hit]
+    edge = on_edge[idx, k]
+
+    r_perp = -r_dot_n[idx, k][:, None] * normal[k]
+    r_perp = r_perp / np.sqrt((r_perp * r_perp).sum(axis=1))[:, None]
+    edge_point, edge_vel = calc_new_state_many(radius, p, v, x, r_perp, dist)
+    # balls that rest or already move away from the side are only put back at the radius, as collide does
+    leaving = (v * r_perp).sum(axis=1) >= 0
+    edge_point[leaving] = p[leaving] - dist[leaving, None] * r_perp[leaving]
+    edge_vel[leaving] = v[leaving]
+
+    vertex_point = np.where((vertex_dist[idx, k] == d_1[idx, k])[:, None], a[k], b[k])
+    vertex_normal = p - vertex_point
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vertex_normal = vertex_normal / np.sqrt((vertex_normal * vertex_normal).sum(axis=1))[:, None]
+    vertex_vel = flip_vel_many(vertex_normal, v)
+
+    edge = edge[:, None]
+    point[idx] = np.where(edge, edge_point, vertex_point)
+    new_pos[idx] = point[idx] + np.where(edge, r_perp, vertex_normal) * radius
+    new_vel[idx] = np.where(edge, edge_vel, vertex_vel)
+    return hit, point, vertex_num, new_pos, new_vel
+
+
+def flip_vel_many(axis, vel):
+    """Reflects velocities of many balls. Does the same as flip_vel."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        axis = axis / np.sqrt((axis * axis).sum(axis=1))[:, None]
+    v_dot_a = (vel * axis).sum(axis=1)[:, None]
+    perp = v_dot_a * axis
+    return -perp + (vel - perp)
+
+
+def calc_new_state_many(radius, pos, vel, prev_pos, r_perp, dist):
+    """Calculates the points where many balls hit sides with normals r_perp. Does the same as calc_new_state.
+
+    :return: arrays of points and velocities after the hit.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        speed = np.sqrt((vel * vel).sum(axis=1))
+        u = vel / speed[:, None]
+        gamma = np.arccos(np.clip((r_perp * u).sum(axis=1), -1, 1)) - np.pi / 2
+        d = pos - prev_pos
+        d_pos = np.sqrt((d * d).sum(axis=1))
+        cos_beta = np.where(d_pos > 0, np.clip((u * (d / d_pos[:, None])).sum(axis=1), -1, 1), 1)
+        magnetic = np.abs(cos_beta) != 1
+
+        circle = d_pos / (2 * (1 - cos_beta ** 2) ** 0.5)
+        cos_gamma = np.cos(gamma) - (radius - dist) / circle
+        on_circle = magnetic & (np.abs(cos_gamma) <= 1)
+        alpha = (np.arccos(np.clip(cos_gamma, -1, 1)) - gamma) / 2
+        cos_a, sin_a = np.cos(alpha), np.sin(alpha)
+        ux = cos_a * u[:, 0] - sin_a * u[:, 1]
+        uy = sin_a * u[:, 0] + cos_a * u[:, 1]
+        turned = np.stack((ux, uy), axis=1)
+        arc_point = pos - turned * 2 * circle[:, None] * sin_a[:, None] - radius * r_perp
+        arc_vel = speed[:, None] * np.stack((cos_a * ux - sin_a * uy, sin_a * ux + cos_a * uy), axis=1)
+        arc_vel = flip_vel_many(r_perp, arc_vel)
+
+        sin_gamma = np.sin(gamma)
+        line_point = np.where((sin_gamma == 0)[:, None], pos - dist[:, None] * r_perp,
+                              pos - u * (radius - dist)[:, None] / sin_gamma[:, None] - r_perp * radius)
+        line_vel = np.where((sin_gamma == 0)[:, None], vel, flip_vel_many(r_perp, vel))
+
+    point = np.where(magnetic[:, None], np.where(on_circle[:, None], arc_point, 0), line_point)
+    vel = np.where(magnetic[:, None], np.where(on_circle[:, None], arc_vel, 0), line_vel)
+    return point, vel
+
+
+def advance_many(pos, vel, prev_pos, b, friction, dt, field_map=None):
+    """Moves balls that have non-zero velocity during one time step, other balls stay where they are.
+
+    :param pos, vel, prev_pos: arrays of shape (n, 2) with coordinates, velocities and previous coordinates.
+    :param b: magnetic field.
+    :param field_map: FieldMap if the field changes across the table, then b is multiplied by its value at each ball.
+    :return: new coordinates, velocities and previous coordinates.
+    """
+    moving = np.flatnonzero((vel ** 2).sum(axis=1) > 0)
+    if len(moving) == len(pos):
+        if field_map is not None:
+            b = b * field_map.sample_many(pos)
+        new_pos, new_vel = step_many(pos, vel, b, friction, dt)
+        return new_pos, new_vel, pos
+    pos, vel, prev_pos = pos.copy(), vel.copy(), prev_pos.copy()
+    if len(moving):
+        if field_map is not None:
+            b = b * field_map.sample_many(pos[moving])
+        prev_pos[moving] = pos[moving]
+        pos[moving], vel[moving] = step_many(pos[moving], vel[moving], b, friction, dt)
+    return pos, vel, prev_pos
+
+
+def collide_moving(segments, radius, pos, vel, prev_pos):
+    """Calculates collisions of balls that have non-zero velocity with a polygon.
+
+    :return: tuple (balls, point, vertex_num, pos, vel), where balls are numbers of balls that collided the polygon,
+        point and vertex_num describe their collisions as in collide, pos and vel are the states of all balls after
+        collisions.
+    """
+    moving = np.flatnonzero((vel ** 2).sum(axis=1) > 0)
+    if len(moving) == len(pos):
+        hit, point, vertex_num, pos, vel = collide_many(segments, radius, pos, vel, prev_pos)
+        return moving[hit], point[hit], vertex_num[hit], pos, vel
+    if len(moving) == 0:
+        return moving, np.zeros((0, 2)), moving, pos, vel
+    hit, point, vertex_num, moved_pos, moved_vel = collide_many(segments, radius, pos[moving], vel[moving],
+                                                                prev_pos[moving])
+    pos, vel = pos.copy(), vel.copy()
+    pos[moving], vel[moving] = moved_pos, moved_vel
+    return moving[hit], point[hit], vertex_num[hit], pos, vel
+
+
+def ball_pairs(pos, radius):
+    """Finds pairs of balls of the same radius that overlap.
+
+    Balls are sorted along the axis where they are spread more, then each ball is compared with the next ones in that
+    order while they are closer than two radii along the axis, so only balls that are close along the axis are checked.
+
+    :param pos: array of coordinates of shape (n, 2).
+    :return: arrays first and second with numbers of balls in each pair.
+    """
+    axis = int(np.ptp(pos[:, 1]) > np.ptp(pos[:, 0])) if len(pos) else 0
+    order = np.argsort(pos[:, axis], kind="stable")
+    coord = pos[order, axis]
+    first, second = [], []
+    for k in range(1, len(pos)):
+        close = np.flatnonzero(coord[k:] - coord[:-k] < 2 * radius)
+        if len(close) == 0:  # balls further in the order are even further along the axis
+            break
+        first.append(order[close])
+        second.append(order[close + k])
+    if not first:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    first, second = np.concatenate(first), np.concatenate(second)
+    d = pos[first] - pos[second]
+    overlap = (d * d).sum(axis=1) < (2 * radius) ** 2
+    return first[overlap], second[overlap]
+
+
+def collide_balls(pos, vel, radius):
+    """Calculates elastic collisions between balls of the same radius and mass. Balls of an overlapping pair that move
+    towards each other exchange components of their velocities along the line between their centers.
+
+    Collisions are resolved in rounds, in each round a ball takes part in one collision at most, so that a ball that
+    touches several others at once conserves energy. Pairs that have stopped moving towards each other after the
+    previous rounds are skipped.
+
+    :param pos, vel: arrays of shape (n, 2) with coordinates and velocities.
+    :return: tuple (first, second, vel), where first and second are numbers of balls that collided in pairs, vel are
+        velocities of the balls after collisions.
+    """
+    first, second = ball_pairs(pos, radius)
+    if len(first) == 0:
+        return first, second, vel
+    d = pos[first] - pos[second]
+    dist = np.sqrt((d * d).sum(axis=1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normal = np.where((dist > 0)[:, None], d / dist[:, None], [1.0, 0.0])
+    vel = vel.copy()
+    pending = np.arange(len(first))
+    collided = []
+    while len(pending):
+        f, s, n = first[pending], second[pending], normal[pending]
+        closing = ((vel[f] - vel[s]) * n).sum(axis=1)
+        approaching = closing < 0
+        pending, f, s, n, closing = pending[approaching], f[approaching], s[approaching], n[approaching], \
+            closing[approaching]
+        if len(pending) == 0:
+            break
+        # a pair is resolved in this round if it is the first pending pair of both its balls
+        rank = np.arange(len(pending))
+        first_pair = np.full(len(pos), len(pending))
+        np.minimum.at(first_pair, f, rank)
+        np.minimum.at(first_pair, s, rank)
+        chosen = (first_pair[f] == rank) & (first_pair[s] == rank)
+        d_vel = closing[chosen][:, None] * n[chosen]
+        vel[f[chosen]] -= d_vel
+        vel[s[chosen]] += d_vel
+        collided.append(pending[chosen])
+        pending = pending[~chosen]
+    collided = np.concatenate(collided) if collided else np.zeros(0, dtype=int)
+    return first[collided], second[collided], vel
+
+
+def section_coords(vertices, point, vertex_num, vel):
+    """Calculates coordinates of collisions with the edge of the table on Poincare section, as ChaosStudy plots them.
+
+    :param vertices: vertices of the edge.
+    :param point, vertex_num: arrays that describe collisions as in collide_many.
+    :param vel: array of velocities of balls after collisions.
+    :return: tuple of arrays (length, angles): distance from the first vertex to the point along the edge and cosine
+        of the angle between velocity and the side.
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    sides = np.linalg.norm(np.diff(vertices, axis=0), axis=1)
+    vertex_coords = np.concatenate(([0], np.cumsum(sides)))
+    vertex_num = np.asarray(vertex_num)
+    previous = (vertex_num - 1) % len(vertices)
+    length = vertex_coords[previous] + np.linalg.norm(np.asarray(point) - vertices[previous], axis=-1)
+    tangent = vertices[previous] - vertices[vertex_num]
+    tangent /= np.linalg.norm(tangent, axis=-1)[..., None]
+    angles = (vel * tangent).sum(axis=-1) / np.sqrt((vel ** 2).sum(axis=-1))
+    return length, angles
+
+
+def section_state(vertices, radius, length, angles):
+    """Does the opposite of section_coords: finds states of balls that have just bounced off the edge.
+
+    :param vertices: vertices of the edge.
+    :param length, angles: arrays with coordinates of the balls on Poincare section.
+    :return: tuple (pos, vel, vertex_num): arrays with positions of the centers of the balls, unit velocities and
+        numbers of the sides they bounced off as in collide_many.
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    following = np.roll(vertices, -1, axis=0)
+    sides = np.linalg.norm(following - vertices, axis=1)
+    vertex_coords = np.concatenate(([0], np.cumsum(sides)))
+    length = np.asarray(length, dtype=float) % vertex_coords[-1]
+    previous = np.clip(np.searchsorted(vertex_coords, length, side="right") - 1, 0, len(vertices) - 1)
+    direction = (following[previous] - vertices[previous]) / sides[previous, None]
+    point = vertices[previous] + (length - vertex_coords[previous])[:, None] * direction
+    area = (vertices[:, 0] * following[:, 1] - following[:, 0] * vertices[:, 1]).sum()
+    inward = np.sign(area) * np.stack((-direction[:, 1], direction[:, 0]), axis=1)
+    angles = np.clip(angles, -1, 1)[:, None]
+    vel = -angles * direction + np.sqrt(1 - angles ** 2) * inward
+    return point + radius * inward, vel, (previous + 1) % len(vertices)
+
+
+def curvature(speed, b, dt):
+    """
+    :return: signed curvature of the circle on which step puts positions of a ball that moves without friction,
+        positive if the ball turns counterclockwise in coordinates of the table, 0 if there is no magnetic field.
+    """
+    turn = math.atan(abs(b) * dt)  # angle by which the velocity is turned at each step
+    return -math.copysign(2 * math.sin(turn / 2) / (speed * dt), b) if b != 0 else 0.0
+
+
+def fly(polygons, radius, pos, vel, kappa, min_length=1e-9):
+    """Moves balls along circles (or lines if kappa is 0) until they touch a polygon and bounces them off it. This is
+    the exact motion without friction that step approximates, so collisions are found in closed form and balls can
+    travel any distance at once.
+
+    :param polygons: list of sides of polygons made by make_segment_array.
+    :param radius: radius of the balls.
+    :param pos, vel: arrays of shape (n, 2) with positions and unit velocities.
+    :param kappa: curvature of trajectories as returned by curvature.
+    :return: tuple (length, polygon, vertex_num, point, pos, vel): distance travelled, number of the polygon, number of
+        the side as in collide_many, point of contact and the state after the bounce. length is inf for balls that
+        never touch anything, they stay where they are.
+    """
+    segments = np.concatenate(polygons)
+    owner = np.repeat(np.arange(len(polygons)), [len(segments) for segments in polygons])
+    first = np.concatenate(([0], np.cumsum([len(segments) for segments in polygons])))[owner]
+    a, t, n = segments[:, 0:2], segments[:, 4:6], segments[:, 6:8]
+    side_length = np.sqrt(((segments[:, 2:4] - a) ** 2).sum(axis=1))
+    p, u = pos[:, None, :], vel[:, None, :]
+    dist = ((p - a) * n).sum(axis=2)
+    side = np.where(dist >= 0, 1.0, -1.0)  # side of each line on which balls are
+    target = side * radius  # distance from the line at which balls touch it
+    un = (u * n).sum(axis=2)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if kappa == 0:
+            side_hit = (target - dist) / un
+            side_hit[~(side * un < 0)] = np.inf
+            w = p - a
+            half = (u * w).sum(axis=2)
+            disc = half ** 2 - (w * w).sum(axis=2) + radius ** 2
+            vertex_hit = -half - np.sqrt(disc)
+        else:
+            rho = 1 / abs(kappa)
+            e = -np.sign(kappa) * np.stack((-vel[:, 1], vel[:, 0]), axis=1)[:, None, :]
+            c = p - rho * e
+            # angle along the circle: distance from a line is a cosine of it, so it is found by arccos
+            delta = np.arctan2(un, (n * e).sum(axis=2))
+            q = (target - ((c - a) * n).sum(axis=2)) / rho
+            side_hit = rho * ((delta + side * np.arccos(q)) % (2 * np.pi))
+            g = c - a
+            g_abs = np.sqrt((g * g).sum(axis=2))
+            delta = np.arctan2((g * u).sum(axis=2), (g * e).sum(axis=2))
+            q = (radius ** 2 - g_abs ** 2 - rho ** 2) / (2 * rho * g_abs)
+            vertex_hit = rho * ((delta + np.arccos(q)) % (2 * np.pi))
+        side_hit[~(side_hit > min_length)] = np.inf
+        vertex_hit[~(vertex_hit > min_length)] = np.inf
+
+        def position(travelled):
+            if kappa == 0:
+                return p + u * travelled[..., None], np.broadcast_to(u, travelled.shape + (2,))
+            angle = travelled[..., None] / rho
+            return (c + rho * (e * np.cos(angle) + u * np.sin(angle)),
+                    u * np.cos(angle) - e * np.sin(angle))
+
+        # contacts with sides are only valid between the vertices
+        along = ((position(np.where(np.isfinite(side_hit), side_hit, 0))[0] - a) * t).sum(axis=2)
+        side_hit[(along < 0) | (along > side_length)] = np.inf
+
+    hits = np.concatenate((side_hit, vertex_hit), axis=1)
+    best = hits.argmin(axis=1)
+    rows = np.arange(len(pos))
+    length = hits[rows, best]
+    k = best % len(segments)
+    on_side = best < len(segments)
+    new_pos, new_vel = position(np.where(np.isfinite(length), length, 0)[:, None])
+    new_pos, new_vel = new_pos[:, 0], new_vel[:, 0]
+    normal = np.where(on_side[:, None], (side[rows, k, None] * n[k]), (new_pos - a[k]) / radius)
+    point = new_pos - radius * normal
+    new_vel = new_vel - 2 * (new_vel * normal).sum(axis=1)[:, None] * normal
+    missed = ~np.isfinite(length)
+    new_pos[missed], new_vel[missed], point[missed] = pos[missed], vel[missed], np.nan
+    return length, owner[k], k - first[k], point, new_pos, new_vel
+
+
+def bounce_map(polygons, radius, pos, vel, kappa, max_bounces=100):
+    """Moves balls until they bounce off the first polygon, the edge of the table, bouncing off other polygons on the
+    way. This is the map of the edge to itself that is shown on Poincare section.
+
+    :return: tuple (ok, point, vertex_num, pos, vel) as fly returns them for the collisions with the edge. ok is False
+        for balls that didn't reach the edge after max_bounces bounces or never touch anything.
+    """
+    pos, vel = pos.copy(), vel.copy()
+    point = np.full_like(pos, np.nan)
+    vertex_num = np.zeros(len(pos), dtype=int)
+    ok = np.zeros(len(pos), dtype=bool)
+    flying = np.arange(len(pos))
+    for _ in range(max_bounces):
+        length, polygon, number, hit_point, pos[flying], vel[flying] = fly(polygons, radius, pos[flying],
+                                                                           vel[flying], kappa)
+        edge = (polygon == 0) & np.isfinite(length)
+        done = flying[edge]
+        ok[done] = True
+        point[done], vertex_num[done] = hit_point[edge], number[edge]
+        flying = flying[np.isfinite(length) & ~edge]
+        if len(flying) == 0:
+            break
+    return ok, point, vertex_num, pos, vel
+
+
+def inside_polygon(points, segments):
+    """Checks which points lie inside a polygon by the even-odd rule.
+
+    :param points: array of shape (n, 2).
+    :param segments: sides of the polygon made by make_segment_array.
+    :return: boolean array of shape (n,).
+    """
+    ax, ay, bx, by = segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]
+    x, y = points[:, 0:1], points[:, 1:2]
+    straddles = (ay > y) != (by > y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crossing_x = ax + (bx - ax) * (y - ay) / (by - ay)
+    return (straddles & (x < crossing_x)).sum(axis=1) % 2 == 1
+
+
+def polygon_distance(points, segments):
+    """Calculates distances from points to the nearest side of a polygon.
+
+    :param points: array of shape (n, 2).
+    :param segments: sides of the polygon made by make_segment_array.
+    :return: array of shape (n,).
+    """
+    ax, ay, bx, by = segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]
+    x, y = points[:, 0:1], points[:, 1:2]
+    dx, dy = bx - ax, by - ay
+    t = np.clip(((x - ax) * dx + (y - ay) * dy) / (dx * dx + dy * dy), 0, 1)
+    ex, ey = x - ax - t * dx, y - ay - t * dy
+    return np.sqrt(ex * ex + ey * ey).min(axis=1)
+
+
+class FieldMap:
+    """Magnetic field that changes across the table. It is given on the nodes of a regular grid as multipliers of the
+    field that player sets, and between the nodes it is interpolated bilinearly. Outside of the grid the values on its
+    border are used.
+
+    Attributes:
+        origin: coordinates of the first node.
+        step: distance between neighbouring nodes.
+        values numpy(rows, columns): multipliers in the nodes.
+        padded: values with the last row and column repeated, so that points on the border of the grid are
+            interpolated like any other.
+        padded_list: padded as nested lists, for sampling one point at a time.
+    """
+    def __init__(self, origin, step, values):
+        self.origin = (float(origin[0]), float(origin[1]))
+        self.step = float(step)
+        self.values = np.array(values, dtype=float)
+        self.padded = np.pad(self.values, ((0, 1), (0, 1)), mode="edge")
+        self.padded_list = self.padded.tolist()
+
+    def sample(self, x, y):
+        """
+        :return: multiplier of the field at the point (x, y).
+        """
+        rows, columns = self.values.shape
+        gx = min(max((x - self.origin[0]) / self.step, 0.0), columns - 1.0)
+        gy = min(max((y - self.origin[1]) / self.step, 0.0), rows - 1.0)
+        i, j = int(gy), int(gx)
+        fy, fx = gy - i, gx - j
+        top, bottom = self.padded_list[i], self.padded_list[i + 1]
+        return (top[j] * (1 - fx) + top[j + 1] * fx) * (1 - fy) + (bottom[j] * (1 - fx) + bottom[j + 1] * fx) * fy
+
+    def sample_many(self, pos):
+        """
+        :param pos: array of coordinates of shape (n, 2).
+        :return: array of multipliers of the field at the points. Same as sample for each point.
+        """
+        rows, columns = self.values.shape
+        gx = np.clip((pos[:, 0] - self.origin[0]) / self.step, 0.0, columns - 1.0)
+        gy = np.clip((pos[:, 1] - self.origin[1]) / self.step, 0.0, rows - 1.0)
+        i, j = gy.astype(int), gx.astype(int)
+        fy, fx = gy - i, gx - j
+        v = self.padded
+        return (v[i, j] * (1 - fx) + v[i, j + 1] * fx) * (1 - fy) + (v[i + 1, j] * (1 - fx) + v[i + 1, j + 1] * fx) * fy
@@ -0,0 +1,141 @@
+import collections
+import math
+import time
+import pygame
+import physics
+
+
+class Prediction:
+    """Path of the ball after a shot that is being computed.
+
+    Attributes:
+        state: position, velocity and previous position of the ball at the last computed tick.
+        points: positions of the ball, one per `every` ticks, and all points where it collided.
+        bounces: number of collisions so far.
+        ticks: number of computed ticks.
+        done: shows if the path is complete.
+    """
+    def __init__(self, pos, vel):
+        self.state = (float(pos[0]), float(pos[1]), float(vel[0]), float(vel[1]), float(pos[0]), float(pos[1]))
+        self.points = [(float(pos[0]), float(pos[1]))]
+        self.bounces = 0
+        self.ticks = 0
+        self.done = False
+
+
+class TrajectoryPreview:
+    """Predicts where the ball goes after a shot and draws the path.
+
+    Paths are kept in a cache, keyed by quantized angle, power and magnetic field, so moving the mouse back and forth
+    doesn't compute them again. Each frame the path for the current key is extended only until the time budget runs
+    out, and it continues on the next frames. Other balls of the level are not taken into account.
+
+    Attributes:
+        polygons: sides of the edge of the table and of obstacles.
+        pocket: position of the pocket.
+        field_map: magnetic field that changes across the table, None if the field is uniform.
+        radius: radius of the ball.
+        pocket_radius: radius of the pocket.
+        friction: friction coefficient between the ball and the table.
+        dt: time step.
+
+        bounces: number of collisions after which the path is cut.
+        max_ticks: maximum length of the path in ticks.
+        every: number of ticks between points of the path.
+        budget: time in seconds that can be spent on computations each frame.
+
+        cache: ordered dictionary of Prediction objects, least recently used first.
+        cache_size: maximum number of predictions in the cache.
+        start: position of the ball for which predictions in the cache were made.
+        current: prediction for the current aim.
+        color: color of the path.
+    """
+    def __init__(self, map_data, friction, dt, radius=10, pocket_radius=10, bounces=3, max_ticks=3000, every=4,
+                 budget=0.002, cache_size=256):
+        self.polygons = [physics.make_segments(map_data[2])] + \
+                        [physics.make_segments(obstacle) for obstacle in map_data[3]]
+        self.pocket = (float(map_data[1][0]), float(map_data[1][1]))
+        self.field_map = map_data[4]
+        self.radius = radius
+        self.pocket_radius = pocket_radius
+        self.friction = friction
+        self.dt = dt
+
+        self.bounces = bounces
+        self.max_ticks = max_ticks
+        self.every = every
+        self.budget = budget
+
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.start = None
+        self.current = None
+        self.color = pygame.Color("#888888")
+
+    @staticmethod
+    def key(vel, b):
+        """Quantizes the shot: angle to a quarter of a degree, power to 0.1 of velocity and field to 0.001."""
+        angle = math.degrees(math.atan2(vel[1], vel[0]))
+        return round(angle * 4), round(math.hypot(vel[0], vel[1]) * 10), round(b * 1000)
+
+    def update(self, pos, vel, b):
+        """Finds the prediction for the shot and extends it within the time budget.
+
+        :param pos: position of the ball.
+        :param vel: velocity the ball will get.
+        :param b: magnetic field.
+        """
+        start = (float(pos[0]), float(pos[1]))
+        if start != self.start:
+            self.cache.clear()
+            self.start = start
+        key = self.key(vel, b)
+        prediction = self.cache.get(key)
+        if prediction is None:
+            prediction = Prediction(pos, vel)
+            self.cache[key] = prediction
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        self.current = prediction
+        if not prediction.done:
+            self.extend(prediction, b, time.perf_counter() + self.budget)
+
+    def extend(self, prediction, b, deadline):
+        """Computes the path further until it is complete or the deadline has passed."""
+        x, y, vx, vy, prev_x, prev_y = prediction.state
+        points = prediction.points
+        pocket_x, pocket_y = self.pocket
+        field_map = self.field_map
+        while True:
+            for _ in range(32):
+                prev_x, prev_y = x, y
+                b_here = b if field_map is None else b * field_map.sample(x, y)
+                x, y, vx, vy = physics.step(x, y, vx, vy, b_here, self.friction, self.dt)
+                collided = False
+                for segments in self.polygons:
+                    hit = physics.collide(segments, self.radius, x, y, vx, vy, prev_x, prev_y)
+                    if hit is not None:
+                        collided = True
+                        x, y, vx, vy = hit[3:]
+                prediction.ticks += 1
+                if collided:
+                    prediction.bounces += 1
+                if collided or prediction.ticks % self.every == 0:
+                    points.append((x, y))
+                if (collided and prediction.bounces >= self.bounces or
+                        physics.segment_distance(prev_x, prev_y, x, y, pocket_x, pocket_y) <= self.pocket_radius or
+                        (vx * vx + vy * vy) ** 0.5 < physics.STOP_VEL or prediction.ticks >= self.max_ticks):
+                    points.append((x, y))
+                    prediction.done = True
+                    prediction.state = (x, y, vx, vy, prev_x, prev_y)
+                    return
+            if time.perf_counter() > deadline:
+                prediction.state = (x, y, vx, vy, prev_x, prev_y)
+                return
+
+    def draw(self, surface):
+        """Draws the predicted path."""
+        if self.current is not None and len(self.current.points) >= 2:
+            pygame.draw.lines(surface, self.color, False, self.current.points, 1)
@@ -0,0 +1,128 @@
+import time
+import numpy as np
+import pygame
+
+STAGES = ("events", "gui", "physics", "collision", "draw", "display")
+
+
+class FrameProfiler:
+    """Measures how long each stage of a frame takes.
+
+    Time between two calls of mark is added to the stage given to the second call. Times of the last frames are kept
+    in a ring buffer. If the profiler is off, mark returns at once.
+
+    Attributes:
+        enabled: variable that shows if frames are measured and the overlay is drawn.
+        stages: names of the stages.
+        columns: dictionary that gives column of the buffer for each stage.
+        samples: ring buffer of shape (size, number of stages + 1) with times of stages and of the whole frame in
+            seconds.
+        frames: number of measured frames.
+        current: times of stages in the current frame.
+        frame_start: time when the current frame started.
+        last: time of the last mark.
+
+        overlay: surface with the table of percentiles.
+        overlay_frame: number of the frame when overlay was made.
+    """
+    def __init__(self, stages=STAGES, size=600):
+        self.enabled = False
+        self.stages = stages
+        self.columns = {stage: i for i, stage in enumerate(stages)}
+        self.samples = np.zeros((size, len(stages) + 1))
+        self.frames = 0
+        self.current = [0.0] * len(stages)
+        self.frame_start = 0.0
+        self.last = 0.0
+
+        self.overlay = None
+        self.overlay_frame = -1
+
+    def toggle(self):
+        """Turns profiler and its overlay on and off."""
+        self.enabled = not self.enabled
+        self.frames = 0
+        self.overlay = None
+        self.start_frame()
+
+    def start_frame(self):
+        """Starts measuring a new frame."""
+        if not self.enabled:
+            return
+        self.current = [0.0] * len(self.stages)
+        self.frame_start = self.last = time.perf_counter()
+
+    def mark(self, stage):
+        """Adds time since the last mark to the stage."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.current[self.columns[stage]] += now - self.last
+        self.last = now
+
+    def end_frame(self):
+        """Saves times of the current frame to the buffer."""
+        if not self.enabled:
+            return
+        row = self.samples[self.frames % len(self.samples)]
+        row[:-1] = self.current
+        row[-1] = time.perf_counter() - self.frame_start
+        self.frames += 1
+
+    def recent(self):
+        """
+
+        :return: rows of the buffer that contain measured frames, oldest first.
+        """
+        size = len(self.samples)
+        if self.frames < size:
+            return self.samples[:self.frames]
+        return np.roll(self.samples, -(self.frames % size), axis=0)
+
+    def percentiles(self, q=(50, 95, 99)):
+        """
+
+        :return: array of shape (number of stages + 1, len(q)) with percentiles of times in milliseconds.
+        """
+        samples = self.recent()
+        if len(samples) == 0:
+            return np.zeros((len(self.stages) + 1, len(q)))
+        return np.percentile(samples, q, axis=0).T * 1000
+
+    def draw(self, surface, every=30):
+        """Draws table of percentiles in the top right corner. The table is updated once in several frames."""
+        if not self.enabled:
+            return
+        if self.overlay is None or self.frames - self.overlay_frame >= every:
+            self.overlay = self.make_overlay()
+            self.overlay_frame = self.frames
+        surface.blit(self.overlay, self.overlay.get_rect(topright=(surface.get_width() - 10, 10)))
+
+    def make_overlay(self):
+        """Renders table of percentiles."""
+        font = pygame.font.Font(None, 20)
+        rows = [("ms", "p50", "p95", "p99")]
+        for name, values in zip(self.stages + ("frame",), self.percentiles()):
+            rows.append((name,) + tuple(f"{value:.2f}" for value in values))
+        name_width, value_width, line_height = 80, 50, font.get_linesize()
+        overlay = pygame.Surface((name_width + 3 * value_width + 10, len(rows) * line_height + 10), pygame.SRCALPHA)
+        overlay.fill((0, 0, 0, 160))
+        for i, row in enumerate(rows):
+            y = 5 + i * line_height
+            overlay.blit(font.render(row[0], 1, pygame.Color("white")), (5, y))
+            for j, cell in enumerate(row[1:]):
+                text = font.render(cell, 1, pygame.Color("white"))
+                overlay.blit(text, text.get_rect(topright=(5 + name_width + (j + 1) * value_width, y)))
+        return overlay
+
+    def export_csv(self, path):
+        """Writes times of the measured frames in milliseconds to a csv file."""
+        samples = self.recent() * 1000
+        first = self.frames - len(samples)
+        with open(path, "w", encoding="utf8") as f:
+            f.write(",".join(("frame",) + self.stages + ("total",)) + "\n")
+            for i, row in enumerate(samples):
+                f.write(f"{first + i}," + ",".join(f"{value:.4f}" for value in row) + "\n")
+
+
+frames = FrameProfiler()
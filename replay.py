@@ -0,0 +1,236 @@
+import struct
+import sys
+import time
+import numpy as np
+import data
+import physics
+
+MAGIC = b"MPRL"
+VERSION = 2  # since version 2 the ball gets into the pocket if it passes over it during a tick
+# magic, version, level, seed, dt, friction, ball radius, pocket radius
+HEADER = struct.Struct("<4sHIIddHH")
+# kind, tick, two values
+RECORD = struct.Struct("<BIdd")
+
+FIELD = 0  # magnetic field changed: value
+SHOT = 1  # player hit the ball: velocity
+END = 2  # level was won: score
+
+MAX_ROLL = 100000  # ticks the ball is allowed to roll after the last event
+
+
+class ShotRecorder:
+    """Records everything that player does in a game, so the game can be simulated again.
+
+    Attributes:
+        header: parameters of the game.
+        records: list of packed events.
+        field_value: last recorded value of magnetic field.
+    """
+    def __init__(self, level, seed, dt, friction, ball_radius, pocket_radius):
+        self.header = HEADER.pack(MAGIC, VERSION, level, seed, dt, friction, ball_radius, pocket_radius)
+        self.records = []
+        self.field_value = None
+
+    def field(self, tick, value):
+        """Records value of magnetic field if it has changed."""
+        if value != self.field_value:
+            self.field_value = value
+            self.records.append(RECORD.pack(FIELD, tick, value, 0))
+
+    def shot(self, tick, vel):
+        """Records velocity the ball has got from the cue."""
+        self.records.append(RECORD.pack(SHOT, tick, vel[0], vel[1]))
+
+    def end(self, tick, score):
+        """Records the end of the game."""
+        self.records.append(RECORD.pack(END, tick, score, 0))
+
+    def to_bytes(self):
+        return self.header + b"".join(self.records)
+
+
+class ShotLog:
+    """Recorded game.
+
+    Attributes:
+        level, seed, dt, friction, ball_radius, pocket_radius: parameters of the game.
+        version: version of the format the game was recorded in.
+        events: array of recorded events with fields kind, tick, a, b.
+    """
+    dtype = np.dtype([("kind", "<u1"), ("tick", "<u4"), ("a", "<f8"), ("b", "<f8")])
+
+    def __init__(self, raw):
+        magic, self.version, self.level, self.seed, self.dt, self.friction, self.ball_radius, self.pocket_radius = \
+            HEADER.unpack_from(raw)
+        if magic != MAGIC or not 1 <= self.version <= VERSION:
+            raise ValueError("not a shot log")
+        self.events = np.frombuffer(raw, dtype=self.dtype, offset=HEADER.size)
+
+    def recorded_score(self):
+        """
+
+        :return: score which the game has written at the end, None if the game wasn't finished.
+        """
+        ends = self.events[self.events["kind"] == END]
+        if len(ends) == 0:
+            return None
+        return int(ends["a"][-1])
+
+
+class ReplayResult:
+    """Outcome of a simulated game.
+
+    Attributes:
+        score: player's score.
+        win: shows if the ball got into the pocket.
+        ticks: number of simulated time steps.
+        trajectory: list of (tick, x, y, vx, vy), if it was requested.
+    """
+    def __init__(self, score, win, ticks, trajectory=None):
+        self.score = score
+        self.win = win
+        self.ticks = ticks
+        self.trajectory = trajectory
+
+
+def simulate(log, map_data=None, trace=False):
+    """Simulates recorded game without rendering.
+
+    Every tick is computed exactly as Game.update does it, except the ticks when the ball is resting and nothing
+    happens: they are skipped.
+
+    :param log: ShotLog object.
+    :param map_data: data about the level, read from file if not given.
+    :param trace: if True, the state of the ball after every simulated tick is saved.
+    :return: ReplayResult object.
+    """
+    if map_data is None:
+        map_data = data.read_map(log.level)
+    polygons = [physics.make_segments(map_data[2])] + [physics.make_segments(obstacle) for obstacle in map_data[3]]
+    segment_arrays = [np.array(segments).reshape(-1, 8) for segments in polygons]
+    pocket_x, pocket_y = map_data[1]
+    pocket = np.array(map_data[1], dtype=float)
+    field_map = map_data[4]
+    radius = log.ball_radius
+    pocket_radius = log.pocket_radius
+    swept = log.version >= 2
+    dt, friction = log.dt, log.friction
+    np.random.seed(log.seed)
+
+    x, y = float(map_data[0][0]), float(map_data[0][1])
+    vx = vy = prev_x = prev_y = 0.0
+    # other balls, moved as objects.Ensemble moves them in Game
+    others = map_data[5]
+    other_pos = np.array(others, dtype=float).reshape(-1, 2)
+    other_vel = np.zeros_like(other_pos)
+    other_prev = other_pos.copy()
+    b = 0.0
+    score = 10
+    first_hit = True
+    trajectory = [] if trace else None
+
+    events = log.events
+    last_tick = int(events["tick"][-1]) if len(events) else 0
+    n = 0
+    tick = 0
+    while tick <= last_tick + MAX_ROLL:
+        while n < len(events) and events["tick"][n] == tick:
+            kind, _, a, c = events[n]
+            if kind == FIELD:
+                b = float(a)
+            elif kind == SHOT:
+                if first_hit:
+                    first_hit = False
+                else:
+                    score = max(score - 2, 0)
+                vx, vy = float(a), float(c)
+            n += 1
+
+        prev_x, prev_y = x, y
+        b_here = b if field_map is None else b * field_map.sample(x, y)
+        x, y, vx, vy = physics.step(x, y, vx, vy, b_here, friction, dt)
+        if others:
+            other_pos, other_vel, other_prev = physics.advance_many(other_pos, other_vel, other_prev, b, friction, dt,
+                                                                    field_map)
+        collided = False
+        for segments, segment_array in zip(polygons, segment_arrays):
+            hit = physics.collide(segments, radius, x, y, vx, vy, prev_x, prev_y)
+            if hit is not None:
+                collided = True
+                x, y, vx, vy = hit[3:]
+            if others:
+                other_pos, other_vel = physics.collide_moving(segment_array, radius, other_pos, other_vel,
+                                                              other_prev)[3:]
+        if others:
+            pos = np.concatenate(([[x, y]], other_pos))
+            vel = np.concatenate(([[vx, vy]], other_vel))
+            first, second, vel = physics.collide_balls(pos, vel, radius)
+            if len(first):
+                vx, vy = vel[0].tolist()
+                other_vel = vel[1:]
+                collided = collided or bool((first == 0).any() or (second == 0).any())
+        if collided:
+            score = max(score - 1, 0)
+        if trace:
+            trajectory.append((tick, x, y, vx, vy))
+
+        if swept:
+            won = physics.segment_distance(prev_x, prev_y, x, y, pocket_x, pocket_y) <= pocket_radius
+        else:
+            won = (x - pocket_x) ** 2 + (y - pocket_y) ** 2 <= pocket_radius ** 2
+        if won:
+            return ReplayResult(score, True, tick + 1, trajectory)
+        if (vx * vx + vy * vy) ** 0.5 < physics.STOP_VEL:
+            vx = vy = 0.0
+        if others:
+            if swept:
+                kept = physics.segment_distance_many(other_prev, other_pos, pocket) > pocket_radius
+            else:
+                kept = ((other_pos - pocket) ** 2).sum(axis=1) > pocket_radius ** 2
+            other_pos, other_vel, other_prev = other_pos[kept], other_vel[kept], other_prev[kept]
+            other_vel[(other_vel ** 2).sum(axis=1) < physics.STOP_VEL ** 2] = 0
+        if vx == vy == 0.0 and not (other_vel ** 2).sum():
+            if not collided:
+                # nothing happens until the next event
+                if n == len(events):
+                    break
+                tick = int(events["tick"][n])
+                continue
+        tick += 1
+    return ReplayResult(score, False, tick + 1, trajectory)
+
+
+def audit(level):
+    """Checks the high score of the level by simulating the game that has set it.
+
+    :return: tuple (stored score, simulated score, recorded score). Simulated and recorded scores are None if there
+        is no record of the game.
+    """
+    stored = data.get_levels_scores().get(level, 0)
+    raw = data.read_replay(level)
+    if raw is None:
+        return stored, None, None
+    log = ShotLog(raw)
+    result = simulate(log)
+    return stored, result.score if result.win else 0, log.recorded_score()
+
+
+def main(levels):
+    """Audits high scores of the levels and prints results."""
+    for level in levels:
+        start = time.perf_counter()
+        stored, simulated, recorded = audit(level)
+        elapsed = time.perf_counter() - start
+        if simulated is None:
+            status = "no record" if stored == 0 else "UNVERIFIED"
+        elif simulated == recorded == stored:
+            status = "ok"
+        else:
+            status = "MISMATCH"
+        print(f"level {level}: stored {stored}, simulated {simulated}, recorded {recorded} "
+              f"({elapsed * 1000:.1f} ms) {status}")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or range(1, data.number_of_levels() + 1))
@@ -0,0 +1,303 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import struct
+import sys
+
+import numpy as np
+
+import collisions
+import data
+import parallel
+import physics
+import solver
+from constants import DT
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PORT = 8765
+FRAME = struct.Struct("<II")  # sizes of the header and of the arrays of a message
+BALL_RADIUS = 10
+
+levels = {}  # level number: (time the level file was changed, map data, segment arrays), cache of a worker process
+
+
+def send_message(connection, header, arrays=None):
+    """Sends a message: a json header that describes the arrays, followed by bytes of the arrays one after another.
+
+    :param header: dictionary with parameters of a request or reply.
+    :param arrays: dictionary of numpy arrays.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in (arrays or {}).items()}
+    header = dict(header, arrays=[[name, np.lib.format.dtype_to_descr(array.dtype), list(array.shape)]
+                                  for name, array in arrays.items()])
+    raw_header = json.dumps(header).encode("utf8")
+    connection.sendall(FRAME.pack(len(raw_header), sum(array.nbytes for array in arrays.values())) + raw_header)
+    for array in arrays.values():
+        if array.nbytes:
+            connection.sendall(memoryview(array).cast("B"))
+
+
+def receive_exactly(connection, size):
+    """
+    :return: bytearray of the given size read from the connection, None if it was closed before the first byte.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = connection.recv_into(view[received:])
+        if count == 0:
+            if received == 0:
+                return None
+            raise ConnectionError("connection closed in the middle of a message")
+        received += count
+    return buffer
+
+
+def receive_message(connection):
+    """
+    :return: tuple (header, arrays) of a message sent by send_message, None if the connection was closed. Arrays are
+        views of the received bytes, so they aren't copied.
+    """
+    frame = receive_exactly(connection, FRAME.size)
+    if frame is None:
+        return None
+    header_size, body_size = FRAME.unpack(frame)
+    header = json.loads(receive_exactly(connection, header_size).decode("utf8"))
+    body = receive_exactly(connection, body_size) if body_size else bytearray()
+    arrays = {}
+    offset = 0
+    for name, descr, shape in header.pop("arrays"):
+        dtype = np.lib.format.descr_to_dtype(descr)
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(body, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += count * dtype.itemsize
+    return header, arrays
+
+
+def geometry(level):
+    """
+    :return: tuple (map data, segment arrays of the edge and obstacles) of the level. They are kept until the level
+        file is changed.
+    """
+    changed = os.path.getmtime(os.path.join("levels", "level_" + str(level) + ".txt"))
+    if level not in levels or levels[level][0] != changed:
+        map_data = data.read_map(level)
+        polygons = [physics.make_segment_array(map_data[2])] + \
+                   [physics.make_segment_array(obstacle) for obstacle in map_data[3]]
+        levels[level] = (changed, map_data, polygons)
+    return levels[level][1:]
+
+
+def load_levels():
+    """Fills the cache of a worker process with all levels, so the first requests don't wait for them."""
+    os.chdir(ROOT)
+    for level in range(1, data.number_of_levels() + 1):
+        geometry(level)
+
+
+def simulate_shots(params, arrays):
+    """Simulates shots of the ball of the level as solver.simulate_shots does.
+
+    :param params: level, steps (maximum number of ticks), every (if not 0, trajectories are saved once in this
+        number of ticks), field_step (ticks each value of the field schedule is kept).
+    :param arrays: vel (n, 2), fields (n, k) or field (n,), optional pos (n, 2) with positions of the ball.
+    :return: dictionary with arrays win, collisions, miss, ticks, pos and trajectory if every is not 0.
+    """
+    map_data, polygons = geometry(params["level"])
+    vel = arrays["vel"]
+    fields = arrays["fields"] if "fields" in arrays else arrays["field"].reshape(-1, 1)
+    every = params.get("every", 0)
+    results = solver.simulate_shots(map_data, vel, fields, params.get("field_step", 60), params.get("steps", 5000),
+                                    arrays.get("pos"), every)
+    names = ("win", "collisions", "miss", "ticks", "pos", "trajectory")
+    return dict(zip(names, results))
+
+
+def simulate_ensemble(params, arrays):
+    """Moves an ensemble of balls on the table of the level as ChaosStudy does and records their collisions with the
+    edge of the table.
+
+    :param params: level, steps, field (magnetic field), friction (0 by default).
+    :param arrays: pos (n, 2) and vel (n, 2).
+    :return: dictionary with arrays events (collisions.EVENT records), length and angles (coordinates of the
+        collisions on Poincare section) and pos, vel (states of the balls at the end).
+    """
+    map_data, polygons = geometry(params["level"])
+    n = len(arrays["pos"])
+    state = parallel.shared_arrays(bytearray(parallel.shared_size(n, len(polygons))), n, len(polygons))
+    state["pos"][:] = state["prev_pos"][:] = arrays["pos"]
+    state["vel"][:] = arrays["vel"]
+    part = slice(0, n)
+    bus = collisions.CollisionBus()
+    events = []
+    bus.subscribe(lambda tick_events: events.append(tick_events.copy()))
+    for tick in range(params.get("steps", 1000)):
+        parallel.step_part(state, part, polygons, BALL_RADIUS, map_data[4], params.get("field", 0.0),
+                           params.get("friction", 0.0), DT)
+        bus.emit_many(*parallel.polygon_hits(state))
+        bus.publish(tick)
+    events = np.concatenate(events) if events else np.zeros(0, dtype=collisions.EVENT)
+    events = events[events["obstacle"] == 0]
+    length, angles = physics.section_coords(map_data[2], events["point"], events["vertex"], events["vel_out"])
+    return {"events": events, "length": length, "angles": angles, "pos": state["pos"].copy(),
+            "vel": state["vel"].copy()}
+
+
+KINDS = {"shots": simulate_shots, "ensemble": simulate_ensemble}
+
+
+def run_chunk(job):
+    """Runs a part of a request in a worker process."""
+    kind, params, arrays = job
+    return KINDS[kind](params, arrays)
+
+
+def split(arrays, chunks):
+    """
+    :return: list of dictionaries with parts of the arrays, split along the first axis.
+    """
+    n = len(next(iter(arrays.values())))
+    bounds = np.linspace(0, n, chunks + 1).astype(int)
+    return [{name: array[bounds[i]:bounds[i + 1]] for name, array in arrays.items()} for i in range(chunks)
+            if bounds[i + 1] > bounds[i]]
+
+
+def merge(kind, results, parts):
+    """Joins results of the parts of a request. Numbers of balls in events are counted from the whole request, and
+    events are ordered by time."""
+    if kind == "ensemble":
+        first = 0
+        for result, part in zip(results, parts):
+            result["events"]["ball"] += first
+            first += len(part["pos"])
+    merged = {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+    if kind == "ensemble":
+        order = np.argsort(merged["events"]["tick"], kind="stable")
+        for name in ("events", "length", "angles"):
+            merged[name] = merged[name][order]
+    return merged
+
+
+class Handler(socketserver.BaseRequestHandler):
+    """Answers requests that come through a connection until it is closed. Each request is split between processes of
+    the pool of the server."""
+    def handle(self):
+        while True:
+            message = receive_message(self.request)
+            if message is None:
+                return
+            header, arrays = message
+            try:
+                kind = header["kind"]
+                if kind not in KINDS:
+                    raise ValueError(f"unknown kind of request {kind!r}")
+                parts = split(arrays, self.server.processes) if arrays else [arrays]
+                results = self.server.pool.map(run_chunk, [(kind, header, part) for part in parts])
+                send_message(self.request, {"kind": kind}, merge(kind, results, parts))
+            except Exception as error:
+                send_message(self.request, {"error": f"{type(error).__name__}: {error}"})
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "ThreadingUnixStreamServer"):  # there are no unix sockets on Windows
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+def serve(address, processes=None):
+    """Starts the pool of worker processes and answers requests until interrupted.
+
+    :param address: tuple (host, port) or path of a unix socket.
+    """
+    os.chdir(ROOT)
+    processes = processes or os.cpu_count() or 1
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixServer(address, Handler)
+    else:
+        server = TCPServer(address, Handler)
+    server.processes = processes
+    server.pool = multiprocessing.Pool(processes, initializer=load_levels)
+    print(f"serving on {address} with {processes} processes", file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.pool.terminate()
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+
+
+class Client:
+    """Sends requests to the server.
+
+    Attributes:
+        connection: socket connected to the server.
+    """
+    def __init__(self, address=("127.0.0.1", PORT)):
+        """
+        :param address: tuple (host, port) or path of a unix socket.
+        """
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.connection = socket.socket(family, socket.SOCK_STREAM)
+        self.connection.connect(address)
+
+    def request(self, kind, arrays, **params):
+        """
+        :return: dictionary of arrays of the reply.
+        """
+        send_message(self.connection, dict(params, kind=kind), arrays)
+        message = receive_message(self.connection)
+        if message is None:
+            raise ConnectionError("server closed the connection")
+        header, arrays = message
+        if "error" in header:
+            raise RuntimeError(header["error"])
+        return arrays
+
+    def shots(self, level, vel, fields, pos=None, **params):
+        """Simulates shots, see simulate_shots."""
+        arrays = {"vel": np.asarray(vel, dtype=float), "fields": np.asarray(fields, dtype=float).reshape(len(vel), -1)}
+        if pos is not None:
+            arrays["pos"] = np.asarray(pos, dtype=float)
+        return self.request("shots", arrays, level=level, **params)
+
+    def ensemble(self, level, pos, vel, **params):
+        """Moves an ensemble of balls, see simulate_ensemble."""
+        return self.request("ensemble", {"pos": np.asarray(pos, dtype=float), "vel": np.asarray(vel, dtype=float)},
+                            level=level, **params)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server that simulates batches of shots and ensembles of balls on "
+                                                 "levels of the game for other programs.")
+    parser.add_argument("--port", type=int, default=PORT, help="port on localhost to listen to")
+    parser.add_argument("--unix", help="path of a unix socket to listen to instead of the port")
+    parser.add_argument("--processes", type=int, help="number of worker processes, all cores by default")
+    args = parser.parse_args()
+    try:
+        serve(args.unix or ("127.0.0.1", args.port), args.processes)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import multiprocessing
+import sys
+import time
+import numpy as np
+import data
+import physics
+from constants import DT
+
+FRICTION = 0.01  # same as in game.Game
+MAX_VEL = 15  # same as cue in game.Game
+MAX_FIELD = 0.15  # same as objects.MagneticField
+BALL_RADIUS = 10
+POCKET_RADIUS = 10
+
+
+class Shot:
+    """Describes a shot found by the solver.
+
+    Attributes:
+        angle: angle between x axis and direction of the hit.
+        power: value of the cue, percentage of maximum velocity.
+        fields: values of magnetic field, each one is kept for field_step ticks, the last one is kept till the end.
+        win: shows if the ball gets into the pocket.
+        collisions: number of ticks at which the ball collided with obstacles.
+        miss: closest distance between the ball and the pocket.
+    """
+    def __init__(self, angle, power, fields, win, collisions, miss):
+        self.angle = angle
+        self.power = power
+        self.fields = fields
+        self.win = win
+        self.collisions = collisions
+        self.miss = miss
+
+    def score(self):
+        """
+
+        :return: score that player gets for the shot.
+        """
+        return max(10 - self.collisions, 0) if self.win else 0
+
+    def __repr__(self):
+        fields = ", ".join(f"{b:.3f}" for b in self.fields)
+        return (f"Shot(angle={np.degrees(self.angle):.2f}, power={self.power}, fields=[{fields}], "
+                f"win={self.win}, collisions={self.collisions}, score={self.score()})")
+
+
+def shot_velocity(angle, power):
+    """Calculates velocities given by the cue, as Cue.get_vel does."""
+    direction = np.stack((np.cos(angle), np.sin(angle)), axis=-1)
+    return (np.asarray(power) / 100 * MAX_VEL)[..., None] * direction
+
+
+def simulate_shots(map_data, vel, fields, field_step=60, max_ticks=5000, pos=None, every=0, max_collisions=None):
+    """Simulates many shots from the ball position of the level at once.
+
+    Balls are moved as in Game.update, but balls that have stopped or got into the pocket are removed from
+    computations. Other balls of the level are not taken into account.
+
+    :param map_data: data about the level as returned by data.read_map.
+    :param vel: array of shape (n, 2) with velocities given to the ball.
+    :param fields: array of shape (n, k) with schedules of magnetic field.
+    :param field_step: number of ticks each value of the schedule is kept.
+    :param max_ticks: maximum number of ticks to simulate.
+    :param pos: array of shape (n, 2) with positions from which shots are made, the ball position of the level if
+        None.
+    :param every: if not 0, positions of balls are saved once in this number of ticks.
+    :param max_collisions: if not None, shots are stopped as lost after more collisions than this.
+    :return: tuple of arrays (win, collisions, miss, ticks, pos) with results for each shot. If every is not 0, an
+        array of shape (n, max_ticks // every + 1, 2) with saved positions is added to it, balls that have finished
+        keep their last position.
+    """
+    polygons = [physics.make_segment_array(map_data[2])] + \
+               [physics.make_segment_array(obstacle) for obstacle in map_data[3]]
+    pocket = np.array(map_data[1], dtype=float)
+    field_map = map_data[4]
+    n = len(vel)
+    fields = np.asarray(fields, dtype=float).reshape(n, -1)
+
+    win = np.zeros(n, dtype=bool)
+    collisions = np.zeros(n, dtype=int)
+    miss = np.full(n, np.inf)
+    ticks = np.zeros(n, dtype=int)
+    final_pos = np.zeros((n, 2))
+
+    active = np.arange(n)
+    if pos is None:
+        pos = np.tile(np.array(map_data[0], dtype=float), (n, 1))
+    pos = np.array(pos, dtype=float).reshape(n, 2)
+    vel = np.array(vel, dtype=float)
+    trajectory = np.zeros((n, max_ticks // every + 1, 2)) if every else None
+    if every:
+        trajectory[:, 0] = pos
+    for tick in range(max_ticks):
+        if len(active) == 0:
+            break
+        b = fields[active, min(tick // field_step, fields.shape[1] - 1)]
+        if field_map is not None:
+            b = b * field_map.sample_many(pos)
+        prev_pos = pos
+        pos, vel = physics.step_many(pos, vel, b, FRICTION, DT)
+        collided = np.zeros(len(active), dtype=bool)
+        for segments in polygons:
+            hit, _, _, pos, vel = physics.collide_many(segments, BALL_RADIUS, pos, vel, prev_pos)
+            collided |= hit
+        collisions[active] += collided
+
+        to_pocket = physics.segment_distance_many(prev_pos, pos, pocket)
+        miss[active] = np.minimum(miss[active], to_pocket)
+        won = to_pocket <= POCKET_RADIUS
+        stopped = np.sqrt((vel ** 2).sum(axis=1)) < physics.STOP_VEL
+        if max_collisions is not None:
+            stopped |= collisions[active] > max_collisions
+        done = won | stopped
+        if done.any():
+            finished = active[done]
+            win[finished] = won[done]
+            ticks[finished] = tick + 1
+            final_pos[finished] = pos[done]
+            if every:
+                trajectory[finished, (tick + 1) // every + ((tick + 1) % every > 0):] = pos[done][:, None]
+            active, pos, vel = active[~done], pos[~done], vel[~done]
+        if every and (tick + 1) % every == 0:
+            trajectory[active, (tick + 1) // every] = pos
+    ticks[active] = max_ticks
+    final_pos[active] = pos
+    if every:
+        return win, collisions, miss, ticks, final_pos, trajectory
+    return win, collisions, miss, ticks, final_pos
+
+
+def _simulate_chunk(args):
+    """Runs simulate_shots in a worker process."""
+    map_data, angle, power, fields, field_step, max_collisions = args
+    return simulate_shots(map_data, shot_velocity(angle, power), fields, field_step,
+                          max_collisions=max_collisions)[:3]
+
+
+def evaluate(map_data, angle, power, fields, field_step=60, pool=None, chunk=4096, max_collisions=None):
+    """Simulates shots given by cue angles, cue values and field schedules, splitting them between processes of the
+    pool.
+
+    :param max_collisions: if not None, shots with more collisions are stopped and counted as lost.
+    :return: list of Shot objects.
+    """
+    n = len(angle)
+    if n == 0:
+        return []
+    jobs = [(map_data, angle[i:i + chunk], power[i:i + chunk], fields[i:i + chunk], field_step, max_collisions)
+            for i in range(0, n, chunk)]
+    if pool is None:
+        results = [_simulate_chunk(job) for job in jobs]
+    else:
+        results = pool.map(_simulate_chunk, jobs)
+    win, collisions, miss = (np.concatenate(arrays) for arrays in zip(*results))
+    return [Shot(float(angle[i]), int(power[i]), tuple(float(b) for b in fields[i]), bool(win[i]),
+                 int(collisions[i]), float(miss[i]))
+            for i in range(n)]
+
+
+def rank(shot):
+    """Key for sorting shots: shots that win with less collisions first, then shots that miss the pocket less."""
+    if shot.win:
+        return 0, shot.collisions, 0
+    return 1, 0, shot.miss
+
+
+def search(map_data, field_steps=1, field_step=60, rounds=4, angles=180, fields=5, refine=64, top=16,
+           processes=None, seed=0, stop_on_win=False):
+    """Searches shots that put the ball in the pocket with the fewest collisions.
+
+    First a grid over cue angle, cue value and magnetic field is simulated. Then several times the best shots are
+    taken and new shots are sampled around them in shrinking regions.
+
+    :param map_data: data about the level as returned by data.read_map.
+    :param field_steps: number of values in magnetic field schedule.
+    :param field_step: number of ticks each value of the schedule is kept.
+    :param rounds: number of refinement rounds.
+    :param angles, fields: number of angle and field values in the first grid.
+    :param refine: number of shots sampled around each of the best shots.
+    :param top: number of best shots to refine and to return.
+    :param processes: number of worker processes, 1 to simulate in this process.
+    :param stop_on_win: if True, returns as soon as any shot wins.
+    :return: list of the best Shot objects.
+    """
+    rng = np.random.RandomState(seed)
+    grid = np.meshgrid(np.linspace(0, 2 * np.pi, angles, endpoint=False),
+                       np.arange(5, 101, 5),
+                       *[np.linspace(-MAX_FIELD, MAX_FIELD, fields)] * field_steps,
+                       indexing="ij")
+    grid = [axis.ravel() for axis in grid]
+    angle, power, schedule = grid[0], grid[1], np.stack(grid[2:], axis=1)
+
+    # processes are spawned, not forked, so that they don't inherit the window when the game checks a level
+    pool = multiprocessing.get_context("spawn").Pool(processes) if processes != 1 else None
+    try:
+        shots = sorted(evaluate(map_data, angle, power, schedule, field_step, pool), key=rank)[:top]
+        d_angle, d_field = 2 * np.pi / angles, 2 * MAX_FIELD / max(fields - 1, 1)
+        for _ in range(rounds):
+            if stop_on_win and shots[0].win:
+                break
+            base_angle = np.repeat([shot.angle for shot in shots], refine)
+            base_power = np.repeat([shot.power for shot in shots], refine)
+            base_fields = np.repeat([shot.fields for shot in shots], refine, axis=0)
+            angle = base_angle + d_angle * rng.uniform(-1, 1, len(base_angle))
+            power = np.clip(base_power + 5 * rng.randint(-1, 2, len(base_power)), 5, 100)
+            schedule = np.clip(base_fields + d_field * rng.uniform(-1, 1, base_fields.shape), -MAX_FIELD, MAX_FIELD)
+            new_shots = evaluate(map_data, angle, power, schedule, field_step, pool)
+            shots = sorted(shots + new_shots, key=rank)[:top]
+            d_angle, d_field = d_angle / 2, d_field / 2
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return shots
+
+
+def max_score(shots):
+    """
+
+    :return: maximum score among the shots.
+    """
+    return max([shot.score() for shot in shots], default=0)
+
+
+def is_solvable(map_data, processes=None):
+    """Quickly checks if the ball of the level can be put in the pocket with one shot."""
+    shots = search(map_data, rounds=2, angles=90, fields=3, refine=32, top=8, processes=processes,
+                   stop_on_win=True)
+    return any(shot.win for shot in shots)
+
+
+def main(level):
+    """Prints the best shots for the level."""
+    start = time.perf_counter()
+    shots = search(data.read_map(level))
+    for shot in shots:
+        print(shot)
+    print(f"level {level}: maximum score {max_score(shots)} ({time.perf_counter() - start:.1f} s)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]))